@@ -0,0 +1 @@
+"""Benchmarks for fetpype, run on synthetic data (see README.md)."""
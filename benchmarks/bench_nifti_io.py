@@ -0,0 +1,239 @@
+"""
+Micro-benchmarks of the NIfTI I/O done by the Python nodes of fetpype.
+
+Each node (`CropStacksAndMasks`, `CheckAffineResStacksAndMasks`,
+`clamp_intensities`) is run as it is in the pipeline, over a matrix of
+data types, compression (uncompressed `.nii` or `.nii.gz` at several
+gzip levels) and volume sizes. The calls of the nodes to `load_nifti`
+and `save_nifti` are timed, so that the load, compute and save steps are
+reported separately. The throughput (MB/s of uncompressed data), the
+size on disk and the peak Python memory of the whole node are reported.
+
+Examples:
+    python -m benchmarks.bench_nifti_io
+    python -m benchmarks.bench_nifti_io --dtypes float32 --levels 0 1 \\
+        --sizes stack srr --threads 4 --out nifti_io.json
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import fetpype.nodes.preprocessing as preprocessing
+import fetpype.utils.utils_nifti as utils_nifti
+from fetpype.utils.utils_synthetic import make_stack
+
+SIZES = {
+    "stack": ((99, 113, 36), (1.1, 1.1, 3.2)),
+    "srr": ((128, 128, 128), (0.8, 0.8, 0.8)),
+    "large": ((256, 256, 256), (0.5, 0.5, 0.5)),
+}
+DTYPES = ["int16", "float32", "float64"]
+# 0 means an uncompressed .nii file
+LEVELS = [0, 1, 6, 9]
+
+
+@contextlib.contextmanager
+def timed_io(times):
+    """
+    Accumulate in `times` the time spent by the nodes in `load_nifti`
+    and `save_nifti`. Loading includes reading the data, which nibabel
+    otherwise defers to the first `get_fdata` of the node.
+    """
+    load, save = utils_nifti.load_nifti, utils_nifti.save_nifti
+
+    def timed_load(*args, **kwargs):
+        start = time.perf_counter()
+        img = load(*args, **kwargs)
+        img.get_fdata()
+        times["load"] += time.perf_counter() - start
+        return img
+
+    def timed_save(*args, **kwargs):
+        start = time.perf_counter()
+        path = save(*args, **kwargs)
+        times["save"] += time.perf_counter() - start
+        return path
+
+    # The preprocessing nodes import the functions at the module level,
+    # clamp_intensities from utils_nifti when it runs.
+    modules = [utils_nifti, preprocessing]
+    for module in modules:
+        module.load_nifti, module.save_nifti = timed_load, timed_save
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.load_nifti, module.save_nifti = load, save
+
+
+def node_crop(image_path, mask_path, fmt):
+    """Run CropStacksAndMasks."""
+    preprocessing.CropStacksAndMasks(
+        image=image_path, mask=mask_path, **fmt
+    ).run()
+
+
+def node_check(image_path, mask_path, fmt):
+    """Run CheckAffineResStacksAndMasks."""
+    preprocessing.CheckAffineResStacksAndMasks(
+        stacks=[image_path], masks=[mask_path], **fmt
+    ).run()
+
+
+def node_clamp(image_path, mask_path, fmt):
+    """Run clamp_intensities."""
+    from fetpype.nodes.reconstruction import clamp_intensities
+
+    clamp_intensities(image_path, 0.997, **fmt)
+
+
+NODES = {
+    "CropStacksAndMasks": node_crop,
+    "CheckAffineResStacksAndMasks": node_check,
+    "clamp_intensities": node_clamp,
+}
+
+
+def run_node(node, image_path, mask_path, fmt):
+    """
+    Run a node once, in the current directory.
+
+    Returns:
+        dict: Time spent loading, computing and saving, in seconds.
+    """
+    times = {"load": 0.0, "save": 0.0}
+    with timed_io(times):
+        start = time.perf_counter()
+        NODES[node](image_path, mask_path, fmt)
+        total = time.perf_counter() - start
+    times["compute"] = total - times["load"] - times["save"]
+    return times
+
+
+def run_case(work_dir, node, size, dtype, level, repeat, threads=1):
+    """
+    Benchmark one node for one (size, dtype, level) combination, with
+    `threads` (de)compression threads.
+
+    Returns:
+        dict: Median timings of each step, throughputs, size on disk and
+              peak memory.
+    """
+    shape, zooms = SIZES[size]
+    stack, mask = make_stack(shape, zooms, np.random.default_rng(0), dtype)
+    ext = ".nii.gz" if level else ".nii"
+    image_path = os.path.join(work_dir, f"in_T2w{ext}")
+    mask_path = os.path.join(work_dir, f"in_mask{ext}")
+    out_dir = os.path.join(work_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    utils_nifti.save_nifti(stack, image_path, level or None)
+    utils_nifti.save_nifti(mask, mask_path, level or None)
+    # Outputs in the format and gzip level of the inputs
+    fmt = {
+        "output_format": "nii.gz" if level else "nii",
+        "compresslevel": level or None,
+        "num_threads": threads,
+    }
+
+    steps = []
+    peaks = []
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        for _ in range(repeat):
+            tracemalloc.start()
+            steps.append(run_node(node, image_path, mask_path, fmt))
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+
+    megabytes = np.prod(shape) * np.dtype(dtype).itemsize / 1e6
+    result = {
+        "node": node,
+        "size": size,
+        "dtype": dtype,
+        "compression": f"gzip-{level}" if level else "none",
+        "threads": threads,
+        "file_mb": os.path.getsize(image_path) / 1e6,
+        "peak_mb": max(peaks) / 1e6,
+    }
+    for step in ("load", "compute", "save"):
+        t = statistics.median(s[step] for s in steps)
+        result[f"{step}_s"] = t
+        if step != "compute":
+            result[f"{step}_mb_s"] = megabytes / t if t > 0 else float("inf")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="NIfTI I/O micro-benchmarks of the fetpype nodes."
+    )
+    parser.add_argument(
+        "--nodes", nargs="+", default=list(NODES), choices=list(NODES)
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", default=["stack", "srr"], choices=list(SIZES)
+    )
+    parser.add_argument("--dtypes", nargs="+", default=DTYPES)
+    parser.add_argument(
+        "--levels",
+        type=int,
+        nargs="+",
+        default=LEVELS,
+        help="gzip levels to benchmark, 0 for uncompressed files.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads used by the nodes to (de)compress files.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", default=None, help="Save results as JSON.")
+    args = parser.parse_args(argv)
+    # The nodes log every file they process
+    logging.getLogger("nipype.workflow").setLevel(logging.WARNING)
+
+    results = []
+    header = (
+        f"{'node':30s} {'size':6s} {'dtype':8s} {'compr.':7s} "
+        f"{'file MB':>8s} {'load MB/s':>10s} {'comp. s':>8s} "
+        f"{'save MB/s':>10s} {'peak MB':>8s}"
+    )
+    print(header)
+    with tempfile.TemporaryDirectory(prefix="fetpype_io_") as work_dir:
+        for node, size, dtype, level in itertools.product(
+            args.nodes, args.sizes, args.dtypes, args.levels
+        ):
+            r = run_case(
+                work_dir, node, size, dtype, level, args.repeat, args.threads
+            )
+            results.append(r)
+            print(
+                f"{node:30s} {size:6s} {dtype:8s} {r['compression']:7s} "
+                f"{r['file_mb']:8.2f} {r['load_mb_s']:10.1f} "
+                f"{r['compute_s']:8.3f} {r['save_mb_s']:10.1f} "
+                f"{r['peak_mb']:8.1f}"
+            )
+            sys.stdout.flush()
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
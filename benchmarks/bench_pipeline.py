@@ -0,0 +1,426 @@
+"""
+End-to-end benchmark of fetpype on synthetic cohorts.
+
+Containers are replaced by `stub_container.py`, which sleeps and copies
+its inputs, so that the timings measure fetpype and nipype rather than
+the reconstruction or segmentation methods. The benchmark times:
+
+- the construction of the full workflow graph,
+- the BIDS indexing done by `create_datasource`,
+- the construction and expansion of the graph of a cohort, as a single
+  workflow iterating over the subjects and as one workflow per subject,
+- the Python nodes `CropStacksAndMasks`, `CheckAffineResStacksAndMasks`,
+  `PreprocessStacksAndMasks` and `clamp_intensities`,
+- a full run under MultiProc, including the datasinks.
+
+Examples:
+    python -m benchmarks.bench_pipeline --subjects 1 10 100 \\
+        --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench_pipeline --subjects 1 10 100 \\
+        --compare benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from fetpype.utils.utils_synthetic import (
+    generate_cohort,
+    make_stack,
+    stub_cmd,
+)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def timed(func, repeat=3):
+    """
+    Time `func` `repeat` times.
+
+    Returns:
+        dict: Minimum and median wall time, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def write_config(
+    cfg_dir, sleep, intermediate_format="nii.gz", streaming=False
+):
+    """
+    Copy the configs of the repository into `cfg_dir` and write a
+    configuration where every container is replaced by the stub.
+
+    Returns:
+        str: Path to the configuration file.
+    """
+    shutil.copytree(REPO_ROOT / "configs", cfg_dir, dirs_exist_ok=True)
+    stacks = stub_cmd("<input_stacks>", "<output_stacks>", sleep)
+    cfg = {
+        "defaults": [
+            "preprocessing/default",
+            "reconstruction/nesvor",
+            "reconstruction/postprocessing",
+            "segmentation/bounti",
+            "surface/surfpype",
+            "_self_",
+        ],
+        "container": "docker",
+        "save_graph": False,
+        "intermediate_format": intermediate_format,
+        "preprocessing": {
+            "streaming": streaming,
+            "brain_extraction": {
+                "docker": {
+                    "cmd": stub_cmd("<input_stacks>", "<output_masks>", sleep)
+                }
+            },
+            "denoising": {"docker": {"cmd": stacks}},
+            "bias_correction": {"docker": {"cmd": stacks}},
+        },
+        "reconstruction": {
+            "output_resolution": 0.8,
+            "reconstruction": {
+                "docker": {
+                    "cmd": stub_cmd("<input_stacks>", "<output_volume>", sleep)
+                }
+            },
+            "postprocessing": {
+                "bias_correction": {"docker": {"cmd": stacks}}
+            },
+        },
+        "segmentation": {
+            "docker": {
+                "cmd": stub_cmd("<input_volume>", "<output_seg>", sleep)
+            }
+        },
+        "surface": {
+            "docker": {
+                "cmd": stub_cmd("<input_seg>", "<output_surf>", sleep)
+            }
+        },
+    }
+    cfg_path = os.path.join(cfg_dir, "cfg_benchmark.yaml")
+    with open(cfg_path, "w") as f:
+        yaml.dump(cfg, f)
+    return cfg_path
+
+
+def bench_nodes(work_dir, repeat):
+    """Time the Python nodes on a single synthetic stack."""
+    import numpy as np
+    import nibabel as nib
+    from fetpype.nodes.preprocessing import (
+        CropStacksAndMasks,
+        CheckAffineResStacksAndMasks,
+        PreprocessStacksAndMasks,
+    )
+    from fetpype.nodes.reconstruction import clamp_intensities
+
+    from fetpype.utils.utils_synthetic import STACKS
+
+    rng = np.random.default_rng(0)
+    stacks, masks = [], []
+    for i, (shape, zooms) in enumerate(STACKS):
+        stack, mask = make_stack(shape, zooms, rng)
+        stacks.append(os.path.join(work_dir, f"run-{i}_T2w.nii.gz"))
+        masks.append(os.path.join(work_dir, f"run-{i}_mask.nii.gz"))
+        nib.save(stack, stacks[-1])
+        nib.save(mask, masks[-1])
+    srr, _ = make_stack((128, 128, 128), (0.8, 0.8, 0.8), rng, np.float32)
+    srr_path = os.path.join(work_dir, "srr.nii.gz")
+    nib.save(srr, srr_path)
+
+    cwd = os.getcwd()
+    # The outputs have the name of the inputs
+    os.makedirs(os.path.join(work_dir, "nodes"), exist_ok=True)
+    os.chdir(os.path.join(work_dir, "nodes"))
+    try:
+        return {
+            "crop_stacks_and_masks": timed(
+                lambda: CropStacksAndMasks(
+                    image=stacks[0], mask=masks[0]
+                ).run(),
+                repeat,
+            ),
+            "check_affine_res_stacks_and_masks": timed(
+                lambda: CheckAffineResStacksAndMasks(
+                    stacks=stacks, masks=masks
+                ).run(),
+                repeat,
+            ),
+            "preprocess_stacks_and_masks": timed(
+                lambda: PreprocessStacksAndMasks(
+                    stacks=stacks, masks=masks
+                ).run(),
+                repeat,
+            ),
+            "clamp_intensities": timed(
+                lambda: clamp_intensities(srr_path, 0.997), repeat
+            ),
+        }
+    finally:
+        os.chdir(cwd)
+
+
+def expand_graph(datasource, cfg, nipype_dir, out_dir, entities=None):
+    """
+    Build the main workflow and expand its graph as `workflow.run` does,
+    for all the subjects of `datasource` or only for `entities`.
+    """
+    from copy import deepcopy
+
+    import nipype.pipeline.engine as pe
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+
+    from fetpype.workflows.pipeline_fet import connect_main_workflow
+
+    datasource = deepcopy(datasource)
+    if entities is not None:
+        datasource.iterables = [datasource.iterables[0], [entities]]
+    workflow = pe.Workflow(name="bench", base_dir=nipype_dir)
+    connect_main_workflow(workflow, datasource, cfg, out_dir, load_masks=True)
+    return generate_expanded_graph(deepcopy(workflow._create_flat_graph()))
+
+
+def bench_graph(datasource, cfg_path, nipype_dir, out_dir, repeat):
+    """Time the graph construction of a cohort in both graph modes."""
+    from fetpype.workflows.utils import init_and_load_cfg
+
+    cfg = init_and_load_cfg(cfg_path)
+    return {
+        "graph_expand_iterables": timed(
+            lambda: expand_graph(datasource, cfg, nipype_dir, out_dir),
+            repeat,
+        ),
+        # Total over the subjects, spread over the workers during a run
+        "graph_expand_per_subject": timed(
+            lambda: [
+                expand_graph(datasource, cfg, nipype_dir, out_dir, entities)
+                for entities in datasource.iterables[1]
+            ],
+            repeat,
+        ),
+    }
+
+
+def bench_cohort(work_dir, n_subjects, cfg_path, args):
+    """Time indexing, and optionally a full run, on one cohort size."""
+    from fetpype.utils.utils_bids import create_datasource
+
+    data_dir = os.path.join(work_dir, f"cohort_{n_subjects}")
+    subjects = generate_cohort(data_dir, n_subjects)
+    masks_dir = os.path.join(data_dir, "derivatives", "masks")
+    query = {
+        "stacks": {"datatype": "anat", "suffix": "T2w"},
+        "masks": {"datatype": "anat", "suffix": "mask"},
+    }
+    nipype_dir = os.path.join(work_dir, f"nipype_{n_subjects}")
+    os.makedirs(nipype_dir, exist_ok=True)
+    results = {
+        "create_datasource": timed(
+            lambda: create_datasource(
+                query,
+                data_dir,
+                nipype_dir,
+                extra_derivatives=masks_dir,
+            ),
+            args.repeat,
+        )
+    }
+    datasource = create_datasource(
+        query, data_dir, nipype_dir, extra_derivatives=masks_dir
+    )
+    results.update(
+        bench_graph(
+            datasource,
+            cfg_path,
+            nipype_dir,
+            os.path.join(work_dir, f"out_{n_subjects}"),
+            args.repeat,
+        )
+    )
+    if n_subjects <= args.max_run_subjects:
+        from fetpype.workflows.pipeline_fet import create_main_workflow
+
+        def run():
+            create_main_workflow(
+                data_dir=data_dir,
+                masks_dir=masks_dir,
+                out_dir=os.path.join(work_dir, f"out_{n_subjects}"),
+                nipype_dir=nipype_dir,
+                subjects=subjects,
+                sessions=None,
+                acquisitions=None,
+                cfg_path=cfg_path,
+                nprocs=args.nprocs,
+                cleanup=args.cleanup,
+                min_free_gb=args.min_free_gb,
+                graph_mode=args.graph_mode,
+            )
+
+        # A single repetition: a second run would only hit nipype's cache
+        results["multiproc_run"] = timed(run, 1)
+    return results
+
+
+def compare(results, baseline, tolerance, floor=0.05):
+    """
+    Compare `results` to `baseline`, using the median timings.
+
+    Returns:
+        list: Description of each benchmark that regressed by more than
+              `tolerance` (relative) and `floor` seconds.
+    """
+    regressions = []
+    for name, ref in baseline["results"].items():
+        if name not in results:
+            continue
+        old, new = ref["median"], results[name]["median"]
+        if new > old * (1 + tolerance) and new - old > floor:
+            regressions.append(f"{name}: {old:.3f}s -> {new:.3f}s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="End-to-end fetpype benchmark on synthetic cohorts."
+    )
+    parser.add_argument(
+        "--subjects",
+        type=int,
+        nargs="+",
+        default=[1, 10],
+        help="Cohort sizes to benchmark (1 to 500 subjects).",
+    )
+    parser.add_argument(
+        "--max_run_subjects",
+        "--max-run-subjects",
+        type=int,
+        default=10,
+        help="Largest cohort for which the full workflow is run.",
+    )
+    parser.add_argument("--nprocs", type=int, default=4)
+    parser.add_argument(
+        "--sleep",
+        type=float,
+        default=0.0,
+        help="Time (s) spent by each stub container call.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--intermediate_format",
+        "--intermediate-format",
+        default="nii.gz",
+        choices=["nii.gz", "nii"],
+        help="Format of the intermediate files written by fetpype.",
+    )
+    parser.add_argument(
+        "--cleanup",
+        default="keep_all",
+        choices=["keep_all", "keep_final", "keep_none"],
+        help="Cleanup policy of the nipype directory.",
+    )
+    parser.add_argument(
+        "--min_free_gb",
+        "--min-free-gb",
+        type=float,
+        default=None,
+        help="Free space to keep with disk-space admission of subjects.",
+    )
+    parser.add_argument(
+        "--graph_mode",
+        "--graph-mode",
+        default="iterables",
+        choices=["iterables", "per_subject"],
+        help="Graph construction mode of the full run.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Run the preprocessing of each stack independently.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        "--work-dir",
+        default=None,
+        help="Where to write the cohorts (default: temporary directory).",
+    )
+    parser.add_argument("--save_baseline", "--save-baseline", default=None)
+    parser.add_argument("--compare", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="fetpype_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    cfg_path = write_config(
+        os.path.join(work_dir, "configs"),
+        args.sleep,
+        args.intermediate_format,
+        args.streaming,
+    )
+
+    from fetpype.pipelines.full_pipeline import create_full_pipeline
+    from fetpype.workflows.utils import init_and_load_cfg
+
+    cfg = init_and_load_cfg(cfg_path)
+    results = {
+        "graph_build": timed(
+            lambda: create_full_pipeline(cfg, load_masks=True), args.repeat
+        )
+    }
+    node_dir = os.path.join(work_dir, "nodes")
+    os.makedirs(node_dir, exist_ok=True)
+    results.update(bench_nodes(node_dir, args.repeat))
+    for n in args.subjects:
+        for name, value in bench_cohort(work_dir, n, cfg_path, args).items():
+            results[f"{name}[n={n}]"] = value
+
+    import fetpype
+
+    report = {
+        "fetpype_version": fetpype.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "nprocs": args.nprocs,
+        "sleep": args.sleep,
+        "intermediate_format": args.intermediate_format,
+        "cleanup": args.cleanup,
+        "graph_mode": args.graph_mode,
+        "streaming": args.streaming,
+        "results": results,
+    }
+    out = sys.__stdout__
+    for name, value in results.items():
+        print(
+            f"{name:45s} min {value['min']:8.3f}s  "
+            f"median {value['median']:8.3f}s",
+            file=out,
+        )
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions), file=out)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
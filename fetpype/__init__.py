@@ -1,6 +1,5 @@
-from . import pipelines  # noqa
-from . import nodes  # noqa
-from . import utils  # noqa
+import importlib
+
 from .definitions import (  # noqa
     VALID_RECONSTRUCTION,
     VALID_SEGMENTATION,
@@ -17,3 +16,18 @@ try:
 except ImportError:
     # We're running in a tree that doesn't have a _version.py
     pass
+
+# Submodules are only imported when first accessed (PEP 562), so that
+# the command line entry points do not pay for nipype, pybids or hydra
+# before the arguments have been parsed.
+_lazy_submodules = ("nodes", "pipelines", "utils", "workflows")
+
+
+def __getattr__(name):
+    if name in _lazy_submodules:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_submodules))
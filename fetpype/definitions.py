@@ -28,6 +28,7 @@ VALID_RECON_TAGS = [
     "input_dir",
     "input_masks",
     "input_masks_dir",
+    "input_slice_reports",
     "output_dir",
     "output_volume",
     "input_tp",
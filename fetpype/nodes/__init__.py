@@ -1 +1,10 @@
-from .utils import is_valid_cmd, get_mount_docker, get_directory  # noqa
+from .utils import (  # noqa
+    is_valid_cmd,
+    get_mount_docker,
+    get_mount_args,
+    get_directory,
+    CommandTemplate,
+    as_template,
+    HostValue,
+    host_value,
+)
@@ -31,7 +31,9 @@ def dhcp_pipeline(
     # Flags can be either "-all", "-seg", or "-surf"
     """
     import os
+    import shlex
     import shutil
+    from fetpype.utils.logging import run_and_tee
 
     output_dir = os.path.abspath("dhcp_output")
     os.makedirs(output_dir, exist_ok=True)
@@ -56,39 +58,45 @@ def dhcp_pipeline(
     )
 
     if "docker" in pre_command:
-        cmd = pre_command
-        cmd += (
-            f"-v {output_dir}:/data "
-            f"{dhcp_image} "
-            f"/data/{recon_file_name} "
-            f"{gestational_age} "
-            "-data-dir /data "
-            f"-t {threads} "
-            "-c 0 "
-            f"{flag} "
-        )
+        cmd = shlex.split(pre_command) + [
+            "-v",
+            f"{output_dir}:/data",
+            *shlex.split(dhcp_image),
+            f"/data/{recon_file_name}",
+            str(gestational_age),
+            "-data-dir",
+            "/data",
+            "-t",
+            str(threads),
+            "-c",
+            "0",
+            *shlex.split(flag),
+        ]
 
     elif "singularity" in pre_command:
         # Do we need FSL for this pipeline? add in the precommand
-        cmd = pre_command + dhcp_image
-        cmd += (
-            f"/usr/local/src/structural-pipeline/fetal-pipeline.sh "
-            f"{T2} "
-            f"{gestational_age} "
-            f"-data-dir "
-            f"{output_dir} "
-            f"-t {threads} "
-            "-c 0 "
-            f"{flag} "
-        )
+        cmd = shlex.split(
+            pre_command
+            + dhcp_image
+            + "/usr/local/src/structural-pipeline/fetal-pipeline.sh"
+        ) + [
+            T2,
+            str(gestational_age),
+            "-data-dir",
+            output_dir,
+            "-t",
+            str(threads),
+            "-c",
+            "0",
+            *shlex.split(flag),
+        ]
 
     else:
         raise ValueError(
             "pre_command must either contain docker or singularity."
         )
 
-    print(cmd)
-    os.system(cmd)
+    run_and_tee(cmd)
 
     # assert if the output files exist
     assert os.path.exists(
@@ -1,6 +1,8 @@
+import json
 import numpy as np
 import nibabel as ni
 import os
+import shutil
 from nipype.interfaces.base import (
     traits,
     TraitedSpec,
@@ -9,11 +11,370 @@ from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
 )
 from fetpype.nodes.utils import get_run_id
+from fetpype.utils.utils_nifti import (
+    load_nifti,
+    save_nifti,
+    with_nifti_format,
+)
 import logging
 
 log = logging.getLogger("nipype.workflow")
 
 
+def get_rectangular_masked_region(mask: np.ndarray) -> tuple:
+    """
+    Computes the bounding box around the given mask.
+    Code inspired by Michael Ebner:
+    https://github.com/gift-surg/NiftyMIC/blob/master/niftymic/base/stack.py
+
+    Args:
+        mask (np.ndarray): Input mask.
+
+    Returns:
+        tuple: A tuple containing the bounding box ranges for x, y, and z,
+               (None, None, None) if the mask is empty.
+
+    """
+    if np.sum(abs(mask)) == 0:
+        return None, None, None
+    shape = mask.shape
+    # Define the dimensions along which to sum the data
+    sum_axis = [(1, 2), (0, 2), (0, 1)]
+    range_list = []
+
+    # Non-zero elements of numpy array along the the 3 dimensions
+    for i in range(3):
+        sum_mask = np.sum(mask, axis=sum_axis[i])
+        ran = np.nonzero(sum_mask)[0]
+
+        low = np.max([0, ran[0]])
+        high = np.min([shape[i], ran[-1] + 1])
+        range_list.append(np.array([low, high]).astype(int))
+
+    return range_list
+
+
+def crop_to_mask(image, mask, affine, spacing, boundary, unit="mm"):
+    """
+    Crops an image and its mask to the field of view given by the bounding
+    box around the mask.
+
+    Args:
+        image (np.ndarray): Image data.
+        mask (np.ndarray): Mask data.
+        affine (np.ndarray): Affine of the image.
+        spacing (tuple): Voxel size of the image.
+        boundary (tuple): Boundary to add to the bounding box in the i, j
+                          and k directions.
+        unit (str): The unit of `boundary`, "mm" or voxels.
+
+    Returns:
+        tuple: The cropped image and mask, as Nifti images, or None if the
+               mask is empty.
+
+    Notes:
+        Code inspired by Michael Ebner:
+        https://github.com/gift-surg/NiftyMIC/blob/master/niftymic/base/stack.py
+    """
+    assert all([i >= m] for i, m in zip(image.shape, mask.shape)), (
+        "For a correct cropping, the image should be larger "
+        "or equal to the mask."
+    )
+
+    # Get rectangular region surrounding the masked voxels
+    ranges = get_rectangular_masked_region(mask)
+    if ranges[0] is None:
+        return None
+
+    boundary = list(boundary)
+    if unit == "mm":
+        boundary = [np.round(b / float(z)) for b, z in zip(boundary, spacing)]
+
+    shape = [min(im, m) for im, m in zip(image.shape, mask.shape)]
+    for dim, rng in enumerate(ranges):
+        rng[0] = np.max([0, rng[0] - boundary[dim]])
+        rng[1] = np.min([shape[dim], rng[1] + boundary[dim]])
+
+    new_affine = np.array(affine)
+    new_affine[:, -1] = list(
+        ni.affines.apply_affine(affine, [rng[0] for rng in ranges])
+    ) + [1]
+
+    window = tuple(slice(rng[0], rng[1]) for rng in ranges)
+    return (
+        ni.Nifti1Image(image[window], new_affine),
+        ni.Nifti1Image(mask[window], new_affine),
+    )
+
+
+def refine_mask(mask, spacing, dilation=0.0):
+    """
+    Refine a brain mask before cropping: keep its largest 3D connected
+    component, which removes the stray false positive voxels, fill its
+    holes slice by slice and optionally dilate it.
+
+    Args:
+        mask (np.ndarray): Mask data.
+        spacing (tuple): Voxel size of the mask.
+        dilation (float): Radius of the dilation, in mm. The mask is not
+                          dilated along the axes whose voxel size is
+                          larger than the radius.
+
+    Returns:
+        np.ndarray: The refined mask, with the data type of `mask`.
+    """
+    from scipy import ndimage
+
+    binary = np.asarray(mask) > 0
+    labels, n_labels = ndimage.label(binary)
+    if n_labels > 1:
+        sizes = np.bincount(labels.ravel())[1:]
+        binary = labels == np.argmax(sizes) + 1
+
+    # In-plane connectivity only, so that holes are filled slice by slice
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[:, :, 1] = ndimage.generate_binary_structure(2, 1)
+    binary = ndimage.binary_fill_holes(binary, structure=structure)
+
+    if dilation > 0:
+        radii = [int(dilation // float(z)) for z in spacing[:3]]
+        grid = np.ogrid[tuple(slice(-r, r + 1) for r in radii)]
+        ball = sum(
+            (g / max(r, 1)) ** 2 for g, r in zip(grid, radii)
+        ) <= 1
+        binary = ndimage.binary_dilation(binary, structure=ball)
+    return binary.astype(np.asarray(mask).dtype)
+
+
+def log_mask_refinement(name, mask, refined):
+    """Log the change of the mask and bounding box sizes by refinement."""
+
+    def _box(m):
+        ranges = get_rectangular_masked_region(m)
+        if ranges[0] is None:
+            return 0
+        return int(np.prod([high - low for low, high in ranges]))
+
+    log.info(
+        f"Refined mask {name}: {int(np.count_nonzero(mask))} -> "
+        f"{int(np.count_nonzero(refined))} voxels, bounding box of "
+        f"{_box(mask)} -> {_box(refined)} voxels"
+    )
+
+
+def _slice_statistics(image, mask):
+    """
+    Statistics of the slices of a stack along its through-plane (last)
+    axis, computed on the masked region.
+
+    Returns:
+        tuple: The number of masked voxels and the mean masked intensity of
+               each slice, and the normalized cross-correlation (NCC) of
+               each pair of adjacent slices, on the voxels masked in both,
+               with their number of voxels.
+    """
+    n_slices = image.shape[2]
+    x = np.asarray(image, dtype=np.float32).reshape(-1, n_slices)
+    m = np.asarray(mask).reshape(-1, n_slices) > 0
+    counts = m.sum(axis=0)
+    means = np.divide(
+        (x * m).sum(axis=0),
+        counts,
+        out=np.zeros(n_slices),
+        where=counts > 0,
+    )
+    joint = m[:, :-1] & m[:, 1:]
+    n = joint.sum(axis=0)
+    safe_n = np.maximum(n, 1)
+    a, b = x[:, :-1], x[:, 1:]
+    da = (a - (a * joint).sum(axis=0) / safe_n) * joint
+    db = (b - (b * joint).sum(axis=0) / safe_n) * joint
+    denom = np.sqrt((da**2).sum(axis=0) * (db**2).sum(axis=0))
+    ncc = np.divide(
+        (da * db).sum(axis=0),
+        denom,
+        out=np.zeros_like(denom),
+        where=denom > 0,
+    )
+    return counts, means, ncc, n
+
+
+def stack_quality(image, mask, spacing, dropout_ratio=0.5):
+    """
+    Quality metrics of a stack, computed on its masked region, slice by
+    slice along the through-plane (last) axis.
+
+    Args:
+        image (np.ndarray): Stack data.
+        mask (np.ndarray): Brain mask of the stack.
+        spacing (tuple): Voxel size of the stack.
+        dropout_ratio (float): A slice is a dropout if its mean masked
+                               intensity is below this ratio of the median
+                               over the slices.
+
+    Returns:
+        dict: "slice_correlation", the mean correlation between the
+              masked intensities of adjacent slices (low with motion),
+              "dropout", the fraction of slices with a signal dropout, and
+              "mask_volume", the volume of the mask in mm^3.
+    """
+    counts, means, ncc, n = _slice_statistics(image, mask)
+    volume = float(
+        counts.sum() * np.prod(np.asarray(spacing[:3], dtype=float))
+    )
+    if counts.max() == 0:
+        return {"slice_correlation": 0.0, "dropout": 1.0, "mask_volume": 0.0}
+
+    # Slices with a small masked region (at the edges of the brain) are
+    # dominated by partial volume
+    valid = counts >= 0.25 * counts.max()
+    means = means[valid]
+    dropout = float(np.mean(means < dropout_ratio * np.median(means)))
+    pairs = n >= max(10, 0.25 * n.max(initial=0))
+    correlation = 0.0
+    if pairs.any():
+        correlation = float(np.average(ncc[pairs], weights=n[pairs]))
+    return {
+        "slice_correlation": correlation,
+        "dropout": dropout,
+        "mask_volume": volume,
+    }
+
+
+def detect_outlier_slices(image, mask, zscore=3.5, intensity_ratio=0.5):
+    """
+    Detect the slices of a stack corrupted by motion or by a signal
+    dropout. A pair of adjacent slices is broken if its NCC is more than
+    `zscore` robust standard deviations (from the median absolute
+    deviation) below the median over the pairs, and a slice is a motion
+    outlier if its pairs with both neighbours are broken. A slice is a
+    dropout if its mean masked intensity is below `intensity_ratio` times
+    the median. Slices and pairs with a small masked region are never
+    outliers.
+
+    Args:
+        image (np.ndarray): Stack data.
+        mask (np.ndarray): Brain mask of the stack.
+        zscore (float): Robust z-score of the NCC below which a pair of
+                        slices is broken.
+        intensity_ratio (float): Ratio of the median intensity below
+                                 which a slice is an outlier.
+
+    Returns:
+        tuple: Boolean array, True for the outlier slices, and the report
+               of the slices: {"outliers": [indices], "slices": [{"index",
+               "masked_voxels", "mean_intensity", "ncc_prev", "ncc_next",
+               "outlier", "reasons"}]}.
+    """
+    counts, means, ncc, n = _slice_statistics(image, mask)
+    n_slices = len(counts)
+    outliers = np.zeros(n_slices, dtype=bool)
+    reasons = [[] for _ in range(n_slices)]
+    # As in `stack_quality`, slices and pairs with a small masked region
+    # are dominated by partial volume
+    valid = counts >= max(1, 0.25 * counts.max())
+    pair_ok = n >= max(10, 0.25 * n.max(initial=0))
+    ncc = np.where(pair_ok, ncc, np.nan)
+    ncc_prev = np.concatenate([[np.nan], ncc])
+    ncc_next = np.concatenate([ncc, [np.nan]])
+
+    if valid.any():
+        dropout = valid & (means < intensity_ratio * np.median(means[valid]))
+        motion = np.zeros(n_slices, dtype=bool)
+        if pair_ok.any():
+            median = np.median(ncc[pair_ok])
+            mad = np.median(np.abs(ncc[pair_ok] - median))
+            # NCC differences of a few hundredths are within the noise of
+            # a clean stack, e.g. towards the edges of the brain
+            sigma = max(1.4826 * mad, 0.05)
+            broken = pair_ok & (ncc < median - zscore * sigma)
+
+            # Both pairs are required, as a single broken pair does not
+            # tell which of its slices is corrupted, and the NCC drops
+            # towards the edges of the brain
+            prev_broken = np.concatenate([[False], broken])
+            next_broken = np.concatenate([broken, [False]])
+            motion = valid & prev_broken & next_broken
+        outliers = motion | dropout
+        for k in np.flatnonzero(motion):
+            reasons[k].append("ncc")
+        for k in np.flatnonzero(dropout):
+            reasons[k].append("intensity")
+
+    def _value(v):
+        return None if np.isnan(v) else round(float(v), 4)
+
+    report = {
+        "outliers": [int(k) for k in np.flatnonzero(outliers)],
+        "slices": [
+            {
+                "index": k,
+                "masked_voxels": int(counts[k]),
+                "mean_intensity": round(float(means[k]), 4),
+                "ncc_prev": _value(ncc_prev[k]),
+                "ncc_next": _value(ncc_next[k]),
+                "outlier": bool(outliers[k]),
+                "reasons": reasons[k],
+            }
+            for k in range(n_slices)
+        ],
+    }
+    return outliers, report
+
+
+def slice_report_path(stack):
+    """Path of the slice report written next to a preprocessed stack."""
+    base = os.path.basename(stack).split(".nii")[0]
+    return os.path.join(os.path.dirname(stack), f"{base}_slices.json")
+
+
+def select_stacks(qualities, min_score=None, max_stacks=None):
+    """
+    Score the stacks of a subject from their `stack_quality` and select
+    the ones to reconstruct. The score, between 0 and 1, is the product of
+    the inter-slice correlation, of the fraction of slices without dropout
+    and of the consistency of the mask volume with the median over the
+    stacks (smallest over largest volume).
+
+    Args:
+        qualities (list[dict]): `stack_quality` of each stack.
+        min_score (float, optional): Minimal score of the kept stacks.
+        max_stacks (int, optional): Maximal number of kept stacks, the
+                                    best scoring ones.
+
+    Returns:
+        tuple: The indices of the kept stacks, in their input order, and
+               the score of each stack.
+    """
+    volumes = [q["mask_volume"] for q in qualities]
+    ref = float(np.median(volumes)) if volumes else 0.0
+    scores = []
+    for q, volume in zip(qualities, volumes):
+        high = max(volume, ref)
+        consistency = min(volume, ref) / high if high > 0 else 0.0
+        scores.append(
+            max(q["slice_correlation"], 0.0)
+            * (1 - q["dropout"])
+            * consistency
+        )
+    ranked = sorted(range(len(scores)), key=lambda i: -scores[i])
+    if min_score is not None:
+        ranked = [i for i in ranked if scores[i] >= min_score]
+    if max_stacks is not None:
+        ranked = ranked[:max_stacks]
+    return sorted(ranked), scores
+
+
+def log_selection(stacks, kept, scores):
+    """Log the quality score of the stacks and the ones discarded."""
+    for i, (stack, score) in enumerate(zip(stacks, scores)):
+        status = "kept" if i in kept else "discarded"
+        log.info(
+            f"Quality score of {os.path.basename(stack)}: {score:.3f} "
+            f"({status})"
+        )
+
+
 class CropStacksAndMasksInputSpec(BaseInterfaceInputSpec):
     """Class used to represent the inputs of the
     CropStacksAndMasks interface.
@@ -33,6 +394,33 @@ class CropStacksAndMasksInputSpec(BaseInterfaceInputSpec):
         usedefault=True,
         mandatory=False,
     )
+    refine_mask = traits.Bool(
+        False,
+        desc="Whether to refine the mask before cropping (see refine_mask).",
+        usedefault=True,
+    )
+    mask_dilation = traits.Float(
+        0.0,
+        desc="Radius (in mm) of the dilation of the refined mask.",
+        usedefault=True,
+    )
+    output_format = traits.Enum(
+        "nii.gz",
+        "nii",
+        desc="Format of the output files.",
+        usedefault=True,
+    )
+    compresslevel = traits.Either(
+        None,
+        traits.Range(low=1, high=9),
+        desc="gzip level of the .nii.gz outputs (nibabel's default if None).",
+        usedefault=True,
+    )
+    num_threads = traits.Int(
+        1,
+        desc="Number of threads used to (de)compress .nii.gz files.",
+        usedefault=True,
+    )
 
 
 class CropStacksAndMasksOutputSpec(TraitedSpec):
@@ -58,6 +446,16 @@ class CropStacksAndMasks(BaseInterface):
         boundary (input; int):  Padding (in mm) to be set around
                                 the cropped image and mask.
         is_enabled (input; bool): Whether cropping and masking are enabled.
+        refine_mask (input; bool): Whether to refine the mask before
+                                   cropping (see `refine_mask`).
+        mask_dilation (input; float): Radius (in mm) of the dilation of the
+                                      refined mask.
+        output_format (input; str): Format of the outputs, "nii.gz" or
+                                    "nii".
+        compresslevel (input; int): gzip level of the .nii.gz outputs.
+        num_threads (input; int): Number of threads used to (de)compress
+                                  .nii.gz files, set from the node's
+                                  `n_procs`.
         output_image (output; str): Path to the cropped image.
         output_mask (output; str): Path to the cropped mask.
 
@@ -78,10 +476,15 @@ class CropStacksAndMasks(BaseInterface):
 
     def _gen_filename(self, name):
         if name == "output_image":
-            return os.path.abspath(os.path.basename(self.inputs.image))
+            path = os.path.basename(self.inputs.image)
         elif name == "output_mask":
-            return os.path.abspath(os.path.basename(self.inputs.mask))
-        return None
+            path = os.path.basename(self.inputs.mask)
+        else:
+            return None
+        if self.inputs.is_enabled:
+            # When disabled, the inputs are copied as they are
+            path = with_nifti_format(path, self.inputs.output_format)
+        return os.path.abspath(path)
 
     def _crop_stack_and_mask(
         self,
@@ -118,103 +521,42 @@ class CropStacksAndMasks(BaseInterface):
         """
 
         log.info(f"Working on {image_path} and {mask_path}")
-        image_ni = ni.load(image_path)
-        mask_ni = ni.load(mask_path)
+        threads = self.inputs.num_threads
+        image_ni = load_nifti(image_path, threads)
+        mask_ni = load_nifti(mask_path, threads)
 
-        image = image_ni.get_fdata()
         mask = mask_ni.get_fdata()
-
-        assert all([i >= m] for i, m in zip(image.shape, mask.shape)), (
-            "For a correct cropping, the image should be larger "
-            "or equal to the mask."
+        if self.inputs.refine_mask:
+            refined = refine_mask(
+                mask, image_ni.header.get_zooms(), self.inputs.mask_dilation
+            )
+            log_mask_refinement(os.path.basename(mask_path), mask, refined)
+            mask = refined
+
+        cropped = crop_to_mask(
+            image_ni.get_fdata(),
+            mask,
+            image_ni.affine,
+            image_ni.header.get_zooms(),
+            (boundary_i, boundary_j, boundary_k),
+            unit,
         )
-
-        # Get rectangular region surrounding the masked voxels
-        [x_range, y_range, z_range] = self._get_rectangular_masked_region(mask)
-
-        if np.array([x_range, y_range, z_range]).all() is None:
+        if cropped is None:
             log.warning(
                 "Cropping to bounding box of mask led to an empty image."
             )
             return None
 
-        if unit == "mm":
-            spacing = image_ni.header.get_zooms()
-            boundary_i = np.round(boundary_i / float(spacing[0]))
-            boundary_j = np.round(boundary_j / float(spacing[1]))
-            boundary_k = np.round(boundary_k / float(spacing[2]))
-
-        shape = [min(im, m) for im, m in zip(image.shape, mask.shape)]
-        x_range[0] = np.max([0, x_range[0] - boundary_i])
-        x_range[1] = np.min([shape[0], x_range[1] + boundary_i])
-
-        y_range[0] = np.max([0, y_range[0] - boundary_j])
-        y_range[1] = np.min([shape[1], y_range[1] + boundary_j])
-
-        z_range[0] = np.max([0, z_range[0] - boundary_k])
-        z_range[1] = np.min([shape[2], z_range[1] + boundary_k])
-
-        new_origin = list(
-            ni.affines.apply_affine(
-                image_ni.affine, [x_range[0], y_range[0], z_range[0]]
-            )
-        ) + [1]
-
-        new_affine = image_ni.affine
-        new_affine[:, -1] = new_origin
-
-        image_cropped = image[
-            x_range[0] : x_range[1],  # noqa: E203
-            y_range[0] : y_range[1],  # noqa: E203
-            z_range[0] : z_range[1],  # noqa: E203
-        ]
-        mask_cropped = mask[
-            x_range[0] : x_range[1],  # noqa: E203
-            y_range[0] : y_range[1],  # noqa: E203
-            z_range[0] : z_range[1],  # noqa: E203
-        ]
-
-        image_cropped = ni.Nifti1Image(image_cropped, new_affine)
-        mask_cropped = ni.Nifti1Image(mask_cropped, new_affine)
-        ni.save(image_cropped, self._gen_filename("output_image"))
-        ni.save(mask_cropped, self._gen_filename("output_mask"))
+        level = self.inputs.compresslevel
+        for img, name in zip(cropped, ["output_image", "output_mask"]):
+            save_nifti(img, self._gen_filename(name), level, threads)
 
     def _get_rectangular_masked_region(
         self,
         mask: np.ndarray,
     ) -> tuple:
-        """
-        Computes the bounding box around the given mask.
-        Code inspired by Michael Ebner:
-        https://github.com/gift-surg/NiftyMIC/blob/master/niftymic/base/stack.py
-
-        Args:
-            mask (np.ndarray): Input mask.
-            range_x (tuple): Pair defining x interval of mask in voxel space.
-            range_y (tuple): Pair defining y interval of mask in voxel space.
-            range_z (tuple): Pair defining z interval of mask in voxel space.
-
-        Returns:
-            tuple: A tuple containing the bounding box ranges for x, y, and z.
-
-        """
-        if np.sum(abs(mask)) == 0:
-            return None, None, None
-        shape = mask.shape
-        # Define the dimensions along which to sum the data
-        sum_axis = [(1, 2), (0, 2), (0, 1)]
-        range_list = []
-
-        # Non-zero elements of numpy array along the the 3 dimensions
-        for i in range(3):
-            sum_mask = np.sum(mask, axis=sum_axis[i])
-            ran = np.nonzero(sum_mask)[0]
-
-            low = np.max([0, ran[0]])
-            high = np.min([shape[0], ran[-1] + 1])
-            range_list.append(np.array([low, high]).astype(int))
-
-        return range_list
+        """See `get_rectangular_masked_region`."""
+        return get_rectangular_masked_region(mask)
 
     def _run_interface(self, runtime):
         if self.inputs.is_enabled:
@@ -227,13 +569,11 @@ class CropStacksAndMasks(BaseInterface):
                 boundary_k=boundary,
             )
         else:
-            os.system(
-                f"cp {self.inputs.image} "
-                f"{self._gen_filename('output_image')}"
+            shutil.copyfile(
+                self.inputs.image, self._gen_filename("output_image")
             )
-            os.system(
-                f"cp {self.inputs.mask} "
-                f"{self._gen_filename('output_mask')}"
+            shutil.copyfile(
+                self.inputs.mask, self._gen_filename("output_mask")
             )
 
     def _list_outputs(self):
@@ -243,12 +583,38 @@ class CropStacksAndMasks(BaseInterface):
         return outputs
 
 
-def copy_header(in_file, ref_file):
-    import nibabel as ni
+def copy_header(
+    in_file,
+    ref_file,
+    output_format=None,
+    compresslevel=None,
+    num_threads=1,
+):
+    """
+    Flip the first axis of `in_file` and give it the header of `ref_file`.
+
+    Args:
+        in_file (str): Image to modify.
+        ref_file (str): Image whose header is copied.
+        output_format (str, optional): Format of the output, "nii.gz" or
+                                       "nii". Defaults to the format of
+                                       `in_file`.
+        compresslevel (int, optional): gzip level of a .nii.gz output.
+        num_threads (int): Number of threads used to (de)compress .nii.gz
+                           files.
+    Returns:
+        str: Path to the new image, named after `in_file` with `_flipped`.
+    """
+    from fetpype.utils.utils_nifti import (
+        load_nifti,
+        save_nifti,
+        split_nifti_ext,
+        with_nifti_format,
+    )
 
     # Load the data
-    in_ni = ni.load(in_file)
-    ref_ni = ni.load(ref_file)
+    in_ni = load_nifti(in_file, num_threads)
+    ref_ni = load_nifti(ref_file, num_threads)
 
     data = in_ni.get_fdata()
 
@@ -260,9 +626,12 @@ def copy_header(in_file, ref_file):
 
     # save new file, which has the same name, but adding _flipped to the end
     # before the extension
-    in_file_new = in_file.replace(".nii.gz", "_flipped.nii.gz")
+    stem, ext = split_nifti_ext(in_file)
+    in_file_new = f"{stem}_flipped{ext}"
+    if output_format is not None:
+        in_file_new = with_nifti_format(in_file_new, output_format)
 
-    ni.save(new_img, in_file_new)
+    save_nifti(new_img, in_file_new, compresslevel, num_threads)
     return in_file_new
 
 
@@ -287,6 +656,23 @@ class CheckAffineResStacksAndMasksInputSpec(BaseInterfaceInputSpec):
         usedefault=True,
         mandatory=False,
     )
+    output_format = traits.Enum(
+        "nii.gz",
+        "nii",
+        desc="Format of the output files.",
+        usedefault=True,
+    )
+    compresslevel = traits.Either(
+        None,
+        traits.Range(low=1, high=9),
+        desc="gzip level of the .nii.gz outputs (nibabel's default if None).",
+        usedefault=True,
+    )
+    num_threads = traits.Int(
+        1,
+        desc="Number of threads used to (de)compress .nii.gz files.",
+        usedefault=True,
+    )
 
 
 class CheckAffineResStacksAndMasksOutputSpec(TraitedSpec):
@@ -314,6 +700,12 @@ class CheckAffineResStacksAndMasks(BaseInterface):
         stacks (input; list): List of input stacks.
         masks (input; list): List of input masks.
         is_enabled (input; bool): Whether the check is enabled.
+        output_format (input; str): Format of the outputs, "nii.gz" or
+                                    "nii".
+        compresslevel (input; int): gzip level of the .nii.gz outputs.
+        num_threads (input; int): Number of threads used to (de)compress
+                                  .nii.gz files, set from the node's
+                                  `n_procs`.
         output_stacks (output; list): List of stacks that passed the check.
         output_masks (output; list): List of masks that passed the check.
 
@@ -371,14 +763,20 @@ class CheckAffineResStacksAndMasks(BaseInterface):
         ):
             skip_stack = False
             out_stack = os.path.join(
-                self._gen_filename("output_dir"), os.path.basename(imp)
+                self._gen_filename("output_dir"),
+                with_nifti_format(
+                    os.path.basename(imp), self.inputs.output_format
+                ),
             )
             out_mask = os.path.join(
                 self._gen_filename("output_dir"),
-                os.path.basename(maskp),
+                with_nifti_format(
+                    os.path.basename(maskp), self.inputs.output_format
+                ),
             )
-            image_ni = ni.load(self.inputs.stacks[i])
-            mask_ni = ni.load(self.inputs.masks[i])
+            threads = self.inputs.num_threads
+            image_ni = load_nifti(self.inputs.stacks[i], threads)
+            mask_ni = load_nifti(self.inputs.masks[i], threads)
             image = self._squeeze_dim(image_ni.get_fdata(), -1)
             mask = self._squeeze_dim(mask_ni.get_fdata(), -1)
             image_ni = ni.Nifti1Image(image, image_ni.affine, image_ni.header)
@@ -411,8 +809,9 @@ class CheckAffineResStacksAndMasks(BaseInterface):
                     )
 
             if not skip_stack:
-                ni.save(image_ni, out_stack)
-                ni.save(mask_ni, out_mask)
+                level = self.inputs.compresslevel
+                save_nifti(image_ni, out_stack, level, threads)
+                save_nifti(mask_ni, out_mask, level, threads)
                 stacks_out.append(str(out_stack))
                 masks_out.append(str(out_mask))
         self._results["output_stacks"] = stacks_out
@@ -521,8 +920,8 @@ class CheckAndSortStacksAndMasks(BaseInterface):
                     f"no corresponding mask (existing IDs: {masks_run})."
                 )
 
-            os.system(f"cp {in_stack} " f"{out_stack}")
-            os.system(f"cp {in_mask} " f"{out_mask}")
+            shutil.copyfile(in_stack, out_stack)
+            shutil.copyfile(in_mask, out_mask)
         self._results["output_stacks"] = out_stacks
         self._results["output_masks"] = out_masks
         return runtime
@@ -545,6 +944,622 @@ class CheckAndSortStacksAndMasks(BaseInterface):
         return outputs
 
 
+class PreprocessStacksAndMasksInputSpec(BaseInterfaceInputSpec):
+    """Class used to represent the inputs of the
+    PreprocessStacksAndMasks interface.
+    """
+
+    stacks = traits.List(
+        traits.File(exists=True),
+        desc="List of input stacks",
+        mandatory=True,
+    )
+    masks = traits.List(
+        traits.File(exists=True),
+        desc="List of input masks",
+        mandatory=True,
+    )
+    sort_masks = traits.Bool(
+        False,
+        desc="Pair the stacks and masks by run ID instead of by position.",
+        usedefault=True,
+    )
+    check_enabled = traits.Bool(
+        True,
+        desc="Whether the resolution/affine/shape check is enabled.",
+        usedefault=True,
+    )
+    crop_enabled = traits.Bool(
+        True,
+        desc="Whether cropping is enabled.",
+        usedefault=True,
+    )
+    refine_mask = traits.Bool(
+        False,
+        desc="Whether to refine the mask before cropping (see refine_mask).",
+        usedefault=True,
+    )
+    mask_dilation = traits.Float(
+        0.0,
+        desc="Radius (in mm) of the dilation of the refined mask.",
+        usedefault=True,
+    )
+    boundary = traits.Int(
+        15,
+        desc="Padding (in mm) to be set around the cropped image and mask",
+        usedefault=True,
+    )
+    output_format = traits.Enum(
+        "nii.gz",
+        "nii",
+        desc="Format of the output files.",
+        usedefault=True,
+    )
+    compresslevel = traits.Either(
+        None,
+        traits.Range(low=1, high=9),
+        desc="gzip level of the .nii.gz outputs (nibabel's default if None).",
+        usedefault=True,
+    )
+    num_threads = traits.Int(
+        1,
+        desc="Number of threads, shared by the stacks processed in parallel "
+        "and the (de)compression of their .nii.gz files.",
+        usedefault=True,
+    )
+    min_score = traits.Either(
+        None,
+        traits.Float,
+        desc="Minimal quality score of the kept stacks (see select_stacks).",
+        usedefault=True,
+    )
+    max_stacks = traits.Either(
+        None,
+        traits.Int,
+        desc="Maximal number of kept stacks, the best scoring ones.",
+        usedefault=True,
+    )
+    outlier_zscore = traits.Either(
+        None,
+        traits.Float,
+        desc="Robust z-score of the NCC of the outlier slices, excluded "
+        "from the masks (see detect_outlier_slices). Disabled if None.",
+        usedefault=True,
+    )
+    outlier_intensity_ratio = traits.Float(
+        0.5,
+        desc="Ratio of the median intensity below which a slice is an "
+        "outlier.",
+        usedefault=True,
+    )
+
+
+class PreprocessStacksAndMasksOutputSpec(TraitedSpec):
+    """Class used to represent the outputs of the
+    PreprocessStacksAndMasks interface."""
+
+    output_stacks = traits.List(
+        desc="List of preprocessed stacks",
+    )
+    output_masks = traits.List(
+        desc="List of masks of the preprocessed stacks",
+    )
+    output_slice_reports = traits.List(
+        desc="Slice report of each preprocessed stack, if the detection "
+        "of outlier slices is enabled",
+    )
+
+
+class PreprocessStacksAndMasks(CheckAffineResStacksAndMasks):
+    """
+    Interface pairing, checking and cropping the stacks and masks of a
+    subject in a single pass, equivalent to `CheckAndSortStacksAndMasks`,
+    `CheckAffineResStacksAndMasks` and `CropStacksAndMasks` run one after
+    the other. Each stack and mask is read and written once, and the
+    stacks are processed on a pool of `num_threads` threads.
+
+    Args:
+
+        stacks (input; list): List of input stacks.
+        masks (input; list): List of input masks.
+        sort_masks (input; bool): Pair the stacks and masks by run ID.
+        check_enabled (input; bool): Whether the check is enabled.
+        crop_enabled (input; bool): Whether cropping is enabled.
+        refine_mask (input; bool): Whether to refine the masks before
+                                   cropping (see `refine_mask`).
+        mask_dilation (input; float): Radius (in mm) of the dilation of the
+                                      refined masks.
+        boundary (input; int):  Padding (in mm) to be set around
+                                the cropped image and mask.
+        output_format (input; str): Format of the outputs, "nii.gz" or
+                                    "nii".
+        compresslevel (input; int): gzip level of the .nii.gz outputs.
+        num_threads (input; int): Number of threads, set from the node's
+                                  `n_procs`.
+        min_score (input; float): If set, the stacks with a lower quality
+                                  score are discarded (see `select_stacks`).
+        max_stacks (input; int): If set, only the best scoring stacks are
+                                 kept.
+        outlier_zscore (input; float): If set, the outlier slices of each
+                                       stack are excluded from its mask
+                                       (see `detect_outlier_slices`).
+        outlier_intensity_ratio (input; float): Intensity ratio of the
+                                                outlier slices.
+        output_stacks (output; list): List of stacks that passed the check.
+        output_masks (output; list): List of masks that passed the check.
+        output_slice_reports (output; list): Slice report (JSON) of each
+                                             stack, if `outlier_zscore` is
+                                             set.
+
+    Examples:
+        >>> from fetpype.nodes.preprocessing import PreprocessStacksAndMasks
+        >>> prepro = PreprocessStacksAndMasks()
+        >>> prepro.inputs.stacks = ['sub-01_acq-haste_run-1_T2w.nii.gz']
+        >>> prepro.inputs.masks = ['sub-01_acq-haste_run-1_mask.nii.gz']
+        >>> prepro.run() # doctest: +SKIP
+    """
+
+    input_spec = PreprocessStacksAndMasksInputSpec
+    output_spec = PreprocessStacksAndMasksOutputSpec
+
+    def _pairs(self):
+        stacks = self.inputs.stacks
+        masks = self.inputs.masks
+        if self.inputs.sort_masks:
+            masks = pair_stacks_and_masks(stacks, masks)[1]
+        return list(zip(stacks, masks))
+
+    def process(self, imp, maskp, threads=1, quality=False):
+        """
+        Preprocess one stack and its mask, writing the outputs in the
+        current directory.
+
+        Args:
+            imp (str): Stack.
+            maskp (str): Mask of the stack.
+            threads (int): Number of threads used to (de)compress .nii.gz
+                           files.
+            quality (bool): Whether to also return the `stack_quality` of
+                            the output stack.
+        Returns:
+            list: The output stack and mask (and quality), None if they
+                  were discarded.
+        """
+        image_ni = load_nifti(imp, threads)
+        mask_ni = load_nifti(maskp, threads)
+        image = self._squeeze_dim(image_ni.get_fdata(), -1)
+        mask = self._squeeze_dim(mask_ni.get_fdata(), -1)
+        image_ni = ni.Nifti1Image(image, image_ni.affine, image_ni.header)
+        mask_ni = ni.Nifti1Image(mask, mask_ni.affine, mask_ni.header)
+
+        if self.inputs.check_enabled:
+            im_res = image_ni.header["pixdim"][1:4]
+            self.check_inplane_pos(imp, im_res)
+            if not self.compare_resolution_affine(
+                im_res,
+                image_ni.affine,
+                mask_ni.header["pixdim"][1:4],
+                mask_ni.affine,
+                image_ni.shape,
+                mask_ni.shape,
+            ):
+                log.warning(
+                    f"Resolution/shape/affine mismatch -- Skipping the "
+                    f"stack {os.path.basename(imp)} and mask "
+                    f"{os.path.basename(maskp)}"
+                )
+                return None
+            if mask.sum() == 0:
+                log.warning(
+                    f"Mask {os.path.basename(maskp)} is empty -- Skipping "
+                    f"the stack {os.path.basename(imp)} and mask "
+                    f"{os.path.basename(maskp)}"
+                )
+                return None
+
+        if self.inputs.refine_mask:
+            refined = refine_mask(
+                mask, image_ni.header.get_zooms(), self.inputs.mask_dilation
+            )
+            log_mask_refinement(os.path.basename(maskp), mask, refined)
+            mask = refined
+            mask_ni = ni.Nifti1Image(mask, mask_ni.affine, mask_ni.header)
+
+        if self.inputs.crop_enabled:
+            boundary = (self.inputs.boundary,) * 3
+            cropped = crop_to_mask(
+                image,
+                mask,
+                image_ni.affine,
+                image_ni.header.get_zooms(),
+                boundary,
+            )
+            if cropped is None:
+                log.warning(
+                    f"Mask {os.path.basename(maskp)} is empty -- Skipping "
+                    f"the stack {os.path.basename(imp)}"
+                )
+                return None
+            image_ni, mask_ni = cropped
+
+        metrics, report = None, None
+        image = np.asanyarray(image_ni.dataobj)
+        mask = np.asanyarray(mask_ni.dataobj)
+        if quality:
+            metrics = stack_quality(image, mask, image_ni.header.get_zooms())
+        if self.inputs.outlier_zscore is not None:
+            outliers, report = detect_outlier_slices(
+                image,
+                mask,
+                self.inputs.outlier_zscore,
+                self.inputs.outlier_intensity_ratio,
+            )
+            if outliers.any():
+                log.info(
+                    f"Excluding slices {report['outliers']} of the stack "
+                    f"{os.path.basename(imp)} from its mask"
+                )
+                mask = mask.copy()
+                mask[..., outliers] = 0
+                mask_ni = ni.Nifti1Image(mask, mask_ni.affine, mask_ni.header)
+
+        outputs = []
+        for img, path in [(image_ni, imp), (mask_ni, maskp)]:
+            out = os.path.abspath(
+                with_nifti_format(
+                    os.path.basename(path), self.inputs.output_format
+                )
+            )
+            save_nifti(img, out, self.inputs.compresslevel, threads)
+            outputs.append(out)
+        if report is not None:
+            with open(slice_report_path(outputs[0]), "w") as f:
+                json.dump(report, f, indent=4)
+        if quality:
+            outputs.append(metrics)
+        return outputs
+
+    def _run_interface(self, runtime):
+        from concurrent.futures import ThreadPoolExecutor
+
+        pairs = self._pairs()
+        selection = {
+            "min_score": self.inputs.min_score,
+            "max_stacks": self.inputs.max_stacks,
+        }
+        quality = any(v is not None for v in selection.values())
+        workers = max(1, min(self.inputs.num_threads, len(pairs)))
+        threads = max(1, self.inputs.num_threads // workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(
+                pool.map(
+                    lambda pair: self.process(*pair, threads, quality), pairs
+                )
+            )
+        results = [r for r in results if r is not None]
+        if quality and results:
+            kept, scores = select_stacks(
+                [r[2] for r in results], **selection
+            )
+            log_selection([r[0] for r in results], kept, scores)
+            results = [results[i][:2] for i in kept]
+        self._results = {
+            "output_stacks": [stack for stack, _ in results],
+            "output_masks": [mask for _, mask in results],
+            "output_slice_reports": [],
+        }
+        if self.inputs.outlier_zscore is not None:
+            self._results["output_slice_reports"] = [
+                slice_report_path(stack) for stack, _ in results
+            ]
+        if len(results) == 0:
+            raise ValueError(
+                "All stacks and masks were "
+                "discarded during the preprocessing."
+            )
+        return runtime
+
+    def _list_outputs(self):
+        outputs = super()._list_outputs()
+        outputs["output_slice_reports"] = self._results.get(
+            "output_slice_reports", []
+        )
+        return outputs
+
+
+def pair_stacks_and_masks(stacks, masks):
+    """
+    Order the masks as their stacks, matching them by run ID.
+
+    Args:
+        stacks (list): Input stacks.
+        masks (list): Input masks.
+    Returns:
+        tuple: The stacks and the mask of each of them.
+    """
+    import os
+    from fetpype.nodes.utils import get_run_id
+
+    masks_run = get_run_id(masks)
+    paired = []
+    for stack, run in zip(stacks, get_run_id(stacks)):
+        if run not in masks_run:
+            raise RuntimeError(
+                f"Stack {os.path.basename(stack)} has no corresponding "
+                f"mask (existing IDs: {masks_run})."
+            )
+        paired.append(masks[masks_run.index(run)])
+    return stacks, paired
+
+
+def run_stack_preprocessing(
+    input_stack,
+    input_mask=None,
+    brain_extraction_cmd=None,
+    denoising_cmd=None,
+    bias_correction_cmd=None,
+    check_enabled=True,
+    crop_enabled=True,
+    refine_mask=False,
+    mask_dilation=0.0,
+    denoising_enabled=True,
+    bias_correction_enabled=True,
+    boundary=15,
+    outlier_zscore=None,
+    outlier_intensity_ratio=0.5,
+    quality=False,
+    output_format="nii.gz",
+    compresslevel=None,
+    num_threads=1,
+    singularity_path=None,
+    singularity_mount=None,
+):
+    """
+    Run all the preprocessing steps on a single stack: brain extraction
+    (if `input_mask` is not given), check of the stack and mask,
+    cropping, denoising and bias field correction. Used as a MapNode
+    over the stacks, so that each stack goes through the steps
+    independently of the others.
+
+    Args:
+        input_stack (str): Input stack.
+        input_mask (str, optional): Mask of the stack.
+        brain_extraction_cmd (CommandTemplate): Brain extraction command,
+                                                used without `input_mask`.
+        denoising_cmd (CommandTemplate): Denoising command.
+        bias_correction_cmd (CommandTemplate): Bias correction command.
+        check_enabled (bool): Whether the check is enabled.
+        crop_enabled (bool): Whether cropping is enabled.
+        refine_mask (bool): Whether to refine the mask before cropping.
+        mask_dilation (float): Radius (in mm) of the dilation of the
+                               refined mask.
+        denoising_enabled (bool): Whether denoising is enabled.
+        bias_correction_enabled (bool): Whether bias correction is enabled.
+        boundary (int): Padding (in mm) around the cropped stack.
+        outlier_zscore (float, optional): If set, the outlier slices are
+                                          excluded from the mask (see
+                                          `detect_outlier_slices`).
+        outlier_intensity_ratio (float): Intensity ratio of the outlier
+                                         slices.
+        quality (bool): Whether to also return the `stack_quality` of the
+                        cropped stack, as computed by
+                        `PreprocessStacksAndMasks` for the selection.
+        output_format (str): Format of the intermediate files.
+        compresslevel (int, optional): gzip level of the .nii.gz files.
+        num_threads (int): Number of threads used to (de)compress .nii.gz
+                           files.
+        singularity_path (str, optional): Path to the Singularity executable.
+        singularity_mount (str, optional): Mount point for Singularity.
+    Returns:
+        tuple: The preprocessed stack and mask, the slice report of the
+               stack (None if the outlier slices are not detected) and its
+               quality (None unless `quality`), all None if the stack was
+               discarded by the check.
+    """
+    import os
+    from fetpype.nodes.preprocessing import (
+        PreprocessStacksAndMasks,
+        run_prepro_cmd,
+        slice_report_path,
+    )
+
+    cwd = os.getcwd()
+    container_args = {
+        "singularity_path": singularity_path,
+        "singularity_mount": singularity_mount,
+    }
+
+    def step(name, func, *args, **kwargs):
+        # Each step writes in its own directory
+        os.makedirs(os.path.join(cwd, name), exist_ok=True)
+        os.chdir(os.path.join(cwd, name))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            os.chdir(cwd)
+
+    if input_mask is None:
+        input_mask = step(
+            "brain_extraction",
+            run_prepro_cmd,
+            input_stack,
+            brain_extraction_cmd,
+            **container_args,
+        )
+        if isinstance(input_mask, list):
+            input_mask = input_mask[0]
+    prepro = PreprocessStacksAndMasks(
+        check_enabled=check_enabled,
+        crop_enabled=crop_enabled,
+        refine_mask=refine_mask,
+        mask_dilation=mask_dilation,
+        boundary=boundary,
+        outlier_zscore=outlier_zscore,
+        outlier_intensity_ratio=outlier_intensity_ratio,
+        output_format=output_format,
+        compresslevel=compresslevel,
+    )
+    outputs = step(
+        "check_and_crop",
+        prepro.process,
+        input_stack,
+        input_mask,
+        num_threads,
+        quality,
+    )
+    if outputs is None:
+        return None, None, None, None
+    stack, mask = outputs[:2]
+    metrics = outputs[2] if quality else None
+    slice_report = None
+    if outlier_zscore is not None:
+        slice_report = slice_report_path(stack)
+    stack = step(
+        "denoising",
+        run_prepro_cmd,
+        stack,
+        denoising_cmd,
+        is_enabled=denoising_enabled,
+        **container_args,
+    )
+    stack = step(
+        "bias_correction",
+        run_prepro_cmd,
+        stack,
+        bias_correction_cmd,
+        is_enabled=bias_correction_enabled,
+        input_masks=mask,
+        **container_args,
+    )
+    return stack, mask, slice_report, metrics
+
+
+def drop_discarded_stacks(
+    stacks,
+    masks,
+    slice_reports=None,
+    qualities=None,
+    min_score=None,
+    max_stacks=None,
+):
+    """
+    Remove the stacks discarded by `run_stack_preprocessing`, and select
+    the remaining ones by quality if `min_score` or `max_stacks` is set
+    (see `select_stacks`).
+
+    Args:
+        stacks (list): Preprocessed stacks, None for the discarded ones.
+        masks (list): Masks of the stacks.
+        slice_reports (list, optional): Slice reports of the stacks, None
+                                        if the outlier slices are not
+                                        detected.
+        qualities (list, optional): `stack_quality` of the stacks, from
+                                    `run_stack_preprocessing` with
+                                    `quality`. Required for the selection.
+        min_score (float, optional): Minimal quality score of the kept
+                                     stacks.
+        max_stacks (int, optional): Maximal number of kept stacks.
+    Returns:
+        tuple: The stacks, masks and slice reports that were kept.
+    """
+    from fetpype.nodes.preprocessing import log_selection, select_stacks
+
+    if slice_reports is None:
+        slice_reports = [None] * len(stacks)
+    if qualities is None:
+        qualities = [None] * len(stacks)
+    kept = [
+        (s, m, r, q)
+        for s, m, r, q in zip(stacks, masks, slice_reports, qualities)
+        if s is not None
+    ]
+    if kept and (min_score is not None or max_stacks is not None):
+        if any(q is None for _, _, _, q in kept):
+            raise ValueError(
+                "The quality of the stacks is required to select them."
+            )
+        selected, scores = select_stacks(
+            [q for _, _, _, q in kept], min_score, max_stacks
+        )
+        log_selection([s for s, _, _, _ in kept], selected, scores)
+        kept = [kept[i] for i in selected]
+    if not kept:
+        raise ValueError(
+            "All stacks and masks were discarded during the preprocessing."
+        )
+    return (
+        [s for s, _, _, _ in kept],
+        [m for _, m, _, _ in kept],
+        [r for _, _, r, _ in kept if r is not None],
+    )
+
+
+def render_stacks_cmd(
+    cmd,
+    input_stacks,
+    input_masks=None,
+    output_dir=None,
+    singularity_path=None,
+    singularity_mount=None,
+):
+    """
+    Render a command processing a list of stacks (and masks), as used by
+    the pre- and post-processing steps. The output files are placed in
+    `output_dir` and keep the name of their inputs.
+
+    Args:
+        cmd (CommandTemplate): Command to render.
+        input_stacks (list): Input stacks to process.
+        input_masks (list, optional): Input masks to process.
+        output_dir (str): Directory where the outputs are written.
+        singularity_path (str, optional): Path to the Singularity executable.
+        singularity_mount (str, optional): Mount point for Singularity.
+    Returns:
+        tuple: The arguments of the command, the output stacks and the
+               output masks (None when the command does not produce them).
+    """
+    import os
+    from fetpype.nodes import get_directory, get_mount_args
+
+    output_stacks = None
+    output_masks = None
+    if "output_stacks" in cmd:
+        output_stacks = [
+            os.path.join(output_dir, os.path.basename(stack))
+            for stack in input_stacks
+        ]
+    if "output_masks" in cmd:
+        if input_masks:
+            output_masks = [
+                os.path.join(output_dir, os.path.basename(mask))
+                for mask in input_masks
+            ]
+        else:
+            output_masks = [
+                os.path.join(output_dir, os.path.basename(stack)).replace(
+                    "_T2w", "_mask"
+                )
+                for stack in input_stacks
+            ]
+
+    values = {
+        "input_stacks": input_stacks,
+        "input_masks": input_masks or [],
+        "output_stacks": output_stacks,
+        "output_masks": output_masks,
+        "singularity_path": singularity_path,
+        "singularity_mount": singularity_mount,
+    }
+    if "mount" in cmd:
+        in_masks_dir = None
+        if input_masks is not None:
+            in_masks_dir = get_directory(input_masks)
+        values["mount"] = get_mount_args(
+            get_directory(input_stacks), in_masks_dir, output_dir
+        )
+    return cmd.render_argv(**values), output_stacks, output_masks
+
+
 def run_prepro_cmd(
     input_stacks,
     cmd,
@@ -558,7 +1573,8 @@ def run_prepro_cmd(
 
     Args:
         input_stacks (str or list): Input stacks to process.
-        cmd (str): Command to run, with tags for input and output.
+        cmd (str or CommandTemplate): Command to run, with tags for
+                                      input and output.
         is_enabled (bool): Whether the command should be executed.
         input_masks (str or list, optional): Input masks to process.
         singularity_path (str, optional): Path to the Singularity executable.
@@ -571,6 +1587,8 @@ def run_prepro_cmd(
     """
     import os
     from fetpype import VALID_PREPRO_TAGS
+    from fetpype.nodes import as_template
+    from fetpype.nodes.preprocessing import render_stacks_cmd
     from fetpype.utils.logging import run_and_tee
 
     # Important for mapnodes
@@ -584,10 +1602,8 @@ def run_prepro_cmd(
         input_masks = [input_masks]
         unlist_masks = True
 
-    from fetpype.nodes import is_valid_cmd, get_directory, get_mount_docker
-
-    is_valid_cmd(cmd, VALID_PREPRO_TAGS)
-    if "<output_stacks>" not in cmd and "<output_masks>" not in cmd:
+    cmd = as_template(cmd, VALID_PREPRO_TAGS)
+    if "output_stacks" not in cmd and "output_masks" not in cmd:
         raise RuntimeError(
             "No output stacks or masks specified in the command. "
             "Please specify <output_stacks> and/or <output_masks>."
@@ -595,67 +1611,19 @@ def run_prepro_cmd(
 
     if is_enabled:
         output_dir = os.path.join(os.getcwd(), "output")
-        in_stacks_dir = get_directory(input_stacks)
-        in_stacks = " ".join(input_stacks)
-
-        in_masks = ""
-        in_masks_dir = None
-        if input_masks is not None:
-            in_masks_dir = get_directory(input_masks)
-            in_masks = " ".join(input_masks)
-
-        output_stacks = None
-        output_masks = None
-
-        # In cmd, there will be things contained in <>.
-        # Check that everything that is in <> is in valid_tags
-        # If not, raise an error
-
-        # Replace the tags in the command
-        cmd = cmd.replace("<input_stacks>", in_stacks)
-        cmd = cmd.replace("<input_masks>", in_masks)
-        if "<output_stacks>" in cmd:
-            output_stacks = [
-                os.path.join(output_dir, os.path.basename(stack))
-                for stack in input_stacks
-            ]
-            cmd = cmd.replace("<output_stacks>", " ".join(output_stacks))
-        if "<output_masks>" in cmd:
-            if input_masks:
-                output_masks = [
-                    os.path.join(output_dir, os.path.basename(mask))
-                    for mask in input_masks
-                ]
-            else:
-                output_masks = [
-                    os.path.join(output_dir, os.path.basename(stack)).replace(
-                        "_T2w", "_mask"
-                    )
-                    for stack in input_stacks
-                ]
-            cmd = cmd.replace("<output_masks>", " ".join(output_masks))
-
-        if "<mount>" in cmd:
-            mount_cmd = get_mount_docker(
-                in_stacks_dir, in_masks_dir, output_dir
-            )
-            cmd = cmd.replace("<mount>", mount_cmd)
-        if "<singularity_path>" in cmd:
-            # assume that if we have a singularity path,
-            # we are using singularity and the
-            # parameter has been set in the config file
-            cmd = cmd.replace("<singularity_path>", singularity_path)
-        if "<singularity_mount>" in cmd:
-            # assume that if we have a singularity mount path,
-            # we are using singularity and the
-            # parameter has been set in the config file
-            cmd = cmd.replace("<singularity_mount>", singularity_mount)
-
-        run_and_tee(cmd)
+        argv, output_stacks, output_masks = render_stacks_cmd(
+            cmd,
+            input_stacks,
+            input_masks,
+            output_dir,
+            singularity_path=singularity_path,
+            singularity_mount=singularity_mount,
+        )
+        run_and_tee(argv)
 
     else:
-        output_stacks = input_stacks if "<output_stacks>" in cmd else None
-        output_masks = input_masks if "<output_masks>" in cmd else None
+        output_stacks = input_stacks if "output_stacks" in cmd else None
+        output_masks = input_masks if "output_masks" in cmd else None
 
     if output_stacks is not None and unlist_stacks:
         assert (
@@ -1,7 +1,77 @@
+def crop_srr_to_brain(input_srr, output, margin):
+    """
+    Crop a SRR volume to the bounding box of its non-zero (brain) voxels
+    plus a margin.
+
+    Args:
+        input_srr (str): Path to the SRR volume.
+        output (str): Path of the cropped volume.
+        margin (float): Margin around the bounding box, in mm.
+    Returns:
+        tuple: The window of the cropped volume in the SRR, as a tuple of
+               slices, and the shape of the SRR.
+    """
+    import nibabel as nib
+    import numpy as np
+    from fetpype.nodes.preprocessing import get_rectangular_masked_region
+
+    img = nib.load(input_srr)
+    data = np.asanyarray(img.dataobj)
+    ranges = get_rectangular_masked_region(data > 0)
+    if ranges[0] is None:
+        # Empty volume, left for the segmentation method to handle
+        ranges = [[0, n] for n in data.shape[:3]]
+    window = []
+    zooms = img.header.get_zooms()
+    for (low, high), n, zoom in zip(ranges, data.shape, zooms):
+        pad = int(np.ceil(margin / float(zoom)))
+        window.append(slice(max(0, low - pad), min(n, high + pad)))
+    window = tuple(window)
+    affine = img.affine.copy()
+    affine[:3, 3] = nib.affines.apply_affine(
+        img.affine, [w.start for w in window]
+    )
+    nib.save(nib.Nifti1Image(data[window], affine, img.header), output)
+    return window, data.shape
+
+
+def embed_segmentation(seg, cropped_srr, window, shape, affine, output):
+    """
+    Re-embed the segmentation of a cropped SRR into the grid of the
+    original SRR, the voxels outside the window being background.
+
+    Args:
+        seg (str): Segmentation of the cropped SRR.
+        cropped_srr (str): Cropped SRR, from `crop_srr_to_brain`.
+        window (tuple): Window of the cropped SRR in the original one.
+        shape (tuple): Shape of the original SRR.
+        affine (np.ndarray): Affine of the original SRR.
+        output (str): Path of the re-embedded segmentation.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    seg_img = nib.load(seg)
+    cropped = nib.load(cropped_srr)
+    if seg_img.shape[:3] != cropped.shape[:3] or not np.allclose(
+        seg_img.affine, cropped.affine, atol=1e-3
+    ):
+        raise ValueError(
+            f"The segmentation {seg} is not in the grid of its input SRR, "
+            "and cannot be re-embedded into the original grid. Disable "
+            "the cropping of the SRR (segmentation.crop_margin: null)."
+        )
+    labels = np.asanyarray(seg_img.dataobj)
+    full = np.zeros(tuple(shape[:3]) + labels.shape[3:], dtype=labels.dtype)
+    full[window] = labels
+    nib.save(nib.Nifti1Image(full, affine, seg_img.header), output)
+
+
 def run_seg_cmd(
     input_srr,
     cmd,
-    cfg,
+    path_to_output=None,
+    crop_margin=None,
     singularity_path=None,
     singularity_mount=None,
     singularity_home=None,
@@ -12,8 +82,16 @@ def run_seg_cmd(
     Args:
         input_srr (str or list): Path to the input SRR file or a list
                                 containing a single SRR file.
-        cmd (str): Command to run, with placeholders for input and output.
-        cfg (object): Configuration object containing output directory.
+        cmd (str or CommandTemplate): Command to run, with placeholders
+                                      for input and output.
+        path_to_output (str, optional): Path of the output segmentation in
+                                        `<output_dir>`, where `<basename>`
+                                        is the name of the input SRR.
+        crop_margin (float, optional): If set, the SRR is cropped to the
+                                       bounding box of the brain plus this
+                                       margin (in mm) before the
+                                       segmentation, which is then
+                                       re-embedded into the original grid.
         singularity_path (str, optional): Path to the Singularity executable.
         singularity_mount (str, optional): Mount point for Singularity.
     Returns:
@@ -21,11 +99,12 @@ def run_seg_cmd(
 
     """
     import os
+    import shutil
     from fetpype import VALID_SEG_TAGS as VALID_TAGS
-    from fetpype.nodes import is_valid_cmd, get_mount_docker
+    from fetpype.nodes import as_template, get_mount_args
     from fetpype.utils.logging import run_and_tee
 
-    is_valid_cmd(cmd, VALID_TAGS)
+    cmd = as_template(cmd, VALID_TAGS)
 
     # Check if input_srr is a directory or a file
     if isinstance(input_srr, list):
@@ -40,30 +119,43 @@ def run_seg_cmd(
     # Avoid mounting problematic directories
     input_srr_dir = os.path.join(os.getcwd(), "seg/input")
     os.makedirs(input_srr_dir, exist_ok=True)
-    os.system(f"cp {input_srr} {input_srr_dir}/input_srr.nii.gz")
-    input_srr = os.path.join(input_srr_dir, "input_srr.nii.gz")
+    staged_srr = os.path.join(input_srr_dir, "input_srr.nii.gz")
+    if crop_margin is not None:
+        import nibabel as nib
+        from fetpype.nodes.segmentation import (
+            crop_srr_to_brain,
+            embed_segmentation,
+        )
+
+        srr_affine = nib.load(input_srr).affine
+        window, srr_shape = crop_srr_to_brain(
+            input_srr, staged_srr, crop_margin
+        )
+    else:
+        shutil.copyfile(input_srr, staged_srr)
+    input_srr = staged_srr
 
     output_dir = os.path.join(os.getcwd(), "seg/out")
     os.makedirs(output_dir, exist_ok=True)
     seg = os.path.join(output_dir, "seg.nii.gz")
 
-    # In cmd, there will be things contained in <>.
-    # Check that everything that is in <> is in valid_tags
-    # If not, raise an error
-
-    # Replace the tags in the command
-    cmd = cmd.replace("<input_srr>", input_srr)
-    cmd = cmd.replace("<input_dir>", input_srr_dir)
-    cmd = cmd.replace("<output_seg>", seg)
-    if "<output_dir>" in cmd:
-        cmd = cmd.replace("<output_dir>", output_dir)
+    values = {
+        "input_volume": input_srr,
+        "input_dir": input_srr_dir,
+        "output_dir": output_dir,
+        "output_seg": seg,
+        "singularity_path": singularity_path,
+        "singularity_mount": singularity_mount,
+        "singularity_home": singularity_home,
+    }
+    if "output_dir" in cmd:
         # Assert that args.path_to_output is defined
-        assert cfg.path_to_output is not None, (
+        assert path_to_output is not None, (
             "<output_dir> found in the command of reconstruction, "
             " but path_to_output is not defined."
         )
 
-        seg = os.path.join(output_dir, cfg.path_to_output)
+        seg = os.path.join(output_dir, path_to_output)
         if "<basename>" in seg:
             # Remove all extensions from the basename
             # (handles .nii.gz correctly)
@@ -71,26 +163,17 @@ def run_seg_cmd(
             # Remove all extensions (handles both .nii.gz and .nii cases)
             basename_no_ext = basename.split(".")[0]
             seg = seg.replace("<basename>", basename_no_ext)
-    if "<mount>" in cmd:
-        mount_cmd = get_mount_docker(input_srr_dir, output_dir)
-        cmd = cmd.replace("<mount>", mount_cmd)
-    if "<singularity_path>" in cmd:
-        # assume that if we have a singularity path,
-        # we are using singularity and the
-        # parameter has been set in the config file
-        cmd = cmd.replace("<singularity_path>", singularity_path)
-    if "<singularity_mount>" in cmd:
-        # assume that if we have a singularity mount path,
-        # we are using singularity and the
-        # parameter has been set in the config file
-        cmd = cmd.replace("<singularity_mount>", singularity_mount)
-
-    if "<singularity_home>" in cmd:
-        # assume that if we have a singularity mount path,
-        # we are using singularity and the
-        # parameter has been set in the config file
-        cmd = cmd.replace("<singularity_home>", singularity_home)
-
-    run_and_tee(cmd)
+    if "mount" in cmd:
+        values["mount"] = get_mount_args(input_srr_dir, output_dir)
 
+    run_and_tee(cmd.render_argv(**values))
+
+    if crop_margin is not None:
+        full_dir = os.path.join(os.getcwd(), "seg/full")
+        os.makedirs(full_dir, exist_ok=True)
+        full_seg = os.path.join(full_dir, os.path.basename(seg))
+        embed_segmentation(
+            seg, input_srr, window, srr_shape, srr_affine, full_seg
+        )
+        seg = full_seg
     return seg
@@ -1,7 +1,57 @@
+def hemisphere_mask(input_seg, labels, output, margin=2):
+    """
+    Binary mask of the labels of a hemisphere, built with a single lookup
+    table pass over the segmentation, cropped to its bounding box plus a
+    margin and stored as uint8, with the affine of the cropped grid so
+    that the meshes stay in scanner space.
+
+    Args:
+        input_seg (str): Path to the multi-label segmentation.
+        labels (list[int]): Labels of the hemisphere.
+        output (str): Path of the mask.
+        margin (int): Background voxels kept around the bounding box.
+    Returns:
+        str: Path to the mask.
+    """
+    import nibabel as nib
+    import numpy as np
+    from fetpype.nodes.preprocessing import get_rectangular_masked_region
+
+    img = nib.load(input_seg)
+    seg = np.asanyarray(img.dataobj)
+    if not np.issubdtype(seg.dtype, np.integer):
+        seg = np.rint(seg)
+    # Labels above those of the hemisphere map to the last, empty, entry
+    lut = np.zeros(max(labels) + 2, dtype=np.uint8)
+    lut[list(labels)] = 1
+    mask = lut[np.clip(seg, 0, len(lut) - 1).astype(np.intp)]
+
+    ranges = get_rectangular_masked_region(mask)
+    if ranges[0] is None:
+        raise ValueError(
+            f"No voxel with the labels {list(labels)} in {input_seg}."
+        )
+    window = tuple(
+        slice(max(0, low - margin), min(n, high + margin))
+        for (low, high), n in zip(ranges, mask.shape)
+    )
+    affine = img.affine.copy()
+    affine[:3, 3] = nib.affines.apply_affine(
+        img.affine, [w.start for w in window]
+    )
+    header = img.header.copy()
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1, 0)
+    nib.save(nib.Nifti1Image(mask[window], affine, header), output)
+    return output
+
+
 def run_surf_cmd(
     input_seg,
     cmd,
-    cfg,
+    out_file,
+    labelling_scheme,
+    crop_hemisphere=False,
     singularity_path=None,
     singularity_mount=None,
     singularity_home=None,
@@ -12,8 +62,14 @@ def run_surf_cmd(
     Args:
         input_seg (str or list): Path to the input segmentation file or a list
                                 containing a single segmentation file.
-        cmd (str): Command to run, with placeholders for input and output.
-        cfg (object): Configuration object containing output directory.
+        cmd (str or CommandTemplate): Command to run, with placeholders
+                                      for input and output.
+        out_file (str): Name of the output surface.
+        labelling_scheme (list[int]): Labels of the hemisphere.
+        crop_hemisphere (bool): Whether to give the command the cropped
+                                binary mask of the hemisphere (see
+                                `hemisphere_mask`), labelled 1, instead
+                                of the whole segmentation.
         singularity_path (str, optional): Path to the Singularity executable.
         singularity_mount (str, optional): Mount point for Singularity.
     Returns:
@@ -21,11 +77,12 @@ def run_surf_cmd(
 
     """
     import os
+    import shutil
     from fetpype import VALID_SURF_TAGS as VALID_TAGS
-    from fetpype.nodes import is_valid_cmd, get_mount_docker
+    from fetpype.nodes import as_template, get_mount_args
     from fetpype.utils.logging import run_and_tee
 
-    is_valid_cmd(cmd, VALID_TAGS)
+    cmd = as_template(cmd, VALID_TAGS)
 
     # Check if input_srr is a directory or a file
     if isinstance(input_seg, list):
@@ -40,56 +97,31 @@ def run_surf_cmd(
     # Avoid mounting problematic directories
     input_seg_dir = os.path.join(os.getcwd(), "seg/input")
     os.makedirs(input_seg_dir, exist_ok=True)
-    os.system(f"cp {input_seg} {input_seg_dir}/input_seg.nii.gz")
-    input_seg = os.path.join(input_seg_dir, "input_seg.nii.gz")
+    staged_seg = os.path.join(input_seg_dir, "input_seg.nii.gz")
+    if crop_hemisphere:
+        from fetpype.nodes.surface_extraction import hemisphere_mask
+
+        hemisphere_mask(input_seg, labelling_scheme, staged_seg)
+        labelling_scheme = [1]
+    else:
+        shutil.copyfile(input_seg, staged_seg)
+    input_seg = staged_seg
 
     output_dir = os.path.join(os.getcwd(), "surf/out")
     os.makedirs(output_dir, exist_ok=True)
-    surf = os.path.join(output_dir, cfg.out_file)
-
-    # In cmd, there will be things contained in <>.
-    # Check that everything that is in <> is in valid_tags
-    # If not, raise an error
-
-    # Replace the tags in the command
-    cmd = cmd.replace("<input_seg>", input_seg)
-    # cmd = cmd.replace("<input_dir>", input_seg_dir)
-    cmd = cmd.replace("<output_surf>", surf)
-    assert cfg.use_scheme in cfg.labelling_scheme, (
-        f"Unknown labelling scheme: {cfg.use_scheme},"
-        f"please choose from {list(cfg.labelling_scheme.keys())}"
-    )
-    labelling_scheme = cfg.labelling_scheme[cfg.use_scheme]
-    labelling_scheme = ",".join(map(str, labelling_scheme))
-    cmd = cmd.replace("<labelling_scheme>", labelling_scheme)
-
-    # if "<output_dir>" in cmd:
-    #     cmd = cmd.replace("<output_dir>", output_dir)
-    #     # Assert that args.path_to_output is defined
-    #     assert cfg.path_to_output is not None, (
-    #         "<output_dir> found in the command of reconstruction, "
-    #         " but path_to_output is not defined."
-    #     )
-
-    # seg = os.path.join(output_dir, cfg.path_to_output)
-    # if "<basename>" in seg:
-    #     # Remove all extensions from the basename
-    #     # (handles .nii.gz correctly)
-    #     basename = os.path.basename(input_srr)
-    #     # Remove all extensions (handles both .nii.gz and .nii cases)
-    #     basename_no_ext = basename.split(".")[0]
-    #     seg = seg.replace("<basename>", basename_no_ext)
-    if "<mount>" in cmd:
-        mount_cmd = get_mount_docker(input_seg_dir, output_dir)
-        cmd = cmd.replace("<mount>", mount_cmd)
-    if "<singularity_path>" in cmd:
-        cmd = cmd.replace("<singularity_path>", singularity_path)
-    if "<singularity_mount>" in cmd:
-        cmd = cmd.replace("<singularity_mount>", singularity_mount)
+    surf = os.path.join(output_dir, out_file)
 
-    if "<singularity_home>" in cmd:
-        cmd = cmd.replace("<singularity_home>", singularity_home)
+    values = {
+        "input_seg": input_seg,
+        "output_surf": surf,
+        "labelling_scheme": ",".join(map(str, labelling_scheme)),
+        "singularity_path": singularity_path,
+        "singularity_mount": singularity_mount,
+        "singularity_home": singularity_home,
+    }
+    if "mount" in cmd:
+        values["mount"] = get_mount_args(input_seg_dir, output_dir)
 
-    run_and_tee(cmd)
+    run_and_tee(cmd.render_argv(**values))
 
     return surf
@@ -1,5 +1,6 @@
 import os
 import re
+import shlex
 
 
 def is_docker(pre_command):
@@ -23,18 +24,26 @@ def get_directory(entry):
         raise TypeError(f"Type {type(entry)} not supported")
 
 
-def get_mount_docker(*args):
+def get_mount_args(*args):
     """
-    Build the string for the folders to be mounted on the
-    docker image. The folders to be mounted are defined
-    in _mount_keys.
+    Build the list of arguments mounting the given folders on
+    the docker image. None entries are ignored.
     """
     mount_args = []
     for arg in args:
         if arg is not None:
             os.makedirs(arg, exist_ok=True)
-            mount_args.append(arg)
-    return " ".join([f"-v {arg}:{arg}" for arg in mount_args])
+            mount_args += ["-v", f"{arg}:{arg}"]
+    return mount_args
+
+
+def get_mount_docker(*args):
+    """
+    Build the string for the folders to be mounted on the
+    docker image. The folders to be mounted are defined
+    in _mount_keys.
+    """
+    return " ".join(get_mount_args(*args))
 
 
 def is_valid_cmd(cmd, valid_tags):
@@ -46,6 +55,165 @@ def is_valid_cmd(cmd, valid_tags):
         raise ValueError("Docker command must have a <mount> tag")
 
 
+class CommandTemplate:
+    """
+    A command from the config, with its `<tags>` parsed and validated
+    once, when the workflow is built. Nodes then render it in a single
+    pass, either as a string or as an argument list that can be run
+    without a shell.
+
+    Args:
+        cmd (str): Command with tags, e.g. `"run --input <input_stacks>"`.
+        valid_tags (list): Tags allowed in the command.
+
+    Examples:
+        >>> from fetpype.nodes.utils import CommandTemplate
+        >>> tpl = CommandTemplate("cp <input_stacks> <output_dir>/",
+        ...                       ["input_stacks", "output_dir"])
+        >>> tpl.render(input_stacks=["a.nii.gz", "b.nii.gz"], output_dir="o")
+        'cp a.nii.gz b.nii.gz o/'
+        >>> tpl.render_argv(input_stacks=["a.nii.gz", "b.nii.gz"],
+        ...                 output_dir="o")
+        ['cp', 'a.nii.gz', 'b.nii.gz', 'o/']
+    """
+
+    _tag_re = re.compile(r"\<(.*?)\>")
+
+    def __init__(self, cmd, valid_tags):
+        is_valid_cmd(cmd, valid_tags)
+        self.cmd = cmd
+        self.valid_tags = list(valid_tags)
+        self._segments = self._parse(cmd)
+        self._argv = [self._parse(token) for token in shlex.split(cmd)]
+        self.tags = {text for text, is_tag in self._segments if is_tag}
+
+    @classmethod
+    def _parse(cls, text):
+        """Split `text` into a list of (text, is_tag) segments."""
+        parts = cls._tag_re.split(text)
+        # re.split alternates literal text and captured tags
+        return [
+            (part, i % 2 == 1)
+            for i, part in enumerate(parts)
+            if part or i % 2 == 1
+        ]
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+    def __eq__(self, other):
+        return isinstance(other, CommandTemplate) and self.cmd == other.cmd
+
+    def __hash__(self):
+        return hash(self.cmd)
+
+    def __repr__(self):
+        # Used by nipype to hash the node inputs: it must be deterministic.
+        return f"CommandTemplate({self.cmd!r})"
+
+    def replace(self, old, new):
+        """Return a new template where `old` is replaced by `new`."""
+        return CommandTemplate(self.cmd.replace(old, new), self.valid_tags)
+
+    def _value(self, tag, values):
+        value = host_value(values.get(tag, None))
+        if value is None:
+            raise ValueError(f"No value given for tag <{tag}> in {self.cmd}")
+        return value
+
+    def _render_segments(self, segments, values):
+        out = []
+        for text, is_tag in segments:
+            if is_tag:
+                value = self._value(text, values)
+                if isinstance(value, (list, tuple)):
+                    value = " ".join(map(str, value))
+                text = str(value)
+            out.append(text)
+        return "".join(out)
+
+    def render(self, **values):
+        """
+        Render the command as a string, in a single pass. Lists are
+        joined with spaces.
+
+        Args:
+            **values: Value of each tag of the command.
+        Returns:
+            str: The command to run.
+        """
+        return self._render_segments(self._segments, values)
+
+    def render_argv(self, **values):
+        """
+        Render the command as an argument list. A tag that makes up a
+        whole argument and whose value is a list is expanded into several
+        arguments.
+
+        Args:
+            **values: Value of each tag of the command.
+        Returns:
+            list: The arguments of the command to run.
+        """
+        argv = []
+        for segments in self._argv:
+            if len(segments) == 1 and segments[0][1]:
+                value = self._value(segments[0][0], values)
+                if isinstance(value, (list, tuple)):
+                    argv.extend(map(str, value))
+                    continue
+            argv.append(self._render_segments(segments, values))
+        return argv
+
+
+class HostValue:
+    """
+    A setting specific to the host running the pipeline (e.g. the folder
+    of the singularity images), given to a node without being part of its
+    hash: moving the containers does not rerun the nodes. Only the
+    singularity settings are wrapped; the paths of the input data are
+    still part of the hash of the nodes reading them, so that moving the
+    data directory reruns the pipeline.
+
+    Args:
+        value: The setting.
+
+    Examples:
+        >>> from fetpype.nodes.utils import HostValue, host_value
+        >>> HostValue("/data/images")
+        HostValue()
+        >>> host_value(HostValue("/data/images"))
+        '/data/images'
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, HostValue) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        # Used by nipype to hash the node inputs: the value is left out.
+        return "HostValue()"
+
+
+def host_value(value):
+    """The setting wrapped in a HostValue, or `value` itself."""
+    if isinstance(value, HostValue):
+        return value.value
+    return value
+
+
+def as_template(cmd, valid_tags):
+    """Build a CommandTemplate from `cmd` unless it already is one."""
+    if isinstance(cmd, CommandTemplate):
+        return cmd
+    return CommandTemplate(cmd, valid_tags)
+
+
 def get_run_id(file_list):
     """
     Get the run ID from the file name.
@@ -1,10 +1,12 @@
 import nipype.interfaces.utility as niu
 import nipype.pipeline.engine as pe
 from ..nodes.preprocessing import (
-    CropStacksAndMasks,
-    CheckAffineResStacksAndMasks,
     CheckAndSortStacksAndMasks,
+    PreprocessStacksAndMasks,
+    drop_discarded_stacks,
+    pair_stacks_and_masks,
     run_prepro_cmd,
+    run_stack_preprocessing,
 )
 from ..nodes.dhcp import dhcp_pipeline
 from nipype import config
@@ -15,6 +17,62 @@ from fetpype.nodes.reconstruction import (
 )
 from fetpype.nodes.segmentation import run_seg_cmd
 from fetpype.nodes.surface_extraction import run_surf_cmd
+from fetpype.nodes.utils import CommandTemplate, HostValue
+from fetpype.utils.utils_nifti import (
+    ensure_nii_gz,
+    get_intermediate_format,
+    get_nifti_threads,
+)
+from fetpype.utils.utils_manifest import stage_digests
+from fetpype.definitions import (
+    VALID_PREPRO_TAGS,
+    VALID_RECON_TAGS,
+    VALID_SEG_TAGS,
+    VALID_SURF_TAGS,
+)
+
+STAGE_WORKFLOWS = {
+    "preprocessing": "Preprocessing",
+    "reconstruction": "Reconstruction",
+    "segmentation": "Segmentation",
+    "surface": "SurfaceExtraction",
+}
+
+
+def stage_workflow_name(cfg, stage):
+    """
+    Name of the workflow of a stage, suffixed with the digest of the
+    configuration of this stage and of the stages before it. Its working
+    directory is thus shared by all the pipelines running the stage with
+    the same configuration, e.g. the reconstructions of a pipeline are
+    reused when only the segmentation method changes.
+
+    Args:
+        cfg: Configuration object.
+        stage (str): Stage, one of the keys of `STAGE_WORKFLOWS`.
+    Returns:
+        str: Name of the workflow, e.g. "Reconstruction_1c00d270".
+    """
+    return f"{STAGE_WORKFLOWS[stage]}_{stage_digests(cfg, [stage])[stage][:8]}"
+
+
+def set_singularity_inputs(node, cfg, home=False):
+    """
+    Give the singularity settings of `cfg` to a node running a container,
+    if singularity is used. They are wrapped in a `HostValue` so that
+    they are not part of the hash of the node.
+
+    Args:
+        node (nipype.Node): Node with singularity inputs.
+        cfg: Configuration object.
+        home (bool): Whether the node also takes `singularity_home`.
+    """
+    if cfg.container != "singularity":
+        return
+    node.inputs.singularity_path = HostValue(cfg.singularity_path)
+    node.inputs.singularity_mount = HostValue(cfg.singularity_mount)
+    if home:
+        node.inputs.singularity_home = HostValue(cfg.singularity_home)
 
 
 def print_files(files):
@@ -28,12 +86,21 @@ def get_prepro(cfg, load_masks=False, enabled_cropping=False):
     Create the preprocessing workflow based on config `cfg`.
     Given an input of T2w stacks, this pipeline performs the following steps:
         1. Brain extraction using MONAIfbs
-        2. Check stacks and masks
-        3. Check affine and resolution of stacks and masks
-        4. Cropping stacks and masks
+        2-4. In a single node: pairing of the stacks and masks, check of
+             their affine and resolution, refinement of the masks (with
+             `preprocessing.mask_refinement` enabled), cropping and, if
+             `preprocessing.stack_selection` is enabled, selection of the
+             stacks by quality (see `select_stacks`). With
+             `preprocessing.slice_outliers` enabled, the outlier slices
+             of each stack are excluded from its mask (see
+             `detect_outlier_slices`)
         5. Denoising stacks
         6. Bias field correction of stacks
 
+    With `preprocessing.streaming` enabled in the config, steps 1 to 6 are
+    run by a single MapNode over the stacks (see `get_stack_prepro`), so
+    that each stack goes through them without waiting for the others.
+
     Args:
         cfg: Configuration object containing the parameters for the pipeline.
         load_masks: Boolean indicating whether to load masks or
@@ -49,10 +116,13 @@ def get_prepro(cfg, load_masks=False, enabled_cropping=False):
     """
     cfg_prepro = cfg.preprocessing
 
-    prepro_pipe = pe.Workflow(name="Preprocessing")
+    prepro_pipe = pe.Workflow(name=stage_workflow_name(cfg, "preprocessing"))
     # Creating input node
 
     enabled_check = cfg_prepro.check_stacks_and_masks.enabled
+    selection = get_stack_selection(cfg_prepro)
+    outliers = get_slice_outliers(cfg_prepro)
+    refinement = get_mask_refinement(cfg_prepro)
     enabled_cropping = cfg_prepro.cropping.enabled and enabled_cropping
     if cfg_prepro.cropping.enabled != enabled_cropping:
         print("Overriding cropping enabled status for the selected pipeline.")
@@ -68,16 +138,80 @@ def get_prepro(cfg, load_masks=False, enabled_cropping=False):
     input = pe.Node(niu.IdentityInterface(fields=in_fields), name="inputnode")
 
     output = pe.Node(
-        niu.IdentityInterface(fields=["stacks", "masks"]), name="outputnode"
+        niu.IdentityInterface(fields=["stacks", "masks", "slice_reports"]),
+        name="outputnode",
     )
-    # 1. Load masks or brain extraction
-    container = cfg.container
-    if load_masks:
-        check_input = pe.Node(
-            interface=CheckAndSortStacksAndMasks(), name="CheckInput"
+    check_output = pe.Node(
+        interface=CheckAndSortStacksAndMasks(),
+        name="CheckOutput",
+    )
+    if cfg_prepro.get("streaming", False):
+        stack_prepro = get_stack_prepro(
+            cfg,
+            load_masks,
+            enabled_check,
+            enabled_cropping,
+            enabled_denoising,
+            enabled_bias_corr,
+        )
+        stack_prepro.inputs.trait_set(**outliers, **refinement)
+        # The stacks are scored in the MapNode, on the cropped stacks as
+        # PreprocessStacksAndMasks does, and selected once all are done
+        stack_prepro.inputs.quality = any(
+            v is not None for v in selection.values()
+        )
+        drop_discarded = pe.Node(
+            interface=niu.Function(
+                input_names=[
+                    "stacks",
+                    "masks",
+                    "slice_reports",
+                    "qualities",
+                    "min_score",
+                    "max_stacks",
+                ],
+                output_names=["stacks", "masks", "slice_reports"],
+                function=drop_discarded_stacks,
+            ),
+            name="DropDiscarded",
         )
+        drop_discarded.inputs.trait_set(**selection)
+        if load_masks:
+            # Masks loaded from the inputs are matched by run ID
+            pair = pe.Node(
+                interface=niu.Function(
+                    input_names=["stacks", "masks"],
+                    output_names=["stacks", "masks"],
+                    function=pair_stacks_and_masks,
+                ),
+                name="PairStacksAndMasks",
+            )
+            prepro_pipe.connect(input, "stacks", pair, "stacks")
+            prepro_pipe.connect(input, "masks", pair, "masks")
+            prepro_pipe.connect(pair, "stacks", stack_prepro, "input_stack")
+            prepro_pipe.connect(pair, "masks", stack_prepro, "input_mask")
+        else:
+            prepro_pipe.connect(input, "stacks", stack_prepro, "input_stack")
+        prepro_pipe.connect(stack_prepro, "stack", drop_discarded, "stacks")
+        prepro_pipe.connect(stack_prepro, "mask", drop_discarded, "masks")
+        prepro_pipe.connect(
+            stack_prepro, "slice_report", drop_discarded, "slice_reports"
+        )
+        prepro_pipe.connect(
+            stack_prepro, "quality", drop_discarded, "qualities"
+        )
+        prepro_pipe.connect(drop_discarded, "stacks", check_output, "stacks")
+        prepro_pipe.connect(drop_discarded, "masks", check_output, "masks")
+        prepro_pipe.connect(check_output, "output_stacks", output, "stacks")
+        prepro_pipe.connect(check_output, "output_masks", output, "masks")
+        prepro_pipe.connect(
+            drop_discarded, "slice_reports", output, "slice_reports"
+        )
+        return prepro_pipe
 
-    else:
+    # 1. Load masks or brain extraction
+    container = cfg.container
+    if not load_masks:
         be_config = cfg_prepro.brain_extraction
         be_cfg_cont = be_config[container]
 
@@ -95,32 +229,28 @@ def get_prepro(cfg, load_masks=False, enabled_cropping=False):
             ),
             name="BrainExtraction",
         )
-        brain_extraction.inputs.cmd = be_cfg_cont.cmd
-        brain_extraction.inputs.cfg = be_config
-        # if the container is singularity, add
-        # singularity path to the brain_extraction
-        if cfg.container == "singularity":
-            brain_extraction.inputs.singularity_path = cfg.singularity_path
-            brain_extraction.inputs.singularity_mount = cfg.singularity_mount
-
-    # 2. Check stacks and masks
-    check_name = "CheckAffineAndRes"
-    check_name += "_disabled" if not enabled_check else ""
-
-    check_affine = pe.Node(
-        interface=CheckAffineResStacksAndMasks(), name=check_name
-    )
-    check_affine.inputs.is_enabled = enabled_check
-    # 3. Cropping
-    cropping_name = "Cropping"
-    cropping_name += "_disabled" if not enabled_cropping else ""
-    cropping = pe.MapNode(
-        interface=CropStacksAndMasks(),
-        iterfield=["image", "mask"],
-        name=cropping_name,
-    )
-
-    cropping.inputs.is_enabled = enabled_cropping
+        brain_extraction.inputs.cmd = CommandTemplate(
+            be_cfg_cont.cmd, VALID_PREPRO_TAGS
+        )
+        set_singularity_inputs(brain_extraction, cfg)
+
+    # 2-4. Pair, check and crop stacks and masks
+    prepro_name = "CheckAndCrop"
+    if not enabled_check:
+        prepro_name = "Crop" if enabled_cropping else "Sort"
+    elif not enabled_cropping:
+        prepro_name = "Check"
+    preprocess = pe.Node(
+        interface=PreprocessStacksAndMasks(), name=prepro_name
+    )
+    preprocess.inputs.sort_masks = load_masks
+    preprocess.inputs.check_enabled = enabled_check
+    preprocess.inputs.crop_enabled = enabled_cropping
+    preprocess.inputs.trait_set(**selection, **outliers, **refinement)
+    intermediate_format = get_intermediate_format(cfg)
+    nifti_threads = get_nifti_threads(cfg)
+    preprocess.inputs.trait_set(**intermediate_format)
+    preprocess.n_procs = nifti_threads
     # 4. Denoising
     denoising_name = "Denoising"
     denoising_name += "_disabled" if not enabled_denoising else ""
@@ -143,11 +273,10 @@ def get_prepro(cfg, load_masks=False, enabled_cropping=False):
 
     denoising_cfg = cfg_prepro.denoising
     denoising.inputs.is_enabled = enabled_denoising
-    denoising.inputs.cmd = denoising_cfg[container].cmd
-    # if the container is singularity, add singularity path to the denoising
-    if cfg.container == "singularity":
-        denoising.inputs.singularity_path = cfg.singularity_path
-        denoising.inputs.singularity_mount = cfg.singularity_mount
+    denoising.inputs.cmd = CommandTemplate(
+        denoising_cfg[container].cmd, VALID_PREPRO_TAGS
+    )
+    set_singularity_inputs(denoising, cfg)
 
     merge_denoise = pe.Node(
         interface=niu.Merge(1, ravel_inputs=True), name="MergeDenoise"
@@ -174,56 +303,177 @@ def get_prepro(cfg, load_masks=False, enabled_cropping=False):
     )
     bias_cfg = cfg_prepro.bias_correction
     bias_corr.inputs.is_enabled = enabled_bias_corr
-    bias_corr.inputs.cmd = bias_cfg[container].cmd
-
-    # if the container is singularity, add singularity path to the bias_corr
-    if cfg.container == "singularity":
-        bias_corr.inputs.singularity_path = cfg.singularity_path
-        bias_corr.inputs.singularity_mount = cfg.singularity_mount
-
-    # 6. Verify output
-    check_output = pe.Node(
-        interface=CheckAndSortStacksAndMasks(),
-        name="CheckOutput",
+    bias_corr.inputs.cmd = CommandTemplate(
+        bias_cfg[container].cmd, VALID_PREPRO_TAGS
     )
 
+    set_singularity_inputs(bias_corr, cfg)
+
     # Connect nodes
 
+    prepro_pipe.connect(input, "stacks", preprocess, "stacks")
     if load_masks:
-        prepro_pipe.connect(input, "stacks", check_input, "stacks")
-        prepro_pipe.connect(input, "masks", check_input, "masks")
-
-        prepro_pipe.connect(
-            check_input, "output_stacks", check_affine, "stacks"
-        )
-        prepro_pipe.connect(check_input, "output_masks", check_affine, "masks")
+        prepro_pipe.connect(input, "masks", preprocess, "masks")
 
     else:
         prepro_pipe.connect(input, "stacks", brain_extraction, "input_stacks")
-
-        prepro_pipe.connect(input, "stacks", check_affine, "stacks")
         prepro_pipe.connect(
-            brain_extraction, "output_masks", check_affine, "masks"
+            brain_extraction, "output_masks", preprocess, "masks"
         )
 
-    prepro_pipe.connect(check_affine, "output_stacks", cropping, "image")
-    prepro_pipe.connect(check_affine, "output_masks", cropping, "mask")
-
-    prepro_pipe.connect(cropping, "output_image", denoising, "input_stacks")
+    prepro_pipe.connect(
+        preprocess, "output_stacks", denoising, "input_stacks"
+    )
     prepro_pipe.connect(denoising, "output_stacks", merge_denoise, "in1")
 
     prepro_pipe.connect(merge_denoise, "out", bias_corr, "input_stacks")
-    prepro_pipe.connect(cropping, "output_mask", bias_corr, "input_masks")
+    prepro_pipe.connect(preprocess, "output_masks", bias_corr, "input_masks")
 
     prepro_pipe.connect(bias_corr, "output_stacks", check_output, "stacks")
-    prepro_pipe.connect(cropping, "output_mask", check_output, "masks")
+    prepro_pipe.connect(preprocess, "output_masks", check_output, "masks")
 
     prepro_pipe.connect(check_output, "output_stacks", output, "stacks")
     prepro_pipe.connect(check_output, "output_masks", output, "masks")
+    prepro_pipe.connect(
+        preprocess, "output_slice_reports", output, "slice_reports"
+    )
 
     return prepro_pipe
 
 
+def get_stack_selection(cfg_prepro):
+    """
+    Parameters of the selection of the stacks by quality, from the
+    `stack_selection` section of the preprocessing config.
+
+    Returns:
+        dict: `min_score` and `max_stacks`, both None if the selection is
+              disabled.
+    """
+    cfg_sel = cfg_prepro.get("stack_selection", None)
+    if cfg_sel is None or not cfg_sel.enabled:
+        return {"min_score": None, "max_stacks": None}
+    return {
+        "min_score": cfg_sel.get("min_score", None),
+        "max_stacks": cfg_sel.get("max_stacks", None),
+    }
+
+
+def get_slice_outliers(cfg_prepro):
+    """
+    Parameters of the detection of outlier slices, from the
+    `slice_outliers` section of the preprocessing config.
+
+    Returns:
+        dict: `outlier_zscore`, None if the detection is disabled, and
+              `outlier_intensity_ratio`.
+    """
+    cfg_out = cfg_prepro.get("slice_outliers", None)
+    if cfg_out is None or not cfg_out.enabled:
+        return {"outlier_zscore": None, "outlier_intensity_ratio": 0.5}
+    return {
+        "outlier_zscore": float(cfg_out.get("zscore", 3.5)),
+        "outlier_intensity_ratio": float(cfg_out.get("intensity_ratio", 0.5)),
+    }
+
+
+def get_mask_refinement(cfg_prepro):
+    """
+    Parameters of the refinement of the masks before cropping, from the
+    `mask_refinement` section of the preprocessing config.
+
+    Returns:
+        dict: `refine_mask` and `mask_dilation`.
+    """
+    cfg_ref = cfg_prepro.get("mask_refinement", None)
+    if cfg_ref is None or not cfg_ref.enabled:
+        return {"refine_mask": False, "mask_dilation": 0.0}
+    return {
+        "refine_mask": True,
+        "mask_dilation": float(cfg_ref.get("dilation", 0.0)),
+    }
+
+
+def get_stack_prepro(
+    cfg,
+    load_masks,
+    enabled_check,
+    enabled_cropping,
+    enabled_denoising,
+    enabled_bias_corr,
+):
+    """
+    MapNode running all the preprocessing steps on each stack, with
+    `run_stack_preprocessing`: each stack is brain extracted (unless
+    `load_masks`), checked, cropped, denoised and bias corrected as soon
+    as a process is free, and the only barrier is the end of the MapNode,
+    before the reconstruction.
+
+    Args:
+        cfg: Configuration object containing the parameters for the pipeline.
+        load_masks: Whether the masks are given as inputs.
+        enabled_check: Whether the check of the stacks and masks is enabled.
+        enabled_cropping: Whether cropping is enabled.
+        enabled_denoising: Whether denoising is enabled.
+        enabled_bias_corr: Whether bias field correction is enabled.
+    Returns:
+        nipype.MapNode: The node, with inputs `input_stack` (and
+                        `input_mask` if `load_masks`) and outputs `stack`,
+                        `mask`, `slice_report` and `quality`.
+    """
+    cfg_prepro = cfg.preprocessing
+    container = cfg.container
+    input_names = ["input_stack"]
+    if load_masks:
+        input_names += ["input_mask"]
+    stack_prepro = pe.MapNode(
+        interface=niu.Function(
+            input_names=input_names
+            + [
+                "brain_extraction_cmd",
+                "denoising_cmd",
+                "bias_correction_cmd",
+                "check_enabled",
+                "crop_enabled",
+                "refine_mask",
+                "mask_dilation",
+                "denoising_enabled",
+                "bias_correction_enabled",
+                "outlier_zscore",
+                "outlier_intensity_ratio",
+                "quality",
+                "output_format",
+                "compresslevel",
+                "num_threads",
+                "singularity_path",
+                "singularity_mount",
+            ],
+            output_names=["stack", "mask", "slice_report", "quality"],
+            function=run_stack_preprocessing,
+        ),
+        iterfield=list(input_names),
+        name="StackPreprocessing",
+    )
+    if not load_masks:
+        stack_prepro.inputs.brain_extraction_cmd = CommandTemplate(
+            cfg_prepro.brain_extraction[container].cmd, VALID_PREPRO_TAGS
+        )
+    stack_prepro.inputs.denoising_cmd = CommandTemplate(
+        cfg_prepro.denoising[container].cmd, VALID_PREPRO_TAGS
+    )
+    stack_prepro.inputs.bias_correction_cmd = CommandTemplate(
+        cfg_prepro.bias_correction[container].cmd, VALID_PREPRO_TAGS
+    )
+    stack_prepro.inputs.check_enabled = enabled_check
+    stack_prepro.inputs.crop_enabled = enabled_cropping
+    stack_prepro.inputs.denoising_enabled = enabled_denoising
+    stack_prepro.inputs.bias_correction_enabled = enabled_bias_corr
+    stack_prepro.inputs.trait_set(**get_intermediate_format(cfg))
+    stack_prepro.n_procs = get_nifti_threads(cfg)
+    set_singularity_inputs(stack_prepro, cfg)
+    return stack_prepro
+
+
 def get_recon(cfg):
     """
     Get the reconstruction workflow based on the pipeline specified
@@ -242,14 +492,15 @@ def get_recon(cfg):
     cfg_reco_base = cfg.reconstruction
     cfg_reco = cfg.reconstruction.reconstruction[container]
     cfg_postpro = cfg.reconstruction.postprocessing
-    rec_pipe = pe.Workflow(name="Reconstruction")
+    rec_pipe = pe.Workflow(name=stage_workflow_name(cfg, "reconstruction"))
     enabled_clamp = cfg_postpro.clamp_intensity.enabled
     enabled_ppbc = cfg_postpro.bias_correction.enabled
 
     # Creating input node
     # Define input and output
     inputnode = pe.Node(
-        niu.IdentityInterface(fields=["stacks", "masks"]), name="inputnode"
+        niu.IdentityInterface(fields=["stacks", "masks", "slice_reports"]),
+        name="inputnode",
     )
     outputnode = pe.Node(
         niu.IdentityInterface(fields=["output_stacks"]), name="outputnode"
@@ -261,8 +512,10 @@ def get_recon(cfg):
             input_names=[
                 "input_stacks",
                 "input_masks",
+                "input_slice_reports",
                 "cmd",
-                "cfg",
+                "path_to_output",
+                "output_resolution",
                 "singularity_path",
                 "singularity_mount",
             ],
@@ -272,12 +525,15 @@ def get_recon(cfg):
         name=cfg_reco_base.pipeline,
     )
 
-    recon.inputs.cmd = cfg_reco.cmd
-    recon.inputs.cfg = cfg_reco_base
-    # if the container is singularity, add singularity path to the recon node
-    if cfg.container == "singularity":
-        recon.inputs.singularity_path = cfg.singularity_path
-        recon.inputs.singularity_mount = cfg.singularity_mount
+    recon.inputs.cmd = CommandTemplate(cfg_reco.cmd, VALID_RECON_TAGS)
+    # Only the settings used by the command are part of the hash
+    if "output_dir" in recon.inputs.cmd:
+        recon.inputs.path_to_output = cfg_reco_base.get("path_to_output")
+    if "output_res" in recon.inputs.cmd:
+        recon.inputs.output_resolution = float(
+            cfg_reco_base.output_resolution
+        )
+    set_singularity_inputs(recon, cfg)
 
     # 2. clamp_intensities
     clamp_intense_name = "clamp_intensities"
@@ -286,8 +542,11 @@ def get_recon(cfg):
         interface=niu.Function(
             input_names=[
                 "input_stacks",
-                "cfg",
+                "quantile_ratio",
                 "is_enabled",
+                "output_format",
+                "compresslevel",
+                "num_threads",
             ],
             output_names=["output_stacks"],
             function=clamp_intensities,
@@ -295,7 +554,11 @@ def get_recon(cfg):
         name=clamp_intense_name
     )
     clamp_intense.inputs.is_enabled = enabled_clamp
-    clamp_intense.inputs.cfg = cfg
+    clamp_intense.inputs.quantile_ratio = float(cfg_reco_base.quantile_ratio)
+    intermediate_format = get_intermediate_format(cfg)
+    nifti_threads = get_nifti_threads(cfg)
+    clamp_intense.inputs.trait_set(**intermediate_format)
+    clamp_intense.n_procs = nifti_threads
 
     # 3. post_bias_correction
     post_bias_corr_name = "PostBiasCorrection"
@@ -319,12 +582,11 @@ def get_recon(cfg):
     )
     post_bias_cfg = cfg_postpro.bias_correction
     post_bias_corr.inputs.is_enabled = enabled_ppbc
-    post_bias_corr.inputs.cmd = post_bias_cfg[container].cmd
+    post_bias_corr.inputs.cmd = CommandTemplate(
+        post_bias_cfg[container].cmd, VALID_PREPRO_TAGS
+    )
 
-    # if the container is singularity, add singularity path to post_bias_corr
-    if cfg.container == "singularity":
-        post_bias_corr.inputs.singularity_path = cfg.singularity_path
-        post_bias_corr.inputs.singularity_mount = cfg.singularity_mount
+    set_singularity_inputs(post_bias_corr, cfg)
 
     # connect nodes
     rec_pipe.connect(
@@ -333,15 +595,35 @@ def get_recon(cfg):
             (inputnode, recon, [("masks", "input_masks")]),
         ]
     )
+    if "input_slice_reports" in recon.inputs.cmd:
+        # Only passed to the commands using them, to keep the hash of the
+        # others
+        rec_pipe.connect(
+            inputnode, "slice_reports", recon, "input_slice_reports"
+        )
 
     # recon => clamp_intense => post_bias_corr => outputnode
     rec_pipe.connect(recon, "srr_volume", clamp_intense, "input_stacks")
     rec_pipe.connect(
         clamp_intense, "output_stacks", post_bias_corr, "input_stacks"
     )
-    rec_pipe.connect(
-        post_bias_corr, "output_stacks", outputnode, "output_stacks"
-    )
+    if intermediate_format["output_format"] == "nii.gz":
+        rec_pipe.connect(
+            post_bias_corr, "output_stacks", outputnode, "output_stacks"
+        )
+    else:
+        # The reconstruction is a final output: always write it gzipped
+        compress = pe.Node(
+            interface=niu.Function(
+                input_names=["in_file", "compresslevel", "num_threads"],
+                output_names=["out_file"],
+                function=ensure_nii_gz,
+            ),
+            name="CompressOutput",
+        )
+        compress.n_procs = nifti_threads
+        rec_pipe.connect(post_bias_corr, "output_stacks", compress, "in_file")
+        rec_pipe.connect(compress, "out_file", outputnode, "output_stacks")
     return rec_pipe
 
 
@@ -356,7 +638,7 @@ def get_seg(cfg):
         seg_pipe:   A Nipype workflow object that contains
                     the segmentation steps.
     """
-    seg_pipe = pe.Workflow(name="Segmentation")
+    seg_pipe = pe.Workflow(name=stage_workflow_name(cfg, "segmentation"))
     # Creating input node
     inputnode = pe.Node(
         niu.IdentityInterface(fields=["srr_volume"]), name="inputnode"
@@ -374,7 +656,8 @@ def get_seg(cfg):
             input_names=[
                 "input_srr",
                 "cmd",
-                "cfg",
+                "path_to_output",
+                "crop_margin",
                 "singularity_path",
                 "singularity_mount",
                 "singularity_home",
@@ -385,12 +668,12 @@ def get_seg(cfg):
         name=cfg_seg_base.pipeline,
     )
 
-    seg.inputs.cmd = cfg_seg.cmd
-    seg.inputs.cfg = cfg_seg_base
-    if cfg.container == "singularity":
-        seg.inputs.singularity_path = cfg.singularity_path
-        seg.inputs.singularity_mount = cfg.singularity_mount
-        seg.inputs.singularity_home = cfg.singularity_home
+    seg.inputs.cmd = CommandTemplate(cfg_seg.cmd, VALID_SEG_TAGS)
+    if "output_dir" in seg.inputs.cmd:
+        seg.inputs.path_to_output = cfg_seg_base.get("path_to_output")
+    if cfg_seg_base.get("crop_margin") is not None:
+        seg.inputs.crop_margin = float(cfg_seg_base.crop_margin)
+    set_singularity_inputs(seg, cfg, home=True)
 
     seg_pipe.connect(inputnode, "srr_volume", seg, "input_srr")
     seg_pipe.connect(seg, "seg_volume", outputnode, "seg_volume")
@@ -409,7 +692,7 @@ def get_surf(cfg):
         surf_pipe:   A Nipype workflow object that contains
                     the surface extraction steps.
     """
-    surf_pipe = pe.Workflow(name="SurfaceExtraction")
+    surf_pipe = pe.Workflow(name=stage_workflow_name(cfg, "surface"))
 
     # Creating input node
     inputnode = pe.Node(
@@ -427,6 +710,8 @@ def get_surf(cfg):
     container = cfg.container
     cfg_surf_base = cfg.surface
     cfg_surf = cfg.surface[container]
+    surf_cmd = CommandTemplate(cfg_surf.cmd, VALID_SURF_TAGS)
+    crop_hemispheres = bool(cfg_surf_base.get("crop_hemispheres", False))
 
     # surf_lh
     surf_lh = pe.Node(
@@ -434,7 +719,9 @@ def get_surf(cfg):
             input_names=[
                 "input_seg",
                 "cmd",
-                "cfg",
+                "out_file",
+                "labelling_scheme",
+                "crop_hemisphere",
                 "singularity_path",
                 "singularity_mount",
                 "singularity_home",
@@ -445,13 +732,14 @@ def get_surf(cfg):
         name="surf_lh",
     )
 
-    surf_lh.inputs.cmd = cfg_surf.cmd
-    surf_lh.inputs.cfg = cfg_surf_base.surface_lh
+    surf_lh.inputs.cmd = surf_cmd
+    surf_lh.inputs.out_file = cfg_surf_base.surface_lh.out_file
+    surf_lh.inputs.labelling_scheme = get_labelling_scheme(
+        cfg_surf_base.surface_lh
+    )
 
-    if cfg.container == "singularity":
-        surf_lh.inputs.singularity_path = cfg.singularity_path
-        surf_lh.inputs.singularity_mount = cfg.singularity_mount
-        surf_lh.inputs.singularity_home = cfg.singularity_home
+    surf_lh.inputs.crop_hemisphere = crop_hemispheres
+    set_singularity_inputs(surf_lh, cfg, home=True)
 
     surf_pipe.connect(inputnode, "seg_volume", surf_lh, "input_seg")
     surf_pipe.connect(surf_lh, "surf_volume", outputnode, "surf_volume_lh")
@@ -462,7 +750,9 @@ def get_surf(cfg):
             input_names=[
                 "input_seg",
                 "cmd",
-                "cfg",
+                "out_file",
+                "labelling_scheme",
+                "crop_hemisphere",
                 "singularity_path",
                 "singularity_mount",
                 "singularity_home",
@@ -473,13 +763,14 @@ def get_surf(cfg):
         name="surf_rh",
     )
 
-    surf_rh.inputs.cmd = cfg_surf.cmd
-    surf_rh.inputs.cfg = cfg_surf_base.surface_rh
+    surf_rh.inputs.cmd = surf_cmd
+    surf_rh.inputs.out_file = cfg_surf_base.surface_rh.out_file
+    surf_rh.inputs.labelling_scheme = get_labelling_scheme(
+        cfg_surf_base.surface_rh
+    )
 
-    if cfg.container == "singularity":
-        surf_rh.inputs.singularity_path = cfg.singularity_path
-        surf_rh.inputs.singularity_mount = cfg.singularity_mount
-        surf_rh.inputs.singularity_home = cfg.singularity_home
+    surf_rh.inputs.crop_hemisphere = crop_hemispheres
+    set_singularity_inputs(surf_rh, cfg, home=True)
 
     surf_pipe.connect(inputnode, "seg_volume", surf_rh, "input_seg")
     surf_pipe.connect(surf_rh, "surf_volume", outputnode, "surf_volume_rh")
@@ -487,6 +778,24 @@ def get_surf(cfg):
     return surf_pipe
 
 
+def get_labelling_scheme(cfg_hemi):
+    """
+    Labels of the hemisphere of a surface extraction.
+
+    Args:
+        cfg_hemi: Configuration of the hemisphere, e.g. `surface_lh`.
+    Returns:
+        list[int]: Labels of the scheme `cfg_hemi.use_scheme`.
+    """
+    if cfg_hemi.use_scheme not in cfg_hemi.labelling_scheme:
+        raise ValueError(
+            f"Unknown labelling scheme: {cfg_hemi.use_scheme}, please "
+            f"choose from {list(cfg_hemi.labelling_scheme.keys())}"
+        )
+    labels = cfg_hemi.labelling_scheme[cfg_hemi.use_scheme]
+    return [int(label) for label in labels]
+
+
 def create_full_pipeline(cfg, load_masks=False, name="full_pipeline"):
     """
     Create a full fetal processing pipeline by combining preprocessing,
@@ -521,7 +830,8 @@ def create_full_pipeline(cfg, load_masks=False, name="full_pipeline"):
     outputnode = pe.Node(
         niu.IdentityInterface(
             fields=["output_srr", "output_seg",
-                    "output_surf_lh", "output_surf_rh"]
+                    "output_surf_lh", "output_surf_rh",
+                    "output_slice_reports"]
         ),
         name="outputnode",
     )
@@ -548,6 +858,14 @@ def create_full_pipeline(cfg, load_masks=False, name="full_pipeline"):
     full_fet_pipe.connect(
         prepro_pipe, "outputnode.masks", recon, "inputnode.masks"
     )
+    full_fet_pipe.connect(
+        prepro_pipe, "outputnode.slice_reports",
+        recon, "inputnode.slice_reports"
+    )
+    full_fet_pipe.connect(
+        prepro_pipe, "outputnode.slice_reports",
+        outputnode, "output_slice_reports"
+    )
 
     full_fet_pipe.connect(
         recon, "outputnode.output_stacks", outputnode, "output_srr"
@@ -621,14 +939,24 @@ def create_rec_pipeline(cfg, load_masks=False, name="rec_pipeline"):
         prepro_pipe, "outputnode.stacks", recon, "inputnode.stacks"
     )
     rec_pipe.connect(prepro_pipe, "outputnode.masks", recon, "inputnode.masks")
+    rec_pipe.connect(
+        prepro_pipe, "outputnode.slice_reports",
+        recon, "inputnode.slice_reports"
+    )
 
     outputnode = pe.Node(
-        niu.IdentityInterface(fields=["output_srr", "output_seg"]),
+        niu.IdentityInterface(
+            fields=["output_srr", "output_seg", "output_slice_reports"]
+        ),
         name="outputnode",
     )
     rec_pipe.connect(
         recon, "outputnode.output_stacks", outputnode, "output_srr"
     )
+    rec_pipe.connect(
+        prepro_pipe, "outputnode.slice_reports",
+        outputnode, "output_slice_reports"
+    )
 
     return rec_pipe
 
@@ -1,5 +1,7 @@
+import functools
 import os
 import re
+import shlex
 import sys
 import logging
 import time
@@ -234,13 +236,29 @@ def status_line(node, status, **_):
         )
 
 
+@functools.lru_cache(maxsize=None)
+def _container_env():
+    """
+    Environment used to launch the containers. It is built once per
+    worker process instead of being copied at every call.
+    """
+    env = os.environ.copy()
+    env.setdefault("PYTHONUNBUFFERED", "1")  # flush Python in container
+    env.setdefault("PYTHONIOENCODING", "utf-8")
+    env.setdefault("TQDM_DISABLE", "1")  # avoid CR-based progress bars
+    return env
+
+
 def run_and_tee(cmd, *, prefix=""):
     """
     Run a command, stream output live to terminal, and log every line.
     Returns the full combined output; raises RuntimeError on non-zero exit.
 
     Args:
-        cmd (str): The command to run.
+        cmd (list or str): The command to run. A list of arguments is
+                           executed directly, without going through a
+                           shell, so that no quoting is needed. A string
+                           is run through the shell.
         prefix (str): A prefix to add to each line of output.
 
     Returns:
@@ -250,21 +268,26 @@ def run_and_tee(cmd, *, prefix=""):
     log_plain = logging.getLogger("nipype.container")  # message-only
     log_evt = logging.getLogger("nipype.workflow")  # structured events
 
-    env = os.environ.copy()
-    env.setdefault("PYTHONUNBUFFERED", "1")  # flush Python in container
-    env.setdefault("PYTHONIOENCODING", "utf-8")
-    env.setdefault("TQDM_DISABLE", "1")  # avoid CR-based progress bars
+    use_shell = isinstance(cmd, str)
+    if not use_shell:
+        cmd = [str(arg) for arg in cmd]
 
-    proc = subprocess.Popen(
-        cmd,
-        shell=True,  # keep if you're passing a single string
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,  # merge stderr -> stdout
-        text=True,
-        bufsize=1,  # line-buffered
-        env=env,
-    )
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            shell=use_shell,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,  # merge stderr -> stdout
+            text=True,
+            bufsize=1,  # line-buffered
+            env=_container_env(),
+        )
+    except OSError as e:
+        # e.g. executable not found, which the shell reports as exit 127
+        raise RuntimeError(f"Could not launch command {cmd}: {e}") from e
 
+    if not use_shell:
+        cmd = shlex.join(cmd)  # quoted, for logging only
     log_evt.info("Running: %s", cmd)  # one structured line
 
     captured = []
@@ -0,0 +1,49 @@
+"""
+Stand-in for the containers used by the pipeline: sleeps for a given
+time, then copies its inputs to its outputs. Output i is a copy of
+input i, or of the last input when there are fewer inputs than outputs
+(e.g. a reconstruction from several stacks). Files are (de)compressed
+when the input and output differ in their `.gz` extension.
+
+Used by the tests and the benchmarks (see `utils_synthetic.stub_cmd`).
+It only depends on the standard library, so that it starts quickly.
+
+Usage:
+    python stub_container.py --sleep 0.1 --inputs a b --outputs c d
+"""
+
+import argparse
+import gzip
+import os
+import shutil
+import time
+
+
+def copy(source, output):
+    """Copy `source` to `output`, gzipping or gunzipping it if needed."""
+    in_gz, out_gz = source.endswith(".gz"), output.endswith(".gz")
+    if in_gz == out_gz:
+        shutil.copyfile(source, output)
+        return
+    reader = gzip.open if in_gz else open
+    writer = gzip.open if out_gz else open
+    with reader(source, "rb") as fin, writer(output, "wb") as fout:
+        shutil.copyfileobj(fin, fout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sleep", type=float, default=0.0)
+    parser.add_argument("--inputs", nargs="+", required=True)
+    parser.add_argument("--outputs", nargs="+", required=True)
+    args = parser.parse_args(argv)
+
+    time.sleep(args.sleep)
+    for i, output in enumerate(args.outputs):
+        source = args.inputs[min(i, len(args.inputs) - 1)]
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        copy(source, output)
+
+
+if __name__ == "__main__":
+    main()
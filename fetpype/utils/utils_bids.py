@@ -21,6 +21,7 @@ def create_datasource(
     name="bids_datasource",
     extra_derivatives=None,
     save_db=False,
+    skip=None,
 ):
     """Create a datasource node that have iterables following BIDS format.
     By default, from a BIDSLayout, lists all the subjects (`<sub>`),
@@ -60,6 +61,8 @@ def create_datasource(
         extra_derivatives (list or str, optional): Additional
             derivatives to include. If provided, these will be
             added to the BIDSDataGrabber.
+        skip (set, optional): (sub, ses, acq) tuples to leave out of the
+            iterables, e.g. the subjects already processed.
     Returns:
         pe.Node: A configured BIDSDataGrabber node that retrieves data
         according to the specified parameters.
@@ -105,13 +108,26 @@ def create_datasource(
 
         bids_datasource.inputs.load_layout = layout_db
 
+    # Index the sessions and acquisitions of each subject from a single
+    # query: querying the layout for each subject scales with the size
+    # of the dataset, and thus quadratically with the number of subjects.
+    entities = [f.get_entities() for f in layout.get(return_type="object")]
+    index = {}
+    for ent in entities:
+        if "subject" not in ent:
+            continue
+        sessions_sub = index.setdefault(ent["subject"], {})
+        acqs = sessions_sub.setdefault(ent.get("session"), set())
+        if "acquisition" in ent:
+            acqs.add(ent["acquisition"])
+    existing_sub = sorted(index)
+
     # Verbose
     print("BIDS layout:", layout)
-    print("\t", layout.get_subjects())
-    print("\t", layout.get_sessions())
+    print("\t", existing_sub)
+    print("\t", sorted({e["session"] for e in entities if "session" in e}))
     iterables = [("subject", "session", "acquisition"), []]
 
-    existing_sub = layout.get_subjects()
     if subjects is None:
         subjects = existing_sub
 
@@ -122,7 +138,7 @@ def create_datasource(
                 f"folder {data_dir}."
             )
 
-        existing_ses = layout.get_sessions(subject=sub)
+        existing_ses = sorted(s for s in index[sub] if s is not None)
         if sessions is None:
             sessions_subj = existing_ses
         else:
@@ -134,7 +150,7 @@ def create_datasource(
                 print(
                     f"WARNING: Session {ses} was not found for subject {sub}."
                 )
-            existing_acq = layout.get_acquisition(subject=sub, session=ses)
+            existing_acq = sorted(index[sub].get(ses, ()))
             if acquisitions is None:
                 acquisitions_subj = existing_acq
             else:
@@ -151,6 +167,12 @@ def create_datasource(
                         f"subject {sub} session {ses}."
                     )
 
+                if skip is not None and (sub, ses, acq) in skip:
+                    print(
+                        f"Skipping subject {sub} session {ses} "
+                        f"acquisition {acq}."
+                    )
+                    continue
                 iterables[1] += [(sub, ses, acq)]
 
     bids_datasource.iterables = iterables
@@ -295,6 +317,33 @@ def create_bids_datasink(
                 ),
             )
         )
+        # ** Rule 3.5: Slice reports of the reconstructed stacks **
+        # with session
+        regex_subs.append(
+            (
+                (
+                    rf"^{escaped_bids_derivatives_root}/.*?_?session_([^/]+)"
+                    rf"_subject_([^/]+).*/([^/]+)_T2w_slices\.json$"
+                ),
+                (
+                    rf"{bids_derivatives_root}/sub-\2/ses-\1/"
+                    rf"{datatype}/\3_desc-slices_T2w.json"
+                ),
+            )
+        )
+        # without session
+        regex_subs.append(
+            (
+                (
+                    rf"^{escaped_bids_derivatives_root}/(?!.*?_?session_[^/]+)"
+                    rf".*?_?subject_([^/]+).*/([^/]+)_T2w_slices\.json$"
+                ),
+                (
+                    rf"{bids_derivatives_root}/sub-\1/"
+                    rf"{datatype}/\2_desc-slices_T2w.json"
+                ),
+            )
+        )
 
     # ** Rule 4: Segmentation Output **
     if seg_label and rec_label and pipeline_name != "preprocessing":
@@ -523,7 +572,53 @@ def create_datasink(
     return datasink
 
 
-def get_gestational_age(bids_dir, T2):
+def _parse_participant_value(value):
+    """Convert a participants.tsv cell to int or float when possible."""
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+def load_participants_index(bids_dir):
+    """
+    Parse the `participants.tsv` file of a BIDS dataset once, so that it
+    can be passed to the nodes that need subject metadata instead of each
+    of them reading the file again.
+
+    Args:
+        bids_dir : The file path to the root of the BIDS dataset,
+            which must contain a 'participants.tsv' file.
+    Returns:
+        participants : A dictionary mapping each `participant_id` to
+            the row of the table (as a dictionary). If the table has a
+            `session_id` column, rows are also keyed by
+            `"<participant_id>_<session_id>"`.
+
+    """
+    import csv
+
+    participants_path = os.path.join(bids_dir, "participants.tsv")
+    try:
+        with open(participants_path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f, delimiter="\t"))
+    except FileNotFoundError:
+        raise FileNotFoundError(f"participants.tsv not found in {bids_dir}")
+
+    participants = {}
+    for row in rows:
+        row = {k: _parse_participant_value(v) for k, v in row.items()}
+        participant_id = str(row.get("participant_id"))
+        # Keep the first row of a participant, as pandas lookups did
+        participants.setdefault(participant_id, row)
+        if row.get("session_id") not in (None, ""):
+            participants[f"{participant_id}_{row['session_id']}"] = row
+    return participants
+
+
+def get_gestational_age(bids_dir, T2, participants=None):
     """
     Retrieve the gestational age for a specific subject from a BIDS dataset.
 
@@ -532,47 +627,70 @@ def get_gestational_age(bids_dir, T2):
             which must contain a 'participants.tsv' file.
         T2 : The path of the image. We can get the subject id from there if
             it follows a BIDS format.
+        participants : Index returned by `load_participants_index`. If
+            None, participants.tsv is read from `bids_dir`.
     Returns:
         gestational_age : The gestational age of the subject.
 
     """
-    import pandas as pd
     import os
+    from fetpype.utils.utils_bids import load_participants_index
 
-    participants_path = f"{bids_dir}/participants.tsv"
-
-    try:
-        df = pd.read_csv(participants_path, delimiter="\t")
-    except FileNotFoundError:
-        raise FileNotFoundError(f"participants.tsv not found in {bids_dir}")
+    if participants is None:
+        participants = load_participants_index(bids_dir)
 
     # TODO This T2[0] not really clean
-    subject_id = os.path.basename(T2).split("_")[0]
+    entities = os.path.basename(T2).split("_")
+    subject_id = entities[0]
+    session_id = next((e for e in entities if e.startswith("ses-")), None)
+
+    row = participants.get(f"{subject_id}_{session_id}")
+    if row is None:
+        row = participants.get(subject_id)
+    if row is None:
+        raise IndexError(
+            f"Subject {subject_id} not found in participants.tsv"
+        )
     try:
-        gestational_age = df.loc[
-            df["participant_id"] == f"{subject_id}", "gestational_age"
-        ].values[0]
+        gestational_age = row["gestational_age"]
     except KeyError:
         raise KeyError(
             "Column 'gestational_age' not found in participants.tsv"
         )
-    except IndexError:
-        raise IndexError(
-            f"Subject sub-{subject_id} not found in participants.tsv"
-        )
 
     return gestational_age
 
 
-def create_description_file(out_dir, algo, prev_desc=None, cfg=None):
+def create_description_file(
+    out_dir, algo, prev_desc=None, cfg=None, digest=None
+):
     """Create a dataset_description.json file in the derivatives folder.
     TODO: should look for the extra parameters and also add them
 
     Args:
-        args : Dictionary containing the arguments passed to the script.
-        container_type : Type of container used to run the algorithm.
+        out_dir (str): Derivatives folder of the pipeline.
+        algo (str): Name of the pipeline.
+        prev_desc (str, optional): dataset_description.json of the inputs.
+        cfg (optional): Configuration of the pipeline, recorded as is.
+        digest (str, optional): Digest of the configuration of the stage
+            and of the stages before it, from `stage_digests`.
     """
-    if not os.path.exists(os.path.join(out_dir, "dataset_description.json")):
+    desc_file = os.path.join(out_dir, "dataset_description.json")
+    if os.path.exists(desc_file):
+        if cfg is None and digest is None:
+            return
+        # Record the current configuration
+        with open(desc_file, "r", encoding="utf-8") as f:
+            description = json.load(f)
+        updated = dict(description)
+        if cfg is not None:
+            updated["Config"] = _config_container(cfg)
+        if digest is not None:
+            updated["ConfigDigest"] = digest
+        if updated != description:
+            with open(desc_file, "w", encoding="utf-8") as outfile:
+                json.dump(updated, outfile, indent=4)
+    else:
         description = {
             "Name": algo,
             "Version": "1.0",
@@ -592,13 +710,84 @@ def create_description_file(out_dir, algo, prev_desc=None, cfg=None):
                 prev_desc = json.load(f)
                 description["GeneratedBy"].append({"Name": prev_desc["Name"]})
         if cfg is not None:
-            description["Config"] = OmegaConf.to_container(cfg, resolve=True)
-        with open(
-            os.path.join(
-                out_dir,
-                "dataset_description.json",
-            ),
-            "w",
-            encoding="utf-8",
-        ) as outfile:
+            description["Config"] = _config_container(cfg)
+        if digest is not None:
+            description["ConfigDigest"] = digest
+        with open(desc_file, "w", encoding="utf-8") as outfile:
             json.dump(description, outfile, indent=4)
+
+
+def _config_container(cfg):
+    """Configuration as stored in dataset_description.json."""
+    return json.loads(json.dumps(OmegaConf.to_container(cfg, resolve=True)))
+
+
+def _entities(filename):
+    """(sub, ses, acq) of a BIDS file name, None if it has no subject."""
+    match = re.match(r"sub-([a-zA-Z0-9]+)", filename)
+    if match is None:
+        return None
+    ses = re.search(r"_ses-([a-zA-Z0-9]+)", filename)
+    acq = re.search(r"_acq-([a-zA-Z0-9]+)", filename)
+    return (
+        match.group(1),
+        ses.group(1) if ses else None,
+        acq.group(1) if acq else None,
+    )
+
+
+def _nifti_mtimes(bids_dir):
+    """Latest modification time of the NIfTI files of each (sub, ses, acq)
+    of the subject folders of `bids_dir`."""
+    mtimes = {}
+    for sub_dir in sorted(os.listdir(bids_dir)):
+        if not sub_dir.startswith("sub-"):
+            continue
+        for root, _, files in os.walk(os.path.join(bids_dir, sub_dir)):
+            for f in files:
+                if not re.search(r"\.nii(\.gz)?$", f):
+                    continue
+                key = _entities(f)
+                if key is None:
+                    continue
+                mtime = os.path.getmtime(os.path.join(root, f))
+                mtimes[key] = max(mtimes.get(key, mtime), mtime)
+    return mtimes
+
+
+def get_up_to_date_subjects(manifest, input_dirs, digests):
+    """
+    Find the (sub, ses, acq) of the inputs whose outputs already exist in
+    the derivatives folder of a pipeline and are up to date, so that an
+    incremental run only processes the new or stale ones.
+
+    A subject is up to date if its run manifest records the stages of
+    `digests` with the current configuration, after the last change of
+    its inputs, and the recorded outputs still exist. As the digest of a
+    stage covers the stages before it, a change of the preprocessing makes
+    the reconstructions stale. The completion is recorded when the
+    datasinks of the subject run, even if they leave identical outputs
+    untouched, so that a configuration change that does not change the
+    outputs is not reported as stale on every run.
+
+    Args:
+        manifest (RunManifest): Run manifest of the pipeline, from
+            `get_manifest`.
+        input_dirs (list[str]): BIDS folders of the inputs (data and
+            masks). None entries are ignored.
+        digests (dict): Digest of the stages of the pipeline, from
+            `stage_digests`.
+    Returns:
+        set: (sub, ses, acq) tuples that can be skipped.
+    """
+    inputs = {}
+    for input_dir in input_dirs:
+        if input_dir is None:
+            continue
+        for key, mtime in _nifti_mtimes(input_dir).items():
+            inputs[key] = max(inputs.get(key, mtime), mtime)
+    return {
+        key
+        for key, mtime in inputs.items()
+        if manifest.is_complete(key, digests, since=mtime)
+    }
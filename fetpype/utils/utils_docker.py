@@ -1,8 +1,17 @@
 # Given a config file, check if the docker model is available
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
 import subprocess
 import sys
 
+log = logging.getLogger("nipype.workflow")
+
 
 def flatten_cfg(cfg, base=""):
     """
@@ -21,6 +30,116 @@ def flatten_cfg(cfg, base=""):
             yield ("/".join([base, k]), v)
 
 
+# Options of `docker run` that take no value
+DOCKER_RUN_FLAGS = {
+    "--detach",
+    "--init",
+    "--interactive",
+    "--no-healthcheck",
+    "--oom-kill-disable",
+    "--privileged",
+    "--publish-all",
+    "--read-only",
+    "--rm",
+    "--tty",
+}
+DOCKER_RUN_SHORT_FLAGS = set("ditP")
+
+
+def _docker_image(tokens):
+    """
+    Find the image of a `docker run` command, given as a list of tokens:
+    the first token after `run` that is neither an option, an option
+    value nor a `<tag>` (e.g. `<mount>`, which expands to options).
+    """
+    i = tokens.index("run") + 1 if "run" in tokens else 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if token.startswith("<") and token.endswith(">"):
+            continue
+        if token.startswith("--"):
+            if "=" not in token and token not in DOCKER_RUN_FLAGS:
+                i += 1  # Skip the value of the option
+            continue
+        if token.startswith("-") and len(token) > 1:
+            # Short options can be grouped (-it) or carry their value (-w/x)
+            flags = token[1:]
+            while flags and flags[0] in DOCKER_RUN_SHORT_FLAGS:
+                flags = flags[1:]
+            if len(flags) == 1:
+                i += 1
+            continue
+        if re.match(r"^[\w.\-/:@]+$", token) is not None:
+            return token
+        return None
+    return None
+
+
+def get_container_name(container_type, cmd, singularity_path=None):
+    """
+    Extract the container used by a command from the config.
+
+    Args:
+        container_type (str):   The type of container, either 'docker'
+                                or 'singularity'
+        cmd (str): The command, with its `<tags>`.
+        singularity_path (str, optional): Value substituted for the
+            `<singularity_path>` tag.
+    Returns:
+        str: The docker image or the path to the singularity image,
+            None if no container could be found in the command.
+    """
+    if cmd is None:
+        return None
+    tokens = shlex.split(cmd)
+    if container_type == "docker":
+        return _docker_image(tokens)
+    elif container_type == "singularity":
+        for token in tokens:
+            if token.endswith(".sif"):
+                if singularity_path is not None:
+                    token = token.replace(
+                        "<singularity_path>", singularity_path
+                    )
+                return token
+    return None
+
+
+def _iter_container_cmds(container_type, cfg, path=()):
+    """
+    Yield the (path, cmd) of every command run with `container_type`
+    in a nested configuration dictionary.
+    """
+    for k, v in cfg.items():
+        if isinstance(v, dict):
+            yield from _iter_container_cmds(container_type, v, path + (k,))
+        elif k == "cmd" and len(path) > 0 and path[-1] == container_type:
+            yield path + (k,), v
+
+
+def get_container_names(container_type, cfg):
+    """
+    List the containers referenced in the configuration.
+
+    Args:
+        container_type (str):   The type of container, either 'docker'
+                                or 'singularity'
+        cfg (dict): The configuration dictionary containing the
+                    container commands.
+    Returns:
+        dict: Mapping from each container to the configuration keys
+            (formatted as `/a/b/cmd`) that use it.
+    """
+    container_names = defaultdict(list)
+    singularity_path = cfg.get("singularity_path", None)
+    for path, cmd in _iter_container_cmds(container_type, cfg):
+        name = get_container_name(container_type, cmd, singularity_path)
+        if name is not None:
+            container_names[name].append("/" + "/".join(path))
+    return container_names
+
+
 def is_available_container(container_type, container_name):
     """
     Check if the container is available on the system.
@@ -55,57 +174,175 @@ def is_available_container(container_type, container_name):
         )
 
 
-def retrieve_container(container_type, container_name):
+def retrieve_container(container_type, container_name, source=None):
     """
-        Retrieve the container from the registry.
+    Retrieve the container from the registry.
+
     Args:
         container_type (str):   The type of container, either 'docker' or
                                 'singularity'
-        container_name (str): The name of the container to retrieve.
+        container_name (str):   The name of the container to retrieve. For
+                                singularity, the path of the `.sif` file
+                                to create.
+        source (str, optional): For singularity, the docker image from
+                                which the `.sif` file is built.
 
     """
     if container_type == "docker":
-
         cmd = [container_type, "pull", container_name]
-        print(f"Running {' '.join(cmd)}")
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-        for line in process.stdout:
-            print(line, end="")
-
-        process.wait()
-        if process.returncode != 0:
-            for line in process.stderr:
-                print(line, end="")
-            raise subprocess.CalledProcessError(
-                process.returncode,
-                cmd,
-                output=process.stdout.read(),
-                stderr=process.stderr.read(),
-            )
     elif container_type == "singularity":
-        raise NotImplementedError
+        if source is None:
+            raise ValueError(
+                f"No docker image to build {container_name} from. Please "
+                "retrieve it manually."
+            )
+        os.makedirs(
+            os.path.dirname(os.path.abspath(container_name)), exist_ok=True
+        )
+        cmd = [container_type, "pull", container_name, f"docker://{source}"]
     else:
         raise ValueError(
             f"Container type {container_type} not supported. "
             "Please use 'docker' or 'singularity'."
         )
 
+    log.info(f"Running {' '.join(cmd)}")
+    process = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode,
+            cmd,
+            output=process.stdout,
+            stderr=process.stderr,
+        )
+
+
+def _source_priority(image):
+    """
+    Sort key of the docker images a singularity image can be built from:
+    images pinned by digest first, then by an explicit tag, then `latest`
+    or no tag. Images of the same kind are sorted by decreasing version.
+    """
+    if "@" in image:
+        kind, tag = 0, image.split("@", 1)[1]
+    else:
+        repository, _, tag = image.rpartition(":")
+        if "/" in tag or not repository:
+            tag = ""
+        kind = 1 if tag not in ("", "latest") else 2
+    version = [
+        (0, -int(part)) if part.isdigit() else (1, part)
+        for part in re.split(r"(\d+)", tag)
+        if part
+    ]
+    return kind, version, image
+
+
+def get_container_sources(cfg):
+    """
+    Map each singularity image of the configuration to the docker image
+    that the same step runs with docker. This is where missing `.sif`
+    files are built from.
+
+    When the steps using the same singularity image run different docker
+    images, the image is built from the most specific one: an image
+    pinned by digest, else the highest explicit tag, else `latest`. A
+    warning lists the images left out.
+
+    Args:
+        cfg (dict): The configuration dictionary containing the
+                    container commands.
+    Returns:
+        dict: Mapping from each singularity image to a docker image.
+    """
+    docker_cmds = {
+        path[:-2]: cmd for path, cmd in _iter_container_cmds("docker", cfg)
+    }
+    singularity_path = cfg.get("singularity_path", None)
+    candidates = defaultdict(set)
+    for path, cmd in _iter_container_cmds("singularity", cfg):
+        name = get_container_name("singularity", cmd, singularity_path)
+        source = get_container_name("docker", docker_cmds.get(path[:-2]))
+        if name is not None and source is not None:
+            candidates[name].add(source)
+    sources = {}
+    for name, images in candidates.items():
+        source, *others = sorted(images, key=_source_priority)
+        if others:
+            log.warning(
+                f"The steps using {name} run different docker images: "
+                f"it is built from {source}, not from {', '.join(others)}"
+            )
+        sources[name] = source
+    return sources
+
+
+def retrieve_containers(
+    container_type, container_names, sources=None, max_workers=4
+):
+    """
+    Retrieve several containers concurrently, reporting the overall
+    progress through the logger.
+
+    Args:
+        container_type (str):   The type of container, either 'docker' or
+                                'singularity'
+        container_names (list): The names of the containers to retrieve.
+        sources (dict, optional):   For singularity, mapping from each
+                                    `.sif` file to the docker image it is
+                                    built from.
+        max_workers (int):  Maximum number of containers retrieved at
+                            the same time.
+    """
+    sources = sources or {}
+    n_total = len(container_names)
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(
+                retrieve_container, container_type, k, sources.get(k)
+            ): k
+            for k in container_names
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                future.result()
+            except (subprocess.CalledProcessError, ValueError) as e:
+                failed[name] = getattr(e, "stderr", None) or str(e)
+                log.error(f"[{i}/{n_total}] Failed to retrieve {name}")
+            else:
+                log.info(f"[{i}/{n_total}] Retrieved {name}")
+
+    if len(failed) > 0:
+        raise RuntimeError(
+            "Could not retrieve the containers:\n"
+            + "\n".join(f"{k}: {v.strip()}" for k, v in failed.items())
+        )
+
 
-def check_container_commands(container_type, cfg):
+def check_container_commands(
+    container_type, cfg, non_interactive=False, max_workers=4
+):
     """
     Check if the required docker or singularity images are available
-    on the system.
+    on the system, and retrieve the missing ones. Missing singularity
+    images are built from the docker image used by the same step.
 
     Args:
         container_type (str):   The type of container, either 'docker' or
                                 'singularity'
         cfg (dict): The configuration dictionary containing the
                     container names.
+        non_interactive (bool): Retrieve the missing containers without
+                                asking for confirmation.
+        max_workers (int):  Maximum number of containers checked and
+                            retrieved at the same time.
 
     """
     # Check if the container_type is valid
@@ -115,62 +352,216 @@ def check_container_commands(container_type, cfg):
             "Please use 'docker' or 'singularity'."
         )
 
-    # Iterate the nested config dictionary
-    cfg_dict = dict(flatten_cfg(cfg))
-    container_names = {}
-    for k, v in cfg_dict.items():
-        # Return the word that is after the <mount> tag in the string v
-        if container_type == "docker" and "docker" in k:
-            docker_name = v.split("<mount>")[-1].split()[0]
-            container_names[k] = docker_name
-        elif container_type == "singularity" and "singularity" in k:
-            # Find a string that ends with .sif
-            if v is None:
-                continue
-            print("CHECKING PATH IN", k, v)
-            singularity_name = [s for s in v.split(" ") if s.endswith(".sif")][
-                0
-            ]
-            container_names[k] = singularity_name
-
-    container_names_list = defaultdict(list)
-    for k, v in container_names.items():
-        container_names_list[v].append(k)
+    container_names_list = get_container_names(container_type, cfg)
 
     # Check which containers are missing
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        available = dict(
+            zip(
+                container_names_list,
+                pool.map(
+                    lambda k: is_available_container(container_type, k),
+                    container_names_list,
+                ),
+            )
+        )
     missing_containers = []
     for k, v in container_names_list.items():
-        print(f"Checking {container_type} {k} -- Used by {', '.join(v)}")
-        if not is_available_container(container_type, k):
-            print("\tSTATUS: NOT FOUND")
+        status = "AVAILABLE" if available[k] else "NOT FOUND"
+        log.info(
+            f"Checking {container_type} {k} -- Used by {', '.join(v)}"
+            f"\n\tSTATUS: {status}"
+        )
+        if not available[k]:
             missing_containers.append(k)
-        else:
-            print("\tSTATUS: AVAILABLE")
+
+    if len(missing_containers) == 0:
+        return
 
     # Retrieve the missing containers
-    if len(missing_containers) > 0 and container_type == "docker":
+    if not non_interactive:
         var = input(
             f"Would you like me to retrieve the missing containers "
             f"{', '.join(missing_containers)}? (y/n) "
         )
-        if var == "y":
-            for k in missing_containers:
-                retrieve_container(container_type, k)
-
-        else:
+        if var != "y":
             print("Exiting...")
             sys.exit(1)
-    elif len(missing_containers) > 0 and container_type == "singularity":
-        raise NotImplementedError(
-            "Automated container retrieval for singularity is "
-            "not implemented yet."
+
+    sources = None
+    if container_type == "singularity":
+        sources = get_container_sources(cfg)
+    retrieve_containers(
+        container_type,
+        missing_containers,
+        sources=sources,
+        max_workers=max_workers,
+    )
+
+
+def resolve_container_digest(container_type, container_name):
+    """
+    Resolve a container to an immutable reference.
+
+    For docker, the image is inspected and the repository digest
+    (`<repository>@sha256:<digest>`) is returned, falling back to the
+    image ID for images that were built locally. For singularity, the
+    `.sif` file is hashed: the path is kept as the reference, and reading
+    the file also brings it into the page cache.
+
+    Args:
+        container_type (str):   The type of container, either 'docker'
+                                or 'singularity'
+        container_name (str): The name of the container to resolve.
+    Returns:
+        tuple: The pinned reference to use in the commands and the
+            `sha256:<digest>` of the container.
+    """
+    if container_type == "docker":
+        out = subprocess.run(
+            ["docker", "image", "inspect", container_name],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
         )
-        sys.exit(1)
+        info = json.loads(out.stdout)[0]
+        repository = container_name.split("@")[0]
+        if ":" in repository.split("/")[-1]:
+            repository = repository.rsplit(":", 1)[0]
+        for repo_digest in info.get("RepoDigests") or []:
+            if repo_digest.split("@")[0] == repository:
+                return repo_digest, repo_digest.split("@")[1]
+        return info["Id"], info["Id"]
+    elif container_type == "singularity":
+        sha = hashlib.sha256()
+        with open(container_name, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                sha.update(chunk)
+        return container_name, f"sha256:{sha.hexdigest()}"
+    else:
+        raise ValueError(
+            f"Container type {container_type} not supported. "
+            "Please use 'docker' or 'singularity'."
+        )
+
+
+def warm_container(container_type, container_ref):
+    """
+    Pre-warm a container so that the first node using it does not pay
+    for its setup. For docker, a (never started) container is created and
+    removed, which prepares the image layers. Singularity images are
+    already read into the page cache by `resolve_container_digest`.
+
+    Args:
+        container_type (str):   The type of container, either 'docker'
+                                or 'singularity'
+        container_ref (str): The (pinned) reference of the container.
+    """
+    if container_type != "docker":
+        return
+    out = subprocess.run(
+        ["docker", "create", container_ref],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if out.returncode != 0:
+        log.warning(
+            f"Could not pre-warm {container_ref}: {out.stderr.strip()}"
+        )
+        return
+    subprocess.run(
+        ["docker", "rm", out.stdout.strip()],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def _pin_container(container_type, container_name):
+    if not is_available_container(container_type, container_name):
+        raise RuntimeError(
+            f"Container {container_name} is not available on this system."
+        )
+    ref, digest = resolve_container_digest(container_type, container_name)
+    warm_container(container_type, ref)
+    return ref, digest
+
+
+def pin_container_commands(
+    cfg, sections=None, retrieve_missing=False, max_workers=None
+):
+    """
+    Resolve every container referenced in the configuration to an
+    immutable digest and pre-warm it, before any node runs. The containers
+    are checked concurrently. The commands in `cfg` are rewritten
+    in-place to use the pinned references, so that every node of the run
+    uses the same image.
+
+    Args:
+        cfg (DictConfig): The composed configuration of the run. Its
+            `container` entry selects the container type.
+        sections (list, optional): Top-level sections of the config to
+            consider, e.g. `["segmentation"]` (default: all of them).
+        retrieve_missing (bool): Retrieve the missing containers, without
+            prompting, before pinning them.
+        max_workers (int, optional): Number of containers processed
+            concurrently (default: one per container, up to 32).
+    Returns:
+        dict: Mapping from each container to its pinned reference and
+            digest.
+    """
+    from omegaconf import OmegaConf
+
+    container_type = cfg.container
+    cfg_dict = OmegaConf.to_container(cfg, resolve=True)
+    if sections is not None:
+        cfg_dict = {
+            k: v
+            for k, v in cfg_dict.items()
+            if k in sections or not isinstance(v, dict)
+        }
+    container_names = get_container_names(container_type, cfg_dict)
+    if len(container_names) == 0:
+        return {}
+    if max_workers is None:
+        max_workers = min(32, len(container_names))
+    if retrieve_missing:
+        check_container_commands(
+            container_type,
+            cfg_dict,
+            non_interactive=True,
+            max_workers=min(4, max_workers),
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pinned = dict(
+            zip(
+                container_names,
+                pool.map(
+                    lambda k: _pin_container(container_type, k),
+                    container_names,
+                ),
+            )
+        )
+
+    for name, (ref, digest) in pinned.items():
+        log.info(
+            f"Pinned {container_type} {name} -> {ref} ({digest}) -- "
+            f"Used by {', '.join(container_names[name])}"
+        )
+        if ref == name:
+            continue
+        pattern = re.compile(rf"(?<!\S){re.escape(name)}(?!\S)")
+        for key in container_names[name]:
+            key = key.strip("/").replace("/", ".")
+            cmd = OmegaConf.select(cfg, key)
+            OmegaConf.update(cfg, key, pattern.sub(ref, cmd, count=1))
+    return pinned
 
 
 if __name__ == "__main__":
     import argparse
-    import os
 
     parser = argparse.ArgumentParser(
         description=(
@@ -183,14 +574,22 @@ if __name__ == "__main__":
         required=True,
         help="Path to the config file",
     )
+    parser.add_argument(
+        "--yes",
+        "-y",
+        action="store_true",
+        help="Retrieve the missing containers without asking.",
+    )
     args = parser.parse_args()
     # Load hydra config and convert it as a dict
     from omegaconf import OmegaConf
-    from workflows.utils import init_and_load_cfg
+    from fetpype.workflows.utils import init_and_load_cfg
 
     # hydra load nested config file
     print(os.getcwd())
     cfg = init_and_load_cfg(args.cfg)
     cfg = OmegaConf.to_container(cfg, resolve=True)
 
-    check_container_commands("singularity", cfg)
+    check_container_commands(
+        cfg["container"], cfg, non_interactive=args.yes
+    )
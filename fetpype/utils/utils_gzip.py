@@ -0,0 +1,140 @@
+"""
+Multi-threaded gzip compression and decompression.
+
+Data is compressed in independent blocks, each written as a gzip member
+(as pigz --independent or the BGZF format do). The concatenation of
+members is a valid gzip file, readable by `gzip`, `zlib` and nibabel.
+Each member carries its total size in an extra field of its header
+(subfield "FP"), so that the members of a file written here can be
+located without inflating them and decompressed in parallel. Other gzip
+files are decompressed on a single thread.
+
+zlib releases the GIL while (de)compressing, so a thread pool is enough
+to use several cores.
+"""
+
+import gzip
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed size of each block
+BLOCK_SIZE = 1 << 20
+
+_MAGIC = b"\x1f\x8b\x08"
+_FEXTRA = 4
+_SUBFIELD = b"FP"
+# ID1 ID2 CM FLG MTIME XFL OS | XLEN | SI1 SI2 LEN | member size
+_HEADER = struct.Struct("<3sBIBBH2sHI")
+_TRAILER = struct.Struct("<II")
+_OVERHEAD = _HEADER.size + _TRAILER.size
+
+
+def _compress_block(block, compresslevel):
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS
+    )
+    deflated = compressor.compress(block) + compressor.flush()
+    header = _HEADER.pack(
+        _MAGIC,
+        _FEXTRA,
+        0,
+        0,
+        255,
+        8,
+        _SUBFIELD,
+        4,
+        len(deflated) + _OVERHEAD,
+    )
+    trailer = _TRAILER.pack(zlib.crc32(block), len(block) & 0xFFFFFFFF)
+    return b"".join((header, deflated, trailer))
+
+
+def _decompress_member(member):
+    deflated = member[_HEADER.size : -_TRAILER.size]  # noqa: E203
+    data = zlib.decompress(deflated, -zlib.MAX_WBITS)
+    crc, size = _TRAILER.unpack(member[-_TRAILER.size :])  # noqa: E203
+    if crc != zlib.crc32(data) or size != len(data) & 0xFFFFFFFF:
+        raise gzip.BadGzipFile("CRC check failed on a gzip member.")
+    return data
+
+
+def _split_members(buf):
+    """
+    Locate the members written by `compress`.
+
+    Returns:
+        tuple: The list of members and the offset of the first byte that
+               does not belong to them (`len(buf)` if all do).
+    """
+    members = []
+    offset = 0
+    while len(buf) - offset >= _OVERHEAD:
+        magic, flags, _, _, _, xlen, subfield, sublen, size = (
+            _HEADER.unpack_from(buf, offset)
+        )
+        if (
+            magic != _MAGIC
+            or flags != _FEXTRA
+            or xlen != 8
+            or subfield != _SUBFIELD
+            or sublen != 4
+            or size < _OVERHEAD
+            or offset + size > len(buf)
+        ):
+            break
+        members.append(buf[offset : offset + size])  # noqa: E203
+        offset += size
+    return members, offset
+
+
+def compress(data, compresslevel=6, threads=1, block_size=BLOCK_SIZE):
+    """
+    Compress `data` to gzip, in blocks compressed on `threads` threads.
+
+    Args:
+        data (bytes): Data to compress.
+        compresslevel (int): gzip level, from 1 to 9.
+        threads (int): Number of threads.
+        block_size (int): Uncompressed size of each block.
+    Returns:
+        bytes: gzip-compatible compressed data.
+    """
+    view = memoryview(data).cast("B")
+    blocks = [
+        view[start : start + block_size]  # noqa: E203
+        for start in range(0, len(view), block_size)
+    ] or [view]
+    if threads > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(min(threads, len(blocks))) as pool:
+            members = list(
+                pool.map(
+                    _compress_block, blocks, [compresslevel] * len(blocks)
+                )
+            )
+    else:
+        members = [_compress_block(b, compresslevel) for b in blocks]
+    return b"".join(members)
+
+
+def decompress(buf, threads=1):
+    """
+    Decompress gzip data. The members written by `compress` are
+    decompressed on `threads` threads, anything else on a single one.
+
+    Args:
+        buf (bytes): gzip data.
+        threads (int): Number of threads.
+    Returns:
+        bytes: Decompressed data.
+    """
+    view = memoryview(buf).cast("B")
+    members, offset = _split_members(view)
+    if threads > 1 and len(members) > 1:
+        with ThreadPoolExecutor(min(threads, len(members))) as pool:
+            chunks = list(pool.map(_decompress_member, members))
+    else:
+        chunks = [_decompress_member(m) for m in members]
+    if offset < len(view):
+        chunks.append(gzip.decompress(view[offset:]))
+    return b"".join(chunks)
@@ -0,0 +1,225 @@
+"""
+Run manifest recording, for each subject, the stages whose outputs have
+been written to the derivatives, so that a run can be resumed without
+rebuilding and re-hashing the graph of the completed subjects.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+STAGES = ["preprocessing", "reconstruction", "segmentation", "surface"]
+
+# Stage whose outputs are written by each datasink of the pipelines
+SINK_STAGES = {
+    "preprocessing_datasink_denoised": "preprocessing",
+    "preprocessing_datasink_cropped": "preprocessing",
+    "final_recon_datasink": "reconstruction",
+    "final_seg_datasink": "segmentation",
+    "final_surf_datasink": "surface",
+}
+
+MANIFEST_NAME = "run_manifest.json"
+
+
+def stage_digests(cfg, stages=None):
+    """
+    Digest of the configuration of each stage of `cfg`. The digest of a
+    stage covers the configuration of the stages before it, so that
+    changing the preprocessing invalidates all the following stages.
+
+    Args:
+        cfg: Configuration object.
+        stages (list[str], optional): Stages to return (default: all).
+    Returns:
+        dict: {stage: digest} for the requested stages present in `cfg`.
+    """
+    from omegaconf import OmegaConf
+
+    digests = {}
+    sha = hashlib.sha256()
+    for stage in STAGES:
+        if stage not in cfg:
+            continue
+        sha.update(stage.encode())
+        sha.update(OmegaConf.to_yaml(cfg[stage], resolve=True).encode())
+        if stages is None or stage in stages:
+            digests[stage] = sha.copy().hexdigest()[:16]
+    return digests
+
+
+def subject_key(subject, session=None, acquisition=None):
+    """
+    Name of a (subject, session, acquisition) in the manifest.
+
+    Examples:
+        >>> subject_key("01", "02")
+        'sub-01_ses-02'
+        >>> subject_key("01", None, "haste")
+        'sub-01_acq-haste'
+    """
+    parts = [f"sub-{subject}"]
+    if session is not None:
+        parts.append(f"ses-{session}")
+    if acquisition is not None:
+        parts.append(f"acq-{acquisition}")
+    return "_".join(parts)
+
+
+class RunManifest:
+    """
+    Completion state of the subjects of a pipeline, stored as JSON.
+
+    Args:
+        path (str): Path to the manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.subjects = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.subjects = json.load(f).get("subjects", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"subjects": self.subjects}, f, indent=4)
+        os.replace(tmp, self.path)
+
+    def record(self, entities, stage, digest, outputs):
+        """
+        Record that `stage` was completed for a subject, now.
+
+        Args:
+            entities (tuple): (subject, session, acquisition).
+            stage (str): Stage name.
+            digest (str): Digest of the configuration of the stage.
+            outputs (list[str]): Files written to the derivatives.
+        """
+        entry = self.subjects.setdefault(
+            subject_key(*entities),
+            dict(zip(["subject", "session", "acquisition"], entities)),
+        )
+        stages = entry.setdefault("stages", {})
+        done = stages.get(stage)
+        if done is not None and done["digest"] == digest:
+            # Stages with several datasinks
+            outputs = set(outputs) | set(done["outputs"])
+        stages[stage] = {
+            "digest": digest,
+            "outputs": sorted(outputs),
+            "time": time.time(),
+        }
+
+    def update(self, other, entities):
+        """Copy the entry of a subject from another manifest."""
+        key = subject_key(*entities)
+        if key in other.subjects:
+            self.subjects[key] = other.subjects[key]
+
+    def is_complete(self, entities, digests, since=None):
+        """
+        Whether all the stages of `digests` were completed for a subject,
+        with the same configuration (and after the time `since`, if
+        given), and their outputs still exist.
+        """
+        entry = self.subjects.get(subject_key(*entities), {})
+        stages = entry.get("stages", {})
+        for stage, digest in digests.items():
+            done = stages.get(stage)
+            if (
+                done is None
+                or done["digest"] != digest
+                or not done["outputs"]
+                or not all(os.path.exists(f) for f in done["outputs"])
+                or (since is not None and done.get("time", 0) < since)
+            ):
+                return False
+        return True
+
+    def completed(self, digests):
+        """
+        Returns:
+            set: (subject, session, acquisition) of the complete subjects.
+        """
+        complete = set()
+        for entry in self.subjects.values():
+            entities = (
+                entry["subject"],
+                entry["session"],
+                entry["acquisition"],
+            )
+            if self.is_complete(entities, digests):
+                complete.add(entities)
+        return complete
+
+
+def _node_entities(node):
+    from fetpype.utils.logging import _iterable_context
+
+    ctx = {
+        k: (None if v == "None" else v)
+        for k, v in _iterable_context(node).items()
+    }
+    if ctx.get("subject") is None:
+        return None
+    return ctx["subject"], ctx.get("session"), ctx.get("acquisition")
+
+
+def _sink_outputs(node):
+    from nipype.utils.filemanip import loadpkl
+
+    result_file = os.path.join(node.output_dir(), f"result_{node.name}.pklz")
+    if not os.path.exists(result_file):
+        return []
+    out_file = loadpkl(result_file).outputs.out_file
+    if isinstance(out_file, str):
+        return [out_file]
+    return list(out_file or [])
+
+
+class ManifestRecorder:
+    """
+    MultiProc status callback recording in a `RunManifest` the stages
+    completed by each subject, when their datasinks finish.
+
+    Args:
+        manifest (RunManifest): Manifest to update.
+        digests (dict): Digest of each stage, from `stage_digests`.
+        status_callback (callable, optional): Callback called first.
+        autosave (bool): Whether to save the manifest after each record.
+    """
+
+    def __init__(self, manifest, digests, status_callback=None, autosave=True):
+        self.manifest = manifest
+        self.digests = digests
+        self.status_callback = status_callback
+        self.autosave = autosave
+
+    def __call__(self, node, status, **kwargs):
+        if self.status_callback is not None:
+            self.status_callback(node, status, **kwargs)
+        stage = SINK_STAGES.get(node.name)
+        if status != "end" or stage not in self.digests:
+            return
+        entities = _node_entities(node)
+        outputs = _sink_outputs(node)
+        if entities is None or not outputs:
+            return
+        self.manifest.record(entities, stage, self.digests[stage], outputs)
+        if self.autosave:
+            self.manifest.save()
+
+
+def get_manifest(workflow, pipeline_name=None):
+    """
+    Manifest of a pipeline in the working directory of `workflow`, which
+    may be shared by several pipelines.
+    """
+    name = MANIFEST_NAME
+    if pipeline_name is not None:
+        name = f"{pipeline_name}_{MANIFEST_NAME}"
+    return RunManifest(os.path.join(workflow.base_dir, workflow.name, name))
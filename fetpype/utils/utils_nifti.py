@@ -0,0 +1,183 @@
+import gzip
+import os
+import struct
+
+NIFTI_FORMATS = ["nii.gz", "nii"]
+
+
+def split_nifti_ext(path):
+    """
+    Split a NIfTI path into its stem and extension.
+
+    Examples:
+        >>> split_nifti_ext("/data/sub-01_T2w.nii.gz")
+        ('/data/sub-01_T2w', '.nii.gz')
+        >>> split_nifti_ext("sub-01_T2w.nii")
+        ('sub-01_T2w', '.nii')
+    """
+    for ext in (".nii.gz", ".nii"):
+        if path.endswith(ext):
+            return path[: -len(ext)], ext
+    return os.path.splitext(path)
+
+
+def with_nifti_format(path, output_format):
+    """
+    Replace the `.nii`/`.nii.gz` extension of a path (if any) by
+    `.<output_format>`.
+
+    Examples:
+        >>> with_nifti_format("sub-01_T2w.nii.gz", "nii")
+        'sub-01_T2w.nii'
+        >>> with_nifti_format("recon_clamped", "nii.gz")
+        'recon_clamped.nii.gz'
+    """
+    if output_format not in NIFTI_FORMATS:
+        raise ValueError(
+            f"Unknown NIfTI format {output_format}, "
+            f"please choose from {NIFTI_FORMATS}."
+        )
+    for ext in (".nii.gz", ".nii"):
+        if path.endswith(ext):
+            path = path[: -len(ext)]
+            break
+    return f"{path}.{output_format}"
+
+
+def save_nifti(img, path, compresslevel=None, threads=1):
+    """
+    Save a nibabel image. `.nii` files are written uncompressed and
+    `.nii.gz` files with the given gzip level (nibabel's default if None).
+    With more than one thread, `.nii.gz` files are compressed in blocks
+    on `threads` threads (see `fetpype.utils.utils_gzip`).
+
+    Args:
+        img (nibabel.Nifti1Image): Image to save.
+        path (str): Output path.
+        compresslevel (int, optional): gzip level, from 1 to 9.
+        threads (int): Number of compression threads.
+    Returns:
+        str: The output path.
+    """
+    import nibabel as nib
+    from fetpype.utils import utils_gzip
+
+    if not path.endswith(".nii.gz"):
+        nib.save(img, path)
+    elif threads > 1:
+        if compresslevel is None:
+            compresslevel = nib.openers.Opener.default_compresslevel
+        data = utils_gzip.compress(img.to_bytes(), compresslevel, threads)
+        with open(path, "wb") as f:
+            f.write(data)
+    elif compresslevel is not None:
+        with gzip.open(path, "wb", compresslevel=compresslevel) as f:
+            f.write(img.to_bytes())
+    else:
+        nib.save(img, path)
+    return path
+
+
+def load_nifti(path, threads=1):
+    """
+    Load a NIfTI image. With more than one thread, `.nii.gz` files are
+    decompressed in memory, on `threads` threads if they were written by
+    `save_nifti`.
+
+    Args:
+        path (str): Path to a `.nii` or `.nii.gz` file.
+        threads (int): Number of decompression threads.
+    Returns:
+        nibabel.Nifti1Image or nibabel.Nifti2Image: The image.
+    """
+    import nibabel as nib
+    from fetpype.utils import utils_gzip
+
+    if threads <= 1 or not path.endswith(".nii.gz"):
+        return nib.load(path)
+    with open(path, "rb") as f:
+        data = utils_gzip.decompress(f.read(), threads)
+    # sizeof_hdr is 348 for NIfTI-1 and 540 for NIfTI-2, in either byte order
+    if 540 in struct.unpack("<i", data[:4]) + struct.unpack(">i", data[:4]):
+        return nib.Nifti2Image.from_bytes(data)
+    return nib.Nifti1Image.from_bytes(data)
+
+
+def get_intermediate_format(cfg):
+    """
+    Read the format of the intermediate files from the configuration.
+
+    Intermediates (cropped and checked stacks, clamped reconstruction)
+    are written as `intermediate_format` (`nii.gz` by default, or `nii`
+    to skip compression), with gzip level `intermediate_compresslevel`.
+
+    Args:
+        cfg: Configuration object.
+    Returns:
+        dict: `output_format` and `compresslevel`, to be set as node
+              inputs.
+    """
+    output_format = cfg.get("intermediate_format", "nii.gz")
+    compresslevel = cfg.get("intermediate_compresslevel", None)
+    if output_format not in NIFTI_FORMATS:
+        raise ValueError(
+            f"Invalid intermediate_format: {output_format}. "
+            f"Please choose one of {NIFTI_FORMATS}"
+        )
+    if compresslevel is not None and not 1 <= compresslevel <= 9:
+        raise ValueError(
+            f"Invalid intermediate_compresslevel: {compresslevel}. "
+            "It should be between 1 and 9."
+        )
+    return {"output_format": output_format, "compresslevel": compresslevel}
+
+
+def get_nifti_threads(cfg):
+    """
+    Read `nifti_threads`, the number of threads used by fetpype's Python
+    nodes to compress and decompress `.nii.gz` files (1 by default). It
+    is set as the `n_procs` of these nodes, so that MultiProc accounts
+    for them.
+
+    Args:
+        cfg: Configuration object.
+    Returns:
+        int: Number of threads.
+    """
+    threads = cfg.get("nifti_threads", 1)
+    if not isinstance(threads, int) or threads < 1:
+        raise ValueError(
+            f"Invalid nifti_threads: {threads}. "
+            "It should be a positive integer."
+        )
+    return threads
+
+
+def ensure_nii_gz(in_file, compresslevel=None, num_threads=1):
+    """
+    Return `in_file` if it is gzipped, or a gzipped copy of it written
+    in the current directory. Used so that final outputs are `.nii.gz`
+    whatever the format of the intermediates.
+
+    Args:
+        in_file (str): Path to a NIfTI file.
+        compresslevel (int, optional): gzip level, from 1 to 9.
+        num_threads (int): Number of compression threads.
+    Returns:
+        str: Path to a `.nii.gz` file.
+    """
+    import os
+    from fetpype.utils.utils_nifti import (
+        load_nifti,
+        save_nifti,
+        with_nifti_format,
+    )
+
+    if in_file.endswith(".nii.gz"):
+        return in_file
+    out_file = os.path.abspath(
+        with_nifti_format(os.path.basename(in_file), "nii.gz")
+    )
+    return save_nifti(
+        load_nifti(in_file, num_threads), out_file, compresslevel, num_threads
+    )
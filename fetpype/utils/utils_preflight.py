@@ -0,0 +1,307 @@
+"""
+Preflight inventory of the input stacks and masks of a cohort, run before
+the workflow is built, so that the subjects whose inputs would make the
+preprocessing fail are found before any container runs.
+"""
+
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from fetpype.utils.utils_manifest import subject_key
+
+log = logging.getLogger("nipype.workflow")
+
+PREFLIGHT_MODES = ["off", "exclude", "abort"]
+
+INVENTORY_NAME = "preflight_inventory.json"
+
+
+def get_inventory_path(workflow, pipeline_name=None):
+    """
+    Path of the inventory of a pipeline in the working directory of
+    `workflow`, next to its run manifest.
+    """
+    name = INVENTORY_NAME
+    if pipeline_name is not None:
+        name = f"{pipeline_name}_{INVENTORY_NAME}"
+    return os.path.join(workflow.base_dir, workflow.name, name)
+
+
+def find_images(bids_dir, suffix):
+    """
+    NIfTI images with a given suffix in the subject folders of a BIDS
+    directory.
+
+    Args:
+        bids_dir (str): BIDS directory.
+        suffix (str): BIDS suffix of the images, e.g. "T2w".
+    Returns:
+        dict: {(sub, ses, acq): [paths]}, sorted by path.
+    """
+    from fetpype.utils.utils_bids import _entities
+
+    images = {}
+    pattern = re.compile(rf"_{suffix}\.nii(\.gz)?$")
+    for sub_dir in sorted(os.listdir(bids_dir)):
+        if not sub_dir.startswith("sub-"):
+            continue
+        for root, _, files in os.walk(os.path.join(bids_dir, sub_dir)):
+            if os.path.basename(root) != "anat":
+                continue
+            for f in files:
+                entities = _entities(f)
+                if entities is not None and pattern.search(f):
+                    images.setdefault(entities, []).append(
+                        os.path.join(root, f)
+                    )
+    return {k: sorted(v) for k, v in images.items()}
+
+
+def scan_image(path, read_data=False):
+    """
+    Header information of an image, without reading its data unless
+    `read_data`.
+
+    Args:
+        path (str): Path to the image.
+        read_data (bool): Whether to read the data to check that it is not
+                          empty (used for the masks).
+    Returns:
+        dict: File name, size, shape, voxel size, affine, orientation and
+              data type of the image (and whether it is empty), or the
+              error raised when reading it.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    info = {"path": path, "size": os.path.getsize(path)}
+    try:
+        img = nib.load(path)
+        shape = img.shape
+        if len(shape) > 3 and shape[-1] == 1:
+            # As the preprocessing, which squeezes trailing dimensions
+            shape = shape[:-1]
+        info.update(
+            shape=list(shape),
+            voxel_size=[float(z) for z in img.header["pixdim"][1:4]],
+            affine=np.round(img.affine, 6).tolist(),
+            orientation="".join(nib.aff2axcodes(img.affine)),
+            dtype=str(img.get_data_dtype()),
+        )
+        if read_data:
+            info["empty"] = not np.any(np.asanyarray(img.dataobj))
+    except Exception as e:
+        info["error"] = f"{type(e).__name__}: {e}"
+    return info
+
+
+def check_subject(stacks, masks=None, check_enabled=True):
+    """
+    Check the inputs of a subject as the preprocessing does.
+
+    Args:
+        stacks (list[dict]): `scan_image` of the stacks.
+        masks (list[dict], optional): `scan_image` of the masks, if they
+                                      are given as inputs.
+        check_enabled (bool): Whether the preprocessing checks the
+                              geometry of the stacks and masks.
+    Returns:
+        tuple: Errors, which make the preprocessing of the subject fail,
+               and warnings, e.g. stacks that will be discarded.
+    """
+    from fetpype.nodes.preprocessing import CheckAffineResStacksAndMasks
+    from fetpype.nodes.utils import get_run_id
+
+    errors, warnings = [], []
+    if not stacks:
+        return ["No stack found."], warnings
+    for info in stacks + (masks or []):
+        if "error" in info:
+            errors.append(f"Cannot read {info['path']}: {info['error']}")
+    if errors:
+        return errors, warnings
+    try:
+        runs = get_run_id([s["path"] for s in stacks])
+        mask_runs = None if masks is None else get_run_id(
+            [m["path"] for m in masks]
+        )
+    except ValueError as e:
+        return [str(e)], warnings
+
+    checker = CheckAffineResStacksAndMasks()
+    kept = 0
+    for stack, run in zip(stacks, runs):
+        name = os.path.basename(stack["path"])
+        if check_enabled:
+            try:
+                checker.check_inplane_pos(name, stack["voxel_size"])
+            except AssertionError as e:
+                errors.append(str(e))
+                continue
+        if masks is None:
+            kept += 1
+            continue
+        if run not in mask_runs:
+            errors.append(
+                f"Stack {name} has no corresponding mask "
+                f"(existing IDs: {mask_runs})."
+            )
+            continue
+        mask = masks[mask_runs.index(run)]
+        if mask["empty"]:
+            warnings.append(
+                f"Mask {os.path.basename(mask['path'])} is empty: the "
+                f"stack {name} will be discarded."
+            )
+            continue
+        if check_enabled and not checker.compare_resolution_affine(
+            stack["voxel_size"],
+            stack["affine"],
+            mask["voxel_size"],
+            mask["affine"],
+            stack["shape"],
+            mask["shape"],
+        ):
+            warnings.append(
+                f"Resolution/shape/affine mismatch between the stack {name} "
+                f"and its mask: the stack will be discarded."
+            )
+            continue
+        kept += 1
+    if not errors and kept == 0:
+        errors.append("All the stacks would be discarded.")
+    return errors, warnings
+
+
+def run_preflight(
+    entities,
+    data_dir,
+    masks_dir=None,
+    check_enabled=True,
+    inventory_path=None,
+    nthreads=8,
+):
+    """
+    Scan the input headers of a cohort on a thread pool, check each
+    subject with `check_subject` and write the inventory of the inputs.
+
+    Args:
+        entities (list[tuple]): (sub, ses, acq) of the subjects to run.
+        data_dir (str): BIDS directory of the stacks.
+        masks_dir (str, optional): BIDS directory of the masks, if they are
+                                   given as inputs.
+        check_enabled (bool): Whether the preprocessing checks the
+                              geometry of the stacks and masks.
+        inventory_path (str, optional): Where to write the inventory.
+        nthreads (int): Number of threads reading the headers.
+    Returns:
+        dict: Inventory, {subject key: {"entities", "stacks", "masks",
+              "errors", "warnings"}}.
+    """
+    stacks = find_images(data_dir, "T2w")
+    masks = find_images(masks_dir, "mask") if masks_dir else {}
+    jobs = [
+        (path, is_mask)
+        for ent in entities
+        for files, is_mask in [(stacks, False), (masks, True)]
+        for path in files.get(tuple(ent), [])
+    ]
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        scans = dict(
+            zip(
+                [path for path, _ in jobs],
+                pool.map(lambda job: scan_image(*job), jobs),
+            )
+        )
+
+    inventory = {}
+    for ent in entities:
+        ent = tuple(ent)
+        ent_stacks = [scans[p] for p in stacks.get(ent, [])]
+        ent_masks = None
+        if masks_dir:
+            ent_masks = [scans[p] for p in masks.get(ent, [])]
+        errors, warnings = check_subject(ent_stacks, ent_masks, check_enabled)
+        inventory[subject_key(*ent)] = {
+            "entities": list(ent),
+            "stacks": ent_stacks,
+            "masks": ent_masks or [],
+            "errors": errors,
+            "warnings": warnings,
+        }
+    if inventory_path is not None:
+        os.makedirs(os.path.dirname(inventory_path), exist_ok=True)
+        with open(inventory_path, "w") as f:
+            json.dump(inventory, f, indent=4)
+    return inventory
+
+
+def preflight_subjects(
+    datasource,
+    mode,
+    data_dir,
+    masks_dir=None,
+    check_enabled=True,
+    inventory_path=None,
+    nthreads=8,
+):
+    """
+    Run the preflight on the subjects of a datasource, and leave out the
+    subjects with errors ("exclude") or raise ("abort").
+
+    Args:
+        datasource (pe.Node): Datasource from `create_datasource`, whose
+                              iterables are updated.
+        mode (str): One of `PREFLIGHT_MODES`.
+        data_dir, masks_dir, check_enabled, inventory_path, nthreads:
+            See `run_preflight`.
+    Returns:
+        dict: Inventory, None if `mode` is "off".
+    """
+    if mode not in PREFLIGHT_MODES:
+        raise ValueError(
+            f"Invalid preflight mode {mode}, choose one of {PREFLIGHT_MODES}."
+        )
+    if mode == "off":
+        return None
+    entities = datasource.iterables[1]
+    inventory = run_preflight(
+        entities,
+        data_dir,
+        masks_dir,
+        check_enabled,
+        inventory_path,
+        nthreads,
+    )
+    bad = {}
+    for key, entry in inventory.items():
+        for warning in entry["warnings"]:
+            log.warning(f"Preflight {key}: {warning}")
+        if entry["errors"]:
+            bad[key] = entry["errors"]
+    if not bad:
+        log.info(
+            f"Preflight: the inputs of {len(inventory)} subject(s) are "
+            f"valid, inventory written to {inventory_path}."
+        )
+        return inventory
+    report = "\n".join(
+        f"  {key}: {' '.join(errors)}" for key, errors in bad.items()
+    )
+    if mode == "abort":
+        raise ValueError(
+            f"Preflight found invalid inputs for {len(bad)} subject(s):\n"
+            f"{report}\nInventory: {inventory_path}"
+        )
+    log.warning(
+        f"Preflight: excluding {len(bad)} subject(s) with invalid "
+        f"inputs:\n{report}"
+    )
+    datasource.iterables = (
+        datasource.iterables[0],
+        [e for e in entities if subject_key(*e) not in bad],
+    )
+    return inventory
@@ -0,0 +1,254 @@
+"""
+Disk-space-aware scheduling of the subjects of a run.
+"""
+
+import logging
+import os
+import re
+import shutil
+import time
+
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+log = logging.getLogger("nipype.workflow")
+
+GB = 1024**3
+
+
+def subject_input_size(parameterization, input_dirs):
+    """
+    Size of the input files of one subject.
+
+    Args:
+        parameterization (str): Directory of the iterable, e.g.
+                                "_session_01_subject_01".
+        input_dirs (list[str]): BIDS directories holding the inputs (data
+                                and masks).
+    Returns:
+        int: Total size, in bytes, of the files of the subject (and
+             session, if any) in `input_dirs`.
+    """
+    pairs = dict(re.findall(r"_(subject|session)_([^/_]+)", parameterization))
+    if "subject" not in pairs:
+        return 0
+    sub = pairs["subject"]
+    parts = [sub if sub.startswith("sub-") else f"sub-{sub}"]
+    ses = pairs.get("session")
+    if ses and ses != "None":
+        parts.append(ses if ses.startswith("ses-") else f"ses-{ses}")
+    size = 0
+    for input_dir in input_dirs:
+        if input_dir is None:
+            continue
+        for root, _, files in os.walk(os.path.join(input_dir, *parts)):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def workdir_usage(workflow_dir):
+    """
+    Disk usage of each subject in a nipype working directory, per stage.
+
+    Returns:
+        dict: {subject directory: {stage: bytes}}, where the stage is the
+              workflow holding the subject directory (e.g.
+              "Preprocessing").
+    """
+    usage = {}
+    for root, dirs, files in os.walk(workflow_dir):
+        rel = os.path.relpath(root, workflow_dir).split(os.sep)
+        for i, part in enumerate(rel):
+            if part.startswith("_") and "_subject_" in part:
+                stage = rel[i - 1] if i > 0 else "."
+                stages = usage.setdefault(part, {})
+                stages[stage] = stages.get(stage, 0) + sum(
+                    os.lstat(os.path.join(root, f)).st_size for f in files
+                )
+                break
+    return usage
+
+
+def _subject_key(node):
+    """Directory of the subject of a node, None outside of the iterables."""
+    if node.parameterization:
+        return node.parameterization[0]
+    # MapNode subnodes have no parameterization but run in the directory
+    # of their MapNode
+    for part in node.output_dir().split(os.sep):
+        if part.startswith("_") and "_subject_" in part:
+            return part
+    return None
+
+
+def _free_space(path):
+    """Free space of the volume of `path`, which may not exist yet."""
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+class DiskAwareMultiProcPlugin(MultiProcPlugin):
+    """
+    MultiProc plugin that only starts a new subject while the projected
+    free space of the working directory stays above a threshold.
+
+    The footprint of a subject is projected from the size of its inputs
+    and the expansion (work directory bytes per input byte) observed for
+    each stage on the subjects already processed, or `default_expansion`
+    until a subject has completed. The space still to be used by the
+    running subjects is subtracted from the current free space, and a new
+    subject is admitted only if its own footprint leaves more than
+    `min_free_gb`. Jobs of subjects already started are never held back.
+
+    Plugin args, on top of those of MultiProc:
+        min_free_gb (float): Free space (GB) to keep on the volume.
+        workflow_dir (str): Working directory of the main workflow.
+        input_dirs (list[str]): Directories of the inputs of the subjects.
+        default_expansion (float): Initial expansion ratio (default: 10).
+        refresh_interval (float): Minimum time (s) between two scans of
+                                  the working directory (default: 30).
+    """
+
+    def __init__(self, plugin_args=None):
+        super().__init__(plugin_args=plugin_args)
+        self.min_free = self.plugin_args.get("min_free_gb", 0) * GB
+        self.workflow_dir = self.plugin_args["workflow_dir"]
+        self.input_dirs = self.plugin_args.get("input_dirs", [])
+        self.default_expansion = self.plugin_args.get("default_expansion", 10)
+        self.refresh_interval = self.plugin_args.get("refresh_interval", 30)
+        self._keys = None
+        self._input_sizes = {}
+        self._expansion = {}
+        self._usage = {}
+        self._last_scan = None
+        self._deferred = None
+        self._admitted = set()
+
+    def _subject_keys(self):
+        # MapNode subnodes are appended to the jobs while running
+        if self._keys is None:
+            self._keys = []
+        for proc in self.procs[len(self._keys) :]:  # noqa: E203
+            self._keys.append(_subject_key(proc))
+        return self._keys
+
+    def _input_size(self, key):
+        if key not in self._input_sizes:
+            self._input_sizes[key] = subject_input_size(key, self.input_dirs)
+        return self._input_sizes[key]
+
+    def _scan(self):
+        now = time.monotonic()
+        if (
+            self._last_scan is not None
+            and now - self._last_scan < self.refresh_interval
+        ):
+            return
+        self._last_scan = now
+        if os.path.isdir(self.workflow_dir):
+            self._usage = workdir_usage(self.workflow_dir)
+        for key, stages in self._usage.items():
+            size = self._input_size(key)
+            if not size:
+                continue
+            for stage, used in stages.items():
+                ratio = used / size
+                if ratio > self._expansion.get(stage, 0):
+                    self._expansion[stage] = ratio
+
+    def projected_footprint(self, key, finished=True):
+        """Projected work directory footprint of a subject, in bytes."""
+        expansion = sum(self._expansion.values())
+        if not finished or not expansion:
+            expansion = max(expansion, self.default_expansion)
+        return self._input_size(key) * expansion
+
+    def _sort_jobs(self, jobids, scheduler="tsort"):
+        jobids = super()._sort_jobs(jobids, scheduler=scheduler)
+        keys = self._subject_keys()
+        started, remaining = set(), set()
+        for jobid, key in enumerate(keys):
+            if self.proc_done[jobid]:
+                started.add(key)
+            if not self.proc_done[jobid] or self.proc_pending[jobid]:
+                remaining.add(key)
+        finished = started - remaining - {None}
+        new = {keys[j] for j in jobids} - started - {None}
+        if not new:
+            return jobids
+
+        self._scan()
+        any_finished = bool(finished)
+        running = started - finished - {None}
+        committed = sum(
+            max(
+                self.projected_footprint(k, any_finished)
+                - sum(self._usage.get(k, {}).values()),
+                0,
+            )
+            for k in running
+        )
+        free = _free_space(self.workflow_dir)
+        available = free - committed - self.min_free
+        admitted = set()
+        for key in sorted(new):
+            footprint = self.projected_footprint(key, any_finished)
+            if footprint > available and (running or admitted):
+                continue
+            available -= footprint
+            admitted.add(key)
+            if key in self._admitted:
+                continue
+            self._admitted.add(key)
+            log.info(
+                f"Admitting {key}: projected footprint "
+                f"{footprint / GB:.2f} GB, free {free / GB:.2f} GB, "
+                f"committed to {len(running)} running subject(s) "
+                f"{committed / GB:.2f} GB, work directory usage "
+                f"{self._total_usage() / GB:.2f} GB."
+            )
+            if available < 0:
+                log.warning(
+                    f"{key} was started although its projected footprint "
+                    "exceeds the available space, as no other subject "
+                    "is running."
+                )
+        deferred = new - admitted
+        if deferred and deferred != self._deferred:
+            log.info(
+                f"Holding back {len(deferred)} subject(s) to keep "
+                f"{self.min_free / GB:.2f} GB free: free {free / GB:.2f} GB, "
+                f"committed {committed / GB:.2f} GB, work directory usage "
+                f"{self._total_usage() / GB:.2f} GB."
+            )
+        self._deferred = deferred
+        return [j for j in jobids if keys[j] not in deferred]
+
+    def _total_usage(self):
+        return sum(sum(stages.values()) for stages in self._usage.values())
+
+
+def get_plugin(workflow, plugin_args, min_free_gb=None, input_dirs=()):
+    """
+    Plugin used to run `workflow`: MultiProc, or MultiProc with disk-space
+    admission of the subjects if `min_free_gb` is set.
+
+    Args:
+        workflow (nipype.Workflow): Main workflow.
+        plugin_args (dict): Arguments of the MultiProc plugin.
+        min_free_gb (float, optional): Free space (GB) to keep on the
+                                       volume of the working directory.
+        input_dirs (list[str]): Directories of the inputs of the subjects.
+    Returns:
+        str or DiskAwareMultiProcPlugin: Plugin to give to `workflow.run`.
+    """
+    if min_free_gb is None:
+        return "MultiProc"
+    return DiskAwareMultiProcPlugin(
+        plugin_args={
+            **plugin_args,
+            "min_free_gb": min_free_gb,
+            "workflow_dir": os.path.join(workflow.base_dir, workflow.name),
+            "input_dirs": [d for d in input_dirs if d is not None],
+        }
+    )
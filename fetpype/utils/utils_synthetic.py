@@ -0,0 +1,119 @@
+"""
+Synthetic data for the tests and the benchmarks: stacks, BIDS cohorts,
+and commands running a stand-in for the containers.
+
+The stacks mimic `test_data/sub-simu001`: three thick-slice T2w runs
+per subject, with their brain masks stored in a `masks` derivative.
+"""
+
+import json
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+
+# (shape, zooms) of the runs of test_data/sub-simu001
+STACKS = [
+    ((99, 113, 36), (1.1, 1.1, 3.2)),
+    ((113, 100, 35), (1.1, 1.1, 3.2)),
+    ((99, 103, 40), (1.1, 1.1, 3.2)),
+]
+
+
+def make_stack(shape, zooms, rng, dtype=np.float64):
+    """
+    Create a synthetic stack: an ellipsoidal "brain" with some structure
+    and noise, placed in a larger field of view, and its binary mask.
+
+    Args:
+        shape (tuple): Shape of the stack.
+        zooms (tuple): Voxel size, in mm.
+        rng (np.random.Generator): Random generator.
+        dtype: Data type of the stack.
+    Returns:
+        tuple: The stack and the mask, as nibabel images.
+    """
+    grid = np.meshgrid(
+        *[np.linspace(-1, 1, n) for n in shape], indexing="ij"
+    )
+    radii = rng.uniform(0.45, 0.6, size=3)
+    center = rng.uniform(-0.1, 0.1, size=3)
+    dist = sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radii))
+    mask = dist <= 1
+
+    data = 100 * np.exp(-dist) * (1 + 0.3 * np.cos(8 * grid[0]))
+    data += rng.normal(0, 5, size=shape)
+    data[data < 0] = 0
+
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = -np.asarray(shape) * np.asarray(zooms) / 2
+    stack = nib.Nifti1Image(data.astype(dtype), affine)
+    stack.header.set_zooms(zooms)
+    mask_img = nib.Nifti1Image(mask.astype(dtype), affine)
+    mask_img.header.set_zooms(zooms)
+    return stack, mask_img
+
+
+def stub_cmd(inputs, outputs, sleep=0.0):
+    """
+    Command running `stub_container.py` in place of a container, with
+    fetpype tags, e.g. `stub_cmd("<input_stacks>", "<output_stacks>")`.
+
+    Args:
+        inputs (str): Tag (or paths) of the inputs.
+        outputs (str): Tag (or paths) of the outputs.
+        sleep (float): Time spent by each call, in seconds.
+    Returns:
+        str: The command.
+    """
+    stub = os.path.join(os.path.dirname(__file__), "stub_container.py")
+    return (
+        f"{sys.executable} {stub} --sleep {sleep} "
+        f"--inputs {inputs} --outputs {outputs}"
+    )
+
+
+def _write_description(path, name, derivative=False):
+    os.makedirs(path, exist_ok=True)
+    description = {"Name": name, "BIDSVersion": "1.8.0"}
+    if derivative:
+        description["GeneratedBy"] = [{"Name": "fetpype"}]
+    with open(os.path.join(path, "dataset_description.json"), "w") as f:
+        json.dump(description, f, indent=4)
+
+
+def generate_cohort(out_dir, n_subjects, seed=0, stacks=STACKS):
+    """
+    Write a synthetic BIDS dataset with `n_subjects` subjects, one
+    session each, and their masks in `<out_dir>/derivatives/masks`.
+    Stacks are generated once and reused across subjects, so that
+    large cohorts remain cheap to create.
+
+    Args:
+        out_dir (str): Root of the BIDS dataset to create.
+        n_subjects (int): Number of subjects.
+        seed (int): Seed of the random generator.
+        stacks (list): (shape, zooms) of each run.
+    Returns:
+        list: The subject labels.
+    """
+    rng = np.random.default_rng(seed)
+    images = [make_stack(shape, zooms, rng) for shape, zooms in stacks]
+    masks_dir = os.path.join(out_dir, "derivatives", "masks")
+    _write_description(out_dir, "fetpype synthetic cohort")
+    _write_description(masks_dir, "Synthetic masks", derivative=True)
+
+    subjects = [f"bench{i:03d}" for i in range(1, n_subjects + 1)]
+    rows = ["participant_id\tgestational_age"]
+    for i, sub in enumerate(subjects):
+        rows.append(f"sub-{sub}\t{20 + i % 18}")
+        for root, suffix, idx in ((out_dir, "T2w", 0), (masks_dir, "mask", 1)):
+            anat = os.path.join(root, f"sub-{sub}", "ses-01", "anat")
+            os.makedirs(anat, exist_ok=True)
+            for run, image in enumerate(images, start=1):
+                fname = f"sub-{sub}_ses-01_run-{run}_{suffix}.nii.gz"
+                nib.save(image[idx], os.path.join(anat, fname))
+    with open(os.path.join(out_dir, "participants.tsv"), "w") as f:
+        f.write("\n".join(rows) + "\n")
+    return subjects
@@ -0,0 +1,209 @@
+"""
+Management of the nipype working directory during a run.
+"""
+
+import fnmatch
+import logging
+import os
+
+CLEANUP_POLICIES = ["keep_all", "keep_final", "keep_none"]
+
+# Bookkeeping files kept when pruning a node directory: they are small,
+# and record which inputs each node was run with.
+_KEEP_PATTERNS = ["_0x*.json", "*.pklz", "report.rst"]
+
+
+def _is_bookkeeping(filename):
+    return any(fnmatch.fnmatch(filename, p) for p in _KEEP_PATTERNS)
+
+
+def _flatten(value):
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _flatten(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _flatten(v)
+    elif isinstance(value, str):
+        yield value
+
+
+def sunk_files(sink_dir):
+    """
+    List the files that a DataSink copied to the output directory.
+
+    Args:
+        sink_dir (str): Working directory of the DataSink node.
+    Returns:
+        set: Absolute paths of the files given to the DataSink.
+    """
+    from nipype.utils.filemanip import loadpkl
+
+    inputs_file = os.path.join(sink_dir, "_inputs.pklz")
+    if not os.path.exists(inputs_file):
+        return set()
+    outputs = loadpkl(inputs_file).get("_outputs", {})
+    return {os.path.abspath(f) for f in _flatten(outputs)}
+
+
+def get_workflow_dirs(workflow, workflow_dir=None):
+    """
+    Working directories of a workflow and of its sub-workflows, under which
+    nipype creates the parameterization directories of their nodes.
+
+    Args:
+        workflow (nipype.Workflow): Main workflow.
+        workflow_dir (str, optional): Working directory of `workflow`
+                                      (default: in its base directory).
+    Returns:
+        list[str]: Working directories, the one of `workflow` first.
+    """
+    import nipype.pipeline.engine as pe
+
+    if workflow_dir is None:
+        workflow_dir = os.path.join(workflow.base_dir, workflow.name)
+    dirs = [workflow_dir]
+    for node in workflow._graph.nodes():
+        if isinstance(node, pe.Workflow):
+            dirs += get_workflow_dirs(
+                node, os.path.join(workflow_dir, node.name)
+            )
+    return dirs
+
+
+def prune_workdir(workflow_dirs, parameterization, keep=()):
+    """
+    Delete the data files of one iterable (e.g. one subject) in nipype
+    working directories, keeping the hash file and report of each node.
+
+    Only the directories of the iterable in `workflow_dirs` are visited:
+    the directories of other workflows sharing the same base directory,
+    e.g. the stages of another pipeline or configuration, are left as is.
+
+    The result file of a node that lost some of its files is deleted too,
+    so that nipype runs that node again if it is needed by a later run,
+    instead of passing on paths to missing files.
+
+    Args:
+        workflow_dirs (list[str]): Working directories of the workflows,
+                                   from `get_workflow_dirs`.
+        parameterization (list[str]): Directories of the iterable,
+                                      e.g. ["_session_01_subject_01"].
+        keep (iterable): Paths of data files that should not be deleted.
+    Returns:
+        int: Number of bytes freed.
+    """
+    parts = list(parameterization)
+    if not parts:
+        # Not an iterable: this would delete the whole work directory
+        return 0
+    keep = {os.path.abspath(f) for f in keep}
+    freed = 0
+    pruned = set()
+    for workflow_dir in workflow_dirs:
+        top = os.path.join(workflow_dir, *parts)
+        for root, dirs, files in os.walk(top, topdown=False):
+            if any(os.path.join(root, d) in pruned for d in dirs):
+                pruned.add(root)
+            for name in files:
+                path = os.path.join(root, name)
+                if _is_bookkeeping(name) or path in keep:
+                    continue
+                try:
+                    size = os.lstat(path).st_size
+                    os.remove(path)
+                except OSError:
+                    continue
+                freed += size
+                pruned.add(root)
+            if root in pruned:
+                for name in fnmatch.filter(files, "result_*.pklz"):
+                    os.remove(os.path.join(root, name))
+            if not os.listdir(root):
+                os.rmdir(root)
+    return freed
+
+
+class WorkdirCleaner:
+    """
+    MultiProc status callback pruning the working directory of each
+    subject once all the datasinks of that subject have run.
+
+    With `keep_final`, the working copies of the files sent to the
+    datasinks are kept; with `keep_none`, only the bookkeeping files of
+    the nodes (hashes and reports) are. Subjects with a failed
+    node are left untouched, so that they can be inspected.
+
+    Args:
+        workflow_dirs (list[str]): Working directories of the workflows of
+                                   the run, from `get_workflow_dirs`.
+        sinks (list[str]): Names of the datasink nodes.
+        policy (str): One of `CLEANUP_POLICIES`.
+        status_callback (callable, optional): Callback called first,
+                                              e.g. `status_line`.
+    """
+
+    def __init__(self, workflow_dirs, sinks, policy, status_callback=None):
+        if policy not in CLEANUP_POLICIES:
+            raise ValueError(
+                f"Invalid cleanup policy: {policy}. "
+                f"Please choose one of {CLEANUP_POLICIES}"
+            )
+        self.workflow_dirs = list(workflow_dirs)
+        self.sinks = set(sinks)
+        self.policy = policy
+        self.status_callback = status_callback
+        self._done = {}
+
+    def __call__(self, node, status, **kwargs):
+        if self.status_callback is not None:
+            self.status_callback(node, status, **kwargs)
+        if self.policy == "keep_all" or node.name not in self.sinks:
+            return
+        if status != "end":
+            return
+        key = tuple(node.parameterization)
+        done = self._done.setdefault(key, {})
+        done[node.name] = node.output_dir()
+        if set(done) != self.sinks:
+            return
+        keep = set()
+        if self.policy == "keep_final":
+            for sink_dir in done.values():
+                keep |= sunk_files(sink_dir)
+        freed = prune_workdir(self.workflow_dirs, key, keep)
+        del self._done[key]
+        logging.getLogger("nipype.workflow").info(
+            f"Pruned the working directory of {'/'.join(key)} "
+            f"({self.policy}): {freed / 1e6:.1f} MB freed."
+        )
+
+
+def get_status_callback(workflow, policy="keep_all", status_callback=None):
+    """
+    Build the MultiProc status callback of `workflow`, pruning the working
+    directory of each subject according to `policy`.
+
+    Args:
+        workflow (nipype.Workflow): Main workflow, with its datasinks at
+                                    the top level.
+        policy (str): One of `CLEANUP_POLICIES`.
+        status_callback (callable, optional): Callback to wrap.
+    Returns:
+        callable: The status callback.
+    """
+    from nipype.interfaces.io import DataSink
+
+    if policy == "keep_all":
+        return status_callback
+    sinks = [
+        node.name
+        for node in workflow._graph.nodes()
+        if isinstance(getattr(node, "interface", None), DataSink)
+    ]
+    return WorkdirCleaner(
+        get_workflow_dirs(workflow),
+        sinks,
+        policy,
+        status_callback,
+    )
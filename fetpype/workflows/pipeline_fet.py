@@ -1,25 +1,11 @@
 import os
-import nipype.pipeline.engine as pe
-from fetpype.pipelines.full_pipeline import (
-    create_full_pipeline,
-)
-import nipype.interfaces.utility as niu
-from fetpype.utils.utils_bids import (
-    create_datasource,
-    create_bids_datasink,
-    create_description_file,
-)
-
-from fetpype.workflows.utils import (  # noqa: E402
-    get_default_parser,
-    init_and_load_cfg,
-    check_and_update_paths,
-    get_pipeline_name,
-    check_valid_pipeline,
-)
-from fetpype.utils.logging import setup_logging, status_line
+from functools import partial
+from fetpype.utils.utils_preflight import PREFLIGHT_MODES
+from fetpype.workflows.utils import get_default_parser
 import logging
 
+GRAPH_MODES = ["iterables", "per_subject"]
+
 
 def create_main_workflow(
     data_dir,
@@ -32,6 +18,13 @@ def create_main_workflow(
     cfg_path,
     nprocs,
     save_intermediates=False,
+    pin_containers=False,
+    retrieve_containers=False,
+    cleanup="keep_all",
+    min_free_gb=None,
+    resume=False,
+    graph_mode="iterables",
+    preflight="exclude",
     debug=False,
     verbose=False,
 ):
@@ -60,12 +53,78 @@ def create_main_workflow(
             parameters.
         nprocs (int):
             Number of processes to be launched by MultiProc.
+        pin_containers (bool):
+            Whether to pin and pre-warm the containers before building
+            the workflow.
+        retrieve_containers (bool):
+            Whether to retrieve the missing containers, without prompting,
+            before pinning them.
+        cleanup (str):
+            Cleanup policy of the nipype directory: "keep_all",
+            "keep_final" (keep the working copies of the outputs) or
+            "keep_none". With the last two, the data files of a subject
+            are deleted once its outputs have been written.
+        min_free_gb (float, optional):
+            If set, new subjects are only started while the projected
+            free space of the nipype directory stays above this value
+            (in GB).
+        resume (bool):
+            Whether to leave out the subjects recorded as complete in the
+            run manifest, with the same configuration and existing
+            outputs.
+        graph_mode (str):
+            "iterables" builds a single workflow iterating over the
+            subjects, run with MultiProc. "per_subject" builds one
+            workflow per subject, in a pool of `nprocs` processes each
+            running one subject at a time: the graph of the whole cohort
+            is never expanded, which is faster to start on large cohorts.
+        preflight (str):
+            Check of the input stacks and masks of all the subjects
+            before running: "off", "exclude" (leave out the subjects
+            whose inputs would make the preprocessing fail) or "abort"
+            (raise if there is any). The inventory of the inputs is
+            written next to the run manifest.
         debug (bool):
             Whether to enable debug mode.
         verbose (bool):
             Whether to enable verbose mode.
 
     """
+    import nipype.pipeline.engine as pe
+    from fetpype.utils.utils_bids import (
+        create_datasource,
+        create_description_file,
+    )
+    from fetpype.workflows.utils import (
+        WORKFLOW_NAME,
+        init_and_load_cfg,
+        check_and_update_paths,
+        get_pipeline_name,
+        check_valid_pipeline,
+        run_per_subject,
+    )
+    from fetpype.utils.logging import setup_logging, status_line
+    from fetpype.utils.utils_manifest import (
+        ManifestRecorder,
+        get_manifest,
+        stage_digests,
+    )
+    from fetpype.utils.utils_preflight import (
+        get_inventory_path,
+        preflight_subjects,
+    )
+    from fetpype.utils.utils_scheduler import get_plugin
+    from fetpype.utils.utils_workdir import get_status_callback
+    from fetpype.utils.utils_docker import pin_container_commands
+
+    if graph_mode not in GRAPH_MODES:
+        raise ValueError(
+            f"Invalid graph mode {graph_mode}, choose one of {GRAPH_MODES}."
+        )
+    if graph_mode == "per_subject" and min_free_gb is not None:
+        raise ValueError(
+            "min_free_gb is not supported with the per_subject graph mode."
+        )
 
     cfg = init_and_load_cfg(cfg_path)
     pipeline_name = get_pipeline_name(cfg)
@@ -97,11 +156,12 @@ def create_main_workflow(
         load_masks = True
 
     check_valid_pipeline(cfg)
+    if pin_containers or retrieve_containers:
+        pin_container_commands(cfg, retrieve_missing=retrieve_containers)
 
     # main_workflow
-    main_workflow = pe.Workflow(name=pipeline_name)
+    main_workflow = pe.Workflow(name=WORKFLOW_NAME)
     main_workflow.base_dir = nipype_dir
-    fet_pipe = create_full_pipeline(cfg, load_masks)
 
     output_query = {
         "stacks": {
@@ -117,6 +177,14 @@ def create_main_workflow(
             "extension": ["nii", ".nii.gz"],
         }
 
+    # Subjects completed by a previous run
+    manifest = get_manifest(main_workflow, pipeline_name)
+    stages = ["reconstruction", "segmentation", "surface"]
+    if save_intermediates:
+        stages.append("preprocessing")
+    digests = stage_digests(cfg, stages)
+    skip = manifest.completed(digests) if resume else None
+
     # datasource
     datasource = create_datasource(
         output_query,
@@ -126,7 +194,116 @@ def create_main_workflow(
         sessions,
         acquisitions,
         extra_derivatives=masks_dir,
+        # Each subject workflow would index the dataset again otherwise
+        save_db=graph_mode == "per_subject",
+        skip=skip,
+    )
+    if resume and not datasource.iterables[1]:
+        print("All the subjects are already complete, nothing to run.")
+        return
+
+    # Check the inputs of the subjects before running any of them
+    preflight_subjects(
+        datasource,
+        preflight,
+        data_dir,
+        masks_dir,
+        check_enabled=cfg.preprocessing.check_stacks_and_masks.enabled,
+        inventory_path=get_inventory_path(main_workflow, pipeline_name),
+    )
+    if not datasource.iterables[1]:
+        print("No subject with valid inputs, nothing to run.")
+        return
+
+    if save_intermediates:
+        datasink_path_intermediate = os.path.join(out_dir, "preprocessing")
+        os.makedirs(datasink_path_intermediate, exist_ok=True)
+        create_description_file(
+            datasink_path_intermediate, "preprocessing", cfg=cfg.reconstruction
+        )
+
+    connect = partial(
+        connect_main_workflow,
+        cfg=cfg,
+        out_dir=out_dir,
+        load_masks=load_masks,
+        save_intermediates=save_intermediates,
+    )
+    if graph_mode == "per_subject":
+        run_per_subject(
+            main_workflow,
+            datasource,
+            connect,
+            nprocs,
+            callback=partial(
+                _subject_status_callback,
+                pipeline_name=pipeline_name,
+                digests=digests,
+                cleanup=cleanup,
+            ),
+            on_done=partial(_record_subject, manifest),
+            save_graph=cfg.save_graph,
+        )
+        return
+
+    connect(main_workflow, datasource)
+
+    if cfg.save_graph:
+        main_workflow.write_graph(
+            graph2use="colored",
+            format="png",
+            simple_form=True,
+        )
+
+    plugin_args = {
+        "n_procs": nprocs,
+        "status_callback": ManifestRecorder(
+            manifest,
+            digests,
+            get_status_callback(main_workflow, cleanup, status_line),
+        ),
+    }
+    plugin = get_plugin(
+        main_workflow,
+        plugin_args,
+        min_free_gb,
+        input_dirs=[data_dir, masks_dir],
     )
+    main_workflow.run(plugin=plugin, plugin_args=plugin_args)
+
+
+def connect_main_workflow(
+    main_workflow,
+    datasource,
+    cfg,
+    out_dir,
+    load_masks=False,
+    save_intermediates=False,
+):
+    """
+    Connect the datasource, the full pipeline and the datasinks in
+    `main_workflow`.
+
+    Args:
+        main_workflow (pe.Workflow): Workflow to build.
+        datasource (pe.Node): Datasource from `create_datasource`.
+        cfg: Configuration object.
+        out_dir (str): Derivatives folder of the pipeline.
+        load_masks (bool): Whether the datasource provides masks.
+        save_intermediates (bool): Whether to save the preprocessed stacks
+            and masks in `<out_dir>/preprocessing`.
+    """
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as niu
+    from fetpype.pipelines.full_pipeline import (
+        create_full_pipeline,
+        get_slice_outliers,
+        stage_workflow_name,
+    )
+    from fetpype.utils.utils_bids import create_bids_datasink
+    from fetpype.workflows.utils import STAGES_WORKFLOW_NAME, get_pipeline_name
+
+    fet_pipe = create_full_pipeline(cfg, load_masks, name=STAGES_WORKFLOW_NAME)
 
     input_data = pe.Workflow(name="input")
 
@@ -154,10 +331,6 @@ def create_main_workflow(
     # Preprocessing data sink:
     if save_intermediates:
         datasink_path_intermediate = os.path.join(out_dir, "preprocessing")
-        os.makedirs(datasink_path_intermediate, exist_ok=True)
-        create_description_file(
-            datasink_path_intermediate, "preprocessing", cfg=cfg.reconstruction
-        )
 
         # Create a datasink for the preprocessing pipeline
         preprocessing_datasink_denoised = create_bids_datasink(
@@ -176,15 +349,16 @@ def create_main_workflow(
         )
 
         # Connect the pipeline to the datasinks
+        prepro_name = stage_workflow_name(cfg, "preprocessing")
         main_workflow.connect(
             fet_pipe,
-            "Preprocessing.outputnode.stacks",
+            f"{prepro_name}.outputnode.stacks",
             preprocessing_datasink_denoised,
             "@stacks",
         )
         main_workflow.connect(
             fet_pipe,
-            "Preprocessing.outputnode.masks",
+            f"{prepro_name}.outputnode.masks",
             preprocessing_datasink_masked,
             "@masks",
         )
@@ -221,6 +395,14 @@ def create_main_workflow(
     main_workflow.connect(
         fet_pipe, "outputnode.output_srr", recon_datasink, f"@{pipeline_name}"
     )
+    if get_slice_outliers(cfg.preprocessing)["outlier_zscore"] is not None:
+        # Slice reports of the stacks, next to their reconstruction
+        main_workflow.connect(
+            fet_pipe,
+            "outputnode.output_slice_reports",
+            recon_datasink,
+            "@slice_reports",
+        )
     main_workflow.connect(
         fet_pipe,
         "outputnode.output_seg",
@@ -241,20 +423,29 @@ def create_main_workflow(
         surf_datasink,
         "@surf_rh",
     )
+    return main_workflow
 
-    if cfg.save_graph:
-        main_workflow.write_graph(
-            graph2use="colored",
-            format="png",
-            simple_form=True,
-        )
 
-    main_workflow.run(
-        plugin="MultiProc",
-        plugin_args={"n_procs": nprocs, "status_callback": status_line},
+def _subject_status_callback(workflow, pipeline_name, digests, cleanup):
+    """Status callback of the workflow of a subject, in its worker."""
+    from fetpype.utils.logging import status_line
+    from fetpype.utils.utils_manifest import ManifestRecorder, get_manifest
+    from fetpype.utils.utils_workdir import get_status_callback
+
+    # The main process saves the manifest when the subject is done
+    return ManifestRecorder(
+        get_manifest(workflow, pipeline_name),
+        digests,
+        get_status_callback(workflow, cleanup, status_line),
+        autosave=False,
     )
 
 
+def _record_subject(manifest, entities, status_callback):
+    manifest.update(status_callback.manifest, entities)
+    manifest.save()
+
+
 def main():
     parser = get_default_parser(
         "Run the entire Fetpype pipeline -- "
@@ -268,6 +459,30 @@ def main():
         default=None,
         help="Path to the directory containing the masks.",
     )
+    parser.add_argument(
+        "--preflight",
+        default="exclude",
+        choices=PREFLIGHT_MODES,
+        help=(
+            "Check the headers of the input stacks and masks of all the "
+            "subjects before running, and write their inventory to the "
+            "nipype directory. exclude: leave out the subjects whose "
+            "inputs would make the preprocessing fail. abort: stop if "
+            "there is any (default: exclude)."
+        ),
+    )
+
+    parser.add_argument(
+        "--graph_mode",
+        default="iterables",
+        choices=GRAPH_MODES,
+        help=(
+            "iterables: a single workflow iterating over the subjects. "
+            "per_subject: one workflow per subject, --nprocs subjects at "
+            "a time, each running its steps one after the other; faster "
+            "to start on large cohorts (default: iterables)."
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -284,6 +499,13 @@ def main():
         cfg_path=args.cfg_path,
         nprocs=args.nprocs,
         save_intermediates=args.save_intermediates,
+        pin_containers=args.pin_containers,
+        retrieve_containers=args.retrieve_containers,
+        cleanup=args.cleanup,
+        min_free_gb=args.min_free_gb,
+        resume=args.resume,
+        preflight=args.preflight,
+        graph_mode=args.graph_mode,
         debug=args.debug,
         verbose=args.verbose,
     )
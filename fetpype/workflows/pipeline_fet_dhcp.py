@@ -49,15 +49,6 @@ import os
 import os.path as op
 import json
 import argparse
-import nipype.pipeline.engine as pe
-import nipype.interfaces.utility as niu
-from nipype.interfaces import fsl
-from fetpype.pipelines.full_pipelines import (
-    create_dhcp_subpipe,
-)
-from fetpype.utils.utils_bids import create_datasource, get_gestational_age
-
-fsl.FSLCommand.set_default_output_type("NIFTI_GZ")
 
 ###############################################################################
 
@@ -107,6 +98,17 @@ def create_main_workflow(
     Returns:
         workflow: nipype.pipeline.engine.Workflow
     """
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as niu
+    from nipype.interfaces import fsl
+    from fetpype.pipelines.full_pipeline import create_dhcp_subpipe
+    from fetpype.utils.utils_bids import (
+        create_datasource,
+        get_gestational_age,
+        load_participants_index,
+    )
+
+    fsl.FSLCommand.set_default_output_type("NIFTI_GZ")
 
     # formating args
     data_dir = op.abspath(data_dir)
@@ -177,7 +179,7 @@ def create_main_workflow(
     # Create a node to get the gestational age
     gestational_age = pe.Node(
         interface=niu.Function(
-            input_names=["bids_dir", "T2"],
+            input_names=["bids_dir", "T2", "participants"],
             output_names=["gestational_age"],
             function=get_gestational_age,
         ),
@@ -186,6 +188,8 @@ def create_main_workflow(
 
     main_workflow.connect(sl_t2, "out", gestational_age, "T2")
     gestational_age.inputs.bids_dir = data_dir
+    # Parsed once here rather than by every subject's node
+    gestational_age.inputs.participants = load_participants_index(data_dir)
 
     # Connect the gestational age
     main_workflow.connect(
@@ -1,23 +1,6 @@
 import os
-import nipype.pipeline.engine as pe
-from fetpype.pipelines.full_pipeline import (
-    create_rec_pipeline,
-)
-from fetpype.utils.utils_bids import (
-    create_datasource,
-    create_bids_datasink,
-    create_description_file,
-)
-
-
-from fetpype.workflows.utils import (
-    init_and_load_cfg,
-    check_and_update_paths,
-    get_pipeline_name,
-    get_default_parser,
-    check_valid_pipeline,
-)
-from fetpype.utils.logging import setup_logging, status_line
+from fetpype.utils.utils_preflight import PREFLIGHT_MODES
+from fetpype.workflows.utils import get_default_parser
 
 ###############################################################################
 
@@ -32,6 +15,13 @@ def create_rec_workflow(
     acquisitions,
     cfg_path,
     nprocs,
+    pin_containers=False,
+    retrieve_containers=False,
+    cleanup="keep_all",
+    min_free_gb=None,
+    resume=False,
+    incremental=False,
+    preflight="exclude",
     debug=False,
     verbose=False,
 ):
@@ -62,11 +52,72 @@ def create_rec_workflow(
             parameters.
         nprocs (int):
             Number of processes to be launched by MultiProc.
+        pin_containers (bool):
+            Whether to pin and pre-warm the containers before building
+            the workflow.
+        retrieve_containers (bool):
+            Whether to retrieve the missing containers, without prompting,
+            before pinning them.
+        cleanup (str):
+            Cleanup policy of the nipype directory: "keep_all",
+            "keep_final" (keep the working copies of the outputs) or
+            "keep_none". With the last two, the data files of a subject
+            are deleted once its outputs have been written.
+        min_free_gb (float, optional):
+            If set, new subjects are only started while the projected
+            free space of the nipype directory stays above this value
+            (in GB).
+        resume (bool):
+            Whether to leave out the subjects recorded as complete in the
+            run manifest, with the same configuration and existing
+            outputs.
+        incremental (bool):
+            Whether to leave out the subjects recorded as complete in the
+            run manifest, with the same configuration, after the last
+            change of their inputs, and with existing outputs.
+        preflight (str):
+            Check of the input stacks and masks of all the subjects
+            before running: "off", "exclude" (leave out the subjects
+            whose inputs would make the preprocessing fail) or "abort"
+            (raise if there is any). The inventory of the inputs is
+            written next to the run manifest.
         debug (bool):
             Whether to enable debug mode.
         verbose (bool):
             Whether to enable verbose mode.
     """
+    import nipype.pipeline.engine as pe
+    from fetpype.pipelines.full_pipeline import (
+        create_rec_pipeline,
+        get_slice_outliers,
+    )
+    from fetpype.utils.utils_bids import (
+        create_datasource,
+        create_bids_datasink,
+        create_description_file,
+        get_up_to_date_subjects,
+    )
+    from fetpype.workflows.utils import (
+        STAGES_WORKFLOW_NAME,
+        WORKFLOW_NAME,
+        init_and_load_cfg,
+        check_and_update_paths,
+        get_pipeline_name,
+        check_valid_pipeline,
+    )
+    from fetpype.utils.logging import setup_logging, status_line
+    from fetpype.utils.utils_manifest import (
+        ManifestRecorder,
+        get_manifest,
+        stage_digests,
+    )
+    from fetpype.utils.utils_preflight import (
+        get_inventory_path,
+        preflight_subjects,
+    )
+    from fetpype.utils.utils_scheduler import get_plugin
+    from fetpype.utils.utils_workdir import get_status_callback
+    from fetpype.utils.utils_docker import pin_container_commands
 
     cfg = init_and_load_cfg(cfg_path)
 
@@ -92,12 +143,20 @@ def create_rec_workflow(
         masks_dir = os.path.abspath(masks_dir)
         load_masks = True
     check_valid_pipeline(cfg)
+    if pin_containers or retrieve_containers:
+        pin_container_commands(
+            cfg,
+            sections=["preprocessing", "reconstruction"],
+            retrieve_missing=retrieve_containers,
+        )
     # if general, pipeline is not in params ,create it and set it to niftymic
 
     # main_workflow
-    main_workflow = pe.Workflow(name=pipeline_name)
+    main_workflow = pe.Workflow(name=WORKFLOW_NAME)
     main_workflow.base_dir = nipype_dir
-    fet_pipe = create_rec_pipeline(cfg, load_masks)
+    fet_pipe = create_rec_pipeline(
+        cfg, load_masks, name=STAGES_WORKFLOW_NAME
+    )
 
     output_query = {
         "stacks": {
@@ -113,6 +172,15 @@ def create_rec_workflow(
             "extension": ["nii", ".nii.gz"],
         }
 
+    # Subjects completed by a previous run
+    manifest = get_manifest(main_workflow, pipeline_name)
+    digests = stage_digests(cfg, ["reconstruction"])
+    skip = manifest.completed(digests) if resume else None
+    if incremental:
+        skip = (skip or set()) | get_up_to_date_subjects(
+            manifest, [data_dir, masks_dir], digests
+        )
+
     # datasource
     datasource = create_datasource(
         output_query,
@@ -122,7 +190,24 @@ def create_rec_workflow(
         sessions,
         acquisitions,
         extra_derivatives=masks_dir,
+        skip=skip,
     )
+    if (resume or incremental) and not datasource.iterables[1]:
+        print("All the subjects are already complete, nothing to run.")
+        return
+
+    # Check the inputs of the subjects before running any of them
+    preflight_subjects(
+        datasource,
+        preflight,
+        data_dir,
+        masks_dir,
+        check_enabled=cfg.preprocessing.check_stacks_and_masks.enabled,
+        inventory_path=get_inventory_path(main_workflow, pipeline_name),
+    )
+    if not datasource.iterables[1]:
+        print("No subject with valid inputs, nothing to run.")
+        return
     main_workflow.connect(datasource, "stacks", fet_pipe, "inputnode.stacks")
     if load_masks:
         main_workflow.connect(datasource, "masks", fet_pipe, "inputnode.masks")
@@ -131,7 +216,12 @@ def create_rec_workflow(
 
     # Reconstruction data sink:
     pipeline_name = cfg.reconstruction.pipeline
-    create_description_file(out_dir, pipeline_name, cfg=cfg.reconstruction)
+    create_description_file(
+        out_dir,
+        pipeline_name,
+        cfg=cfg.reconstruction,
+        digest=digests["reconstruction"],
+    )
 
     datasink = create_bids_datasink(
         out_dir=out_dir,
@@ -146,6 +236,14 @@ def create_rec_workflow(
     main_workflow.connect(
         fet_pipe, "outputnode.output_srr", datasink, f"@{pipeline_name}"
     )
+    if get_slice_outliers(cfg.preprocessing)["outlier_zscore"] is not None:
+        # Slice reports of the stacks, next to their reconstruction
+        main_workflow.connect(
+            fet_pipe,
+            "outputnode.output_slice_reports",
+            datasink,
+            "@slice_reports",
+        )
 
     if cfg.save_graph:
         main_workflow.write_graph(
@@ -154,10 +252,21 @@ def create_rec_workflow(
             simple_form=True,
         )
 
-    main_workflow.run(
-        plugin="MultiProc",
-        plugin_args={"n_procs": nprocs, "status_callback": status_line},
+    plugin_args = {
+        "n_procs": nprocs,
+        "status_callback": ManifestRecorder(
+            manifest,
+            digests,
+            get_status_callback(main_workflow, cleanup, status_line),
+        ),
+    }
+    plugin = get_plugin(
+        main_workflow,
+        plugin_args,
+        min_free_gb,
+        input_dirs=[data_dir, masks_dir],
     )
+    main_workflow.run(plugin=plugin, plugin_args=plugin_args)
 
 
 def main():
@@ -173,6 +282,28 @@ def main():
         default=None,
         help="Path to the BIDS directory that contains brain masks.",
     )
+    parser.add_argument(
+        "--preflight",
+        default="exclude",
+        choices=PREFLIGHT_MODES,
+        help=(
+            "Check the headers of the input stacks and masks of all the "
+            "subjects before running, and write their inventory to the "
+            "nipype directory. exclude: leave out the subjects whose "
+            "inputs would make the preprocessing fail. abort: stop if "
+            "there is any (default: exclude)."
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only process the subjects that are not recorded as complete "
+            "in the run manifest, or whose outputs are missing, or that "
+            "were completed before the last change of their inputs or "
+            "of the configuration."
+        ),
+    )
     args = parser.parse_args()
 
     # main_workflow
@@ -187,6 +318,13 @@ def main():
         acquisitions=args.acq,
         cfg_path=args.cfg_path,
         nprocs=args.nprocs,
+        pin_containers=args.pin_containers,
+        retrieve_containers=args.retrieve_containers,
+        cleanup=args.cleanup,
+        min_free_gb=args.min_free_gb,
+        resume=args.resume,
+        preflight=args.preflight,
+        incremental=args.incremental,
         debug=args.debug,
         verbose=args.verbose,
     )
@@ -1,23 +1,7 @@
 import os
 import json
-import nipype.pipeline.engine as pe
-from fetpype.pipelines.full_pipeline import (
-    create_seg_pipeline,
-)
-from fetpype.utils.utils_bids import (
-    create_datasource,
-    create_bids_datasink,
-    create_description_file,
-)
 from fetpype import VALID_RECONSTRUCTION
-from fetpype.workflows.utils import (
-    init_and_load_cfg,
-    check_and_update_paths,
-    get_pipeline_name,
-    get_default_parser,
-    check_valid_pipeline,
-)
-from fetpype.utils.logging import setup_logging, status_line
+from fetpype.workflows.utils import get_default_parser
 
 ###############################################################################
 
@@ -32,6 +16,12 @@ def create_seg_workflow(
     cfg_path,
     nprocs,
     ignore_checks=False,
+    pin_containers=False,
+    retrieve_containers=False,
+    cleanup="keep_all",
+    min_free_gb=None,
+    resume=False,
+    incremental=False,
     debug=False,
     verbose=False,
 ):
@@ -60,11 +50,60 @@ def create_seg_workflow(
             parameters.
         nprocs (int):
             Number of processes to be launched by MultiProc.
+        pin_containers (bool):
+            Whether to pin and pre-warm the containers before building
+            the workflow.
+        retrieve_containers (bool):
+            Whether to retrieve the missing containers, without prompting,
+            before pinning them.
+        cleanup (str):
+            Cleanup policy of the nipype directory: "keep_all",
+            "keep_final" (keep the working copies of the outputs) or
+            "keep_none". With the last two, the data files of a subject
+            are deleted once its outputs have been written.
+        min_free_gb (float, optional):
+            If set, new subjects are only started while the projected
+            free space of the nipype directory stays above this value
+            (in GB).
+        resume (bool):
+            Whether to leave out the subjects recorded as complete in the
+            run manifest, with the same configuration and existing
+            outputs.
+        incremental (bool):
+            Whether to leave out the subjects recorded as complete in the
+            run manifest, with the same configuration, after the last
+            change of their inputs, and with existing outputs.
         debug (bool):
             Whether to enable debug mode.
         verbose (bool):
             Whether to enable verbose mode.
     """
+    import nipype.pipeline.engine as pe
+    from fetpype.pipelines.full_pipeline import create_seg_pipeline
+    from fetpype.utils.utils_bids import (
+        create_datasource,
+        create_bids_datasink,
+        create_description_file,
+        get_up_to_date_subjects,
+    )
+    from fetpype.workflows.utils import (
+        STAGES_WORKFLOW_NAME,
+        WORKFLOW_NAME,
+        init_and_load_cfg,
+        check_and_update_paths,
+        get_pipeline_name,
+        check_valid_pipeline,
+    )
+    from fetpype.utils.logging import setup_logging, status_line
+    from fetpype.utils.utils_manifest import (
+        ManifestRecorder,
+        get_manifest,
+        stage_digests,
+    )
+    from fetpype.utils.utils_scheduler import get_plugin
+    from fetpype.utils.utils_workdir import get_status_callback
+    from fetpype.utils.utils_docker import pin_container_commands
+
     cfg = init_and_load_cfg(cfg_path)
     pipeline_name = get_pipeline_name(cfg, only_seg=True)
     data_dir, out_dir, nipype_dir = check_and_update_paths(
@@ -79,6 +118,12 @@ def create_seg_workflow(
     )
 
     check_valid_pipeline(cfg)
+    if pin_containers or retrieve_containers:
+        pin_container_commands(
+            cfg,
+            sections=["segmentation"],
+            retrieve_missing=retrieve_containers,
+        )
     # if general, pipeline is not in params ,create it and set it to niftymic
 
     data_desc = os.path.join(data_dir, "dataset_description.json")
@@ -103,9 +148,9 @@ def create_seg_workflow(
                 "Please provide a valid BIDS directory."
             )
     # main_workflow
-    main_workflow = pe.Workflow(name=pipeline_name)
+    main_workflow = pe.Workflow(name=WORKFLOW_NAME)
     main_workflow.base_dir = nipype_dir
-    fet_pipe = create_seg_pipeline(cfg)
+    fet_pipe = create_seg_pipeline(cfg, name=STAGES_WORKFLOW_NAME)
 
     output_query = {
         "srr_volume": {
@@ -115,6 +160,15 @@ def create_seg_workflow(
         }
     }
 
+    # Subjects completed by a previous run
+    manifest = get_manifest(main_workflow, pipeline_name)
+    digests = stage_digests(cfg, ["segmentation"])
+    skip = manifest.completed(digests) if resume else None
+    if incremental:
+        skip = (skip or set()) | get_up_to_date_subjects(
+            manifest, [data_dir], digests
+        )
+
     # datasource
     datasource = create_datasource(
         output_query,
@@ -123,7 +177,11 @@ def create_seg_workflow(
         subjects,
         sessions,
         acquisitions,
+        skip=skip,
     )
+    if (resume or incremental) and not datasource.iterables[1]:
+        print("All the subjects are already complete, nothing to run.")
+        return
 
     # in both cases we connect datsource outputs to main pipeline
     main_workflow.connect(
@@ -147,7 +205,11 @@ def create_seg_workflow(
         prev_desc = None
 
     create_description_file(
-        out_dir, pipeline_name, prev_desc, cfg.segmentation
+        out_dir,
+        pipeline_name,
+        prev_desc,
+        cfg.segmentation,
+        digest=digests["segmentation"],
     )
     # Create another datasink for the segmentation pipeline
     seg_datasink = create_bids_datasink(
@@ -171,10 +233,18 @@ def create_seg_workflow(
             format="png",
             simple_form=True,
         )
-    main_workflow.run(
-        plugin="MultiProc",
-        plugin_args={"n_procs": nprocs, "status_callback": status_line},
+    plugin_args = {
+        "n_procs": nprocs,
+        "status_callback": ManifestRecorder(
+            manifest,
+            digests,
+            get_status_callback(main_workflow, cleanup, status_line),
+        ),
+    }
+    plugin = get_plugin(
+        main_workflow, plugin_args, min_free_gb, input_dirs=[data_dir]
     )
+    main_workflow.run(plugin=plugin, plugin_args=plugin_args)
 
 
 def main():
@@ -189,6 +259,16 @@ def main():
             f"{', '.join(VALID_RECONSTRUCTION)}."
         ),
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only process the subjects that are not recorded as complete "
+            "in the run manifest, or whose outputs are missing, or that "
+            "were completed before the last change of their inputs or "
+            "of the configuration."
+        ),
+    )
     args = parser.parse_args()
 
     # main_workflow
@@ -203,6 +283,12 @@ def main():
         cfg_path=args.cfg_path,
         nprocs=args.nprocs,
         ignore_checks=args.ignore_checks,
+        pin_containers=args.pin_containers,
+        retrieve_containers=args.retrieve_containers,
+        cleanup=args.cleanup,
+        min_free_gb=args.min_free_gb,
+        resume=args.resume,
+        incremental=args.incremental,
         debug=args.debug,
         verbose=args.verbose,
     )
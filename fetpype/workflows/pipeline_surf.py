@@ -1,23 +1,7 @@
 import os
 import json
-import nipype.pipeline.engine as pe
-from fetpype.pipelines.full_pipeline import (
-    create_surf_pipeline,
-)
-from fetpype.utils.utils_bids import (
-    create_datasource,
-    create_bids_datasink,
-    create_description_file,
-)
 from fetpype import VALID_SEGMENTATION
-from fetpype.workflows.utils import (
-    init_and_load_cfg,
-    check_and_update_paths,
-    get_pipeline_name,
-    get_default_parser,
-    check_valid_pipeline,
-)
-from fetpype.utils.logging import setup_logging, status_line
+from fetpype.workflows.utils import get_default_parser
 
 ###############################################################################
 
@@ -32,6 +16,11 @@ def create_surf_workflow(
     cfg_path,
     nprocs,
     ignore_checks=False,
+    pin_containers=False,
+    retrieve_containers=False,
+    cleanup="keep_all",
+    min_free_gb=None,
+    resume=False,
     debug=False,
     verbose=False,
 ):
@@ -61,11 +50,54 @@ def create_surf_workflow(
             parameters.
         nprocs (int):
             Number of processes to be launched by MultiProc.
+        pin_containers (bool):
+            Whether to pin and pre-warm the containers before building
+            the workflow.
+        retrieve_containers (bool):
+            Whether to retrieve the missing containers, without prompting,
+            before pinning them.
+        cleanup (str):
+            Cleanup policy of the nipype directory: "keep_all",
+            "keep_final" (keep the working copies of the outputs) or
+            "keep_none". With the last two, the data files of a subject
+            are deleted once its outputs have been written.
+        min_free_gb (float, optional):
+            If set, new subjects are only started while the projected
+            free space of the nipype directory stays above this value
+            (in GB).
+        resume (bool):
+            Whether to leave out the subjects recorded as complete in the
+            run manifest, with the same configuration and existing
+            outputs.
         debug (bool):
             Whether to enable debug mode.
         verbose (bool):
             Whether to enable verbose mode.
     """
+    import nipype.pipeline.engine as pe
+    from fetpype.pipelines.full_pipeline import create_surf_pipeline
+    from fetpype.utils.utils_bids import (
+        create_datasource,
+        create_bids_datasink,
+        create_description_file,
+    )
+    from fetpype.workflows.utils import (
+        STAGES_WORKFLOW_NAME,
+        WORKFLOW_NAME,
+        init_and_load_cfg,
+        check_and_update_paths,
+        get_pipeline_name,
+        check_valid_pipeline,
+    )
+    from fetpype.utils.logging import setup_logging, status_line
+    from fetpype.utils.utils_manifest import (
+        ManifestRecorder,
+        get_manifest,
+        stage_digests,
+    )
+    from fetpype.utils.utils_scheduler import get_plugin
+    from fetpype.utils.utils_workdir import get_status_callback
+    from fetpype.utils.utils_docker import pin_container_commands
 
     cfg = init_and_load_cfg(cfg_path)
     pipeline_name = get_pipeline_name(cfg, only_surf=True)
@@ -81,6 +113,12 @@ def create_surf_workflow(
     )
 
     check_valid_pipeline(cfg)
+    if pin_containers or retrieve_containers:
+        pin_container_commands(
+            cfg,
+            sections=["surface"],
+            retrieve_missing=retrieve_containers,
+        )
     # if general, pipeline is not in params ,create it and set it to niftymic
 
     data_desc = os.path.join(data_dir, "dataset_description.json")
@@ -110,9 +148,9 @@ def create_surf_workflow(
                 "Please provide a valid BIDS directory."
             )
     # main_workflow
-    main_workflow = pe.Workflow(name=pipeline_name)
+    main_workflow = pe.Workflow(name=WORKFLOW_NAME)
     main_workflow.base_dir = nipype_dir
-    fet_pipe = create_surf_pipeline(cfg)
+    fet_pipe = create_surf_pipeline(cfg, name=STAGES_WORKFLOW_NAME)
 
     output_query = {
         "seg_volume": {
@@ -122,6 +160,11 @@ def create_surf_workflow(
         }
     }
 
+    # Subjects completed by a previous run
+    manifest = get_manifest(main_workflow, pipeline_name)
+    digests = stage_digests(cfg, ["surface"])
+    skip = manifest.completed(digests) if resume else None
+
     # datasource
     datasource = create_datasource(
         output_query,
@@ -131,7 +174,11 @@ def create_surf_workflow(
         sessions,
         acquisitions,
         save_db=True,
+        skip=skip,
     )
+    if resume and not datasource.iterables[1]:
+        print("All the subjects are already complete, nothing to run.")
+        return
 
     # in both cases we connect datsource outputs to main pipeline
     main_workflow.connect(
@@ -176,10 +223,18 @@ def create_surf_workflow(
             simple_form=True,
         )
 
-    main_workflow.run(
-        plugin="MultiProc",
-        plugin_args={"n_procs": nprocs, "status_callback": status_line},
+    plugin_args = {
+        "n_procs": nprocs,
+        "status_callback": ManifestRecorder(
+            manifest,
+            digests,
+            get_status_callback(main_workflow, cleanup, status_line),
+        ),
+    }
+    plugin = get_plugin(
+        main_workflow, plugin_args, min_free_gb, input_dirs=[data_dir]
     )
+    main_workflow.run(plugin=plugin, plugin_args=plugin_args)
 
 
 def main():
@@ -209,6 +264,11 @@ def main():
         cfg_path=args.cfg_path,
         nprocs=args.nprocs,
         ignore_checks=args.ignore_checks,
+        pin_containers=args.pin_containers,
+        retrieve_containers=args.retrieve_containers,
+        cleanup=args.cleanup,
+        min_free_gb=args.min_free_gb,
+        resume=args.resume,
         debug=args.debug,
         verbose=args.verbose,
     )
@@ -1,9 +1,14 @@
 import argparse
-import hydra
+import logging
 import os
-from omegaconf import OmegaConf
 from pathlib import Path
 
+# Name of the main workflow of every pipeline, and of the workflow holding
+# their stages. The working directory of a stage thus only depends on its
+# configuration (see `stage_workflow_name`), not on the pipeline running it.
+WORKFLOW_NAME = "fetpype"
+STAGES_WORKFLOW_NAME = "stages"
+
 
 def get_default_parser(desc):
 
@@ -104,6 +109,67 @@ def get_default_parser(desc):
         help="Save intermediate files.",
     )
 
+    parser.add_argument(
+        "--cleanup",
+        dest="cleanup",
+        default="keep_all",
+        choices=["keep_all", "keep_final", "keep_none"],
+        help=(
+            "Cleanup of the nipype directory during the run. Once the "
+            "outputs of a subject are written, keep_final deletes its "
+            "intermediate files except the working copies of its outputs, "
+            "and keep_none deletes them all. Node hashes are kept "
+            "(default: keep_all)."
+        ),
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help=(
+            "Leave out the subjects recorded as complete in the run "
+            "manifest of the nipype directory: all the outputs of the "
+            "pipeline were written with the same configuration and still "
+            "exist."
+        ),
+    )
+
+    parser.add_argument(
+        "--min_free_gb",
+        dest="min_free_gb",
+        type=float,
+        default=None,
+        help=(
+            "Only start a new subject while the projected free space of "
+            "the nipype directory stays above this value (in GB). The "
+            "footprint of each subject is projected from the size of its "
+            "inputs and the usage observed on previous subjects "
+            "(default: no limit)."
+        ),
+    )
+
+    parser.add_argument(
+        "--pin_containers",
+        dest="pin_containers",
+        action="store_true",
+        help=(
+            "Before building the workflow, check every container of the "
+            "config, resolve it to an immutable digest and pre-warm it. "
+            "All nodes of the run then use the pinned images."
+        ),
+    )
+    parser.add_argument(
+        "--retrieve_containers",
+        dest="retrieve_containers",
+        action="store_true",
+        help=(
+            "Retrieve the missing containers without prompting (docker "
+            "pull, or singularity images built into singularity_path), "
+            "then pin them as with --pin_containers."
+        ),
+    )
+
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -154,6 +220,9 @@ def init_and_load_cfg(cfg_path):
     Returns:
         cfg: Loaded configuration.
     """
+    import hydra
+    from omegaconf import OmegaConf
+
     # Get the path to this file
     current_dir = os.path.dirname(os.path.abspath(__file__))
     cfg_path = os.path.abspath(cfg_path)
@@ -239,3 +308,111 @@ def check_valid_pipeline(cfg):
                 "is incompatible with the surface extraction scheme "
                 f"{cfg.surface.surface_rh.use_scheme}"
             )
+
+
+def _subject_workflow(
+    name, base_dir, wf_config, datasource, entities, connect
+):
+    """Build the workflow of one subject."""
+    import nipype.pipeline.engine as pe
+
+    workflow = pe.Workflow(name=name, base_dir=base_dir)
+    workflow.config.update(wf_config)
+    # A single iteration keeps the working directory layout of a run with
+    # all the subjects, and thus its cache.
+    datasource.iterables = [datasource.iterables[0], [entities]]
+    connect(workflow, datasource)
+    return workflow
+
+
+def _run_subject(
+    name, base_dir, wf_config, datasource, entities, connect, callback
+):
+    """Build and run the workflow of one subject, in a worker process."""
+    workflow = _subject_workflow(
+        name, base_dir, wf_config, datasource, entities, connect
+    )
+    status_callback = callback(workflow) if callback is not None else None
+    workflow.run(
+        plugin="Linear", plugin_args={"status_callback": status_callback}
+    )
+    return status_callback
+
+
+def run_per_subject(
+    workflow,
+    datasource,
+    connect,
+    nprocs,
+    callback=None,
+    on_done=None,
+    save_graph=False,
+):
+    """
+    Run one independent workflow per (sub, ses, acq) of the iterables of
+    `datasource`, `nprocs` subjects at a time in a shared process pool.
+
+    The graph of each subject is built and expanded by the worker that
+    runs it, so that the run starts without expanding the graph of the
+    whole cohort, and the nodes of a subject run one after the other.
+
+    Args:
+        workflow (pe.Workflow): Empty main workflow, giving the name, base
+            directory and configuration (e.g. `crashdump_dir`) of the
+            workflows of the subjects.
+        datasource (pe.Node): Datasource from `create_datasource`.
+        connect (callable): Picklable function called as
+            `connect(workflow, datasource)` to build the workflow of a
+            subject.
+        nprocs (int): Number of subjects run at once.
+        callback (callable, optional): Picklable function called as
+            `callback(workflow)` to get the status callback of the run
+            of a subject.
+        on_done (callable, optional): Called in the main process as
+            `on_done(entities, status_callback)` when a subject succeeds.
+        save_graph (bool): Whether to write the graph of the workflow of
+            the first subject, which all the subjects share, to the
+            working directory before the run.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from copy import deepcopy
+
+    log = logging.getLogger("nipype.workflow")
+    if save_graph and datasource.iterables[1]:
+        _subject_workflow(
+            workflow.name,
+            workflow.base_dir,
+            workflow.config,
+            deepcopy(datasource),
+            datasource.iterables[1][0],
+            connect,
+        ).write_graph(graph2use="colored", format="png", simple_form=True)
+    failed = []
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        futures = {
+            pool.submit(
+                _run_subject,
+                workflow.name,
+                workflow.base_dir,
+                workflow.config,
+                datasource,
+                entities,
+                connect,
+                callback,
+            ): entities
+            for entities in datasource.iterables[1]
+        }
+        for future in as_completed(futures):
+            entities = futures[future]
+            try:
+                status_callback = future.result()
+            except Exception as e:
+                log.error(f"Subject {entities} failed: {e}")
+                failed.append(entities)
+                continue
+            if on_done is not None:
+                on_done(entities, status_callback)
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} subject(s) did not execute cleanly: {failed}"
+        )
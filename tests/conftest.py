@@ -7,6 +7,8 @@ import json
 from pathlib import Path
 import yaml
 
+from fetpype.utils import utils_synthetic
+
 
 @pytest.fixture(
     scope="function"
@@ -127,3 +129,22 @@ def generate_config(tmp_path_factory):
         return config_path
 
     return _generate
+
+
+@pytest.fixture
+def make_stack():
+    """Factory of synthetic stacks and masks, see `make_stack`."""
+    return utils_synthetic.make_stack
+
+
+@pytest.fixture
+def generate_cohort():
+    """Factory of synthetic BIDS cohorts, see `generate_cohort`."""
+    return utils_synthetic.generate_cohort
+
+
+@pytest.fixture
+def stub_cmd():
+    """Factory of commands running the stub container, with fetpype tags,
+    e.g. `stub_cmd("<input_stacks>", "<output_stacks>")`."""
+    return utils_synthetic.stub_cmd
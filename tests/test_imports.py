@@ -0,0 +1,49 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+ENTRY_MODULES = [
+    "fetpype.workflows.pipeline_fet",
+    "fetpype.workflows.pipeline_rec",
+    "fetpype.workflows.pipeline_seg",
+    "fetpype.workflows.pipeline_surf",
+    "fetpype.workflows.pipeline_fet_dhcp",
+]
+HEAVY_MODULES = ["nipype", "bids", "hydra", "omegaconf", "nibabel"]
+
+
+def _run_python(code):
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+
+@pytest.mark.parametrize("module", ENTRY_MODULES)
+def test_entry_points_import_lightly(module):
+    code = (
+        f"import sys, {module}\n"
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    assert _run_python(code).strip() == ""
+
+
+def test_lazy_submodules():
+    code = (
+        "import sys, fetpype\n"
+        "assert 'fetpype.pipelines' not in sys.modules\n"
+        "print(fetpype.pipelines.__name__)"
+    )
+    assert _run_python(code).strip() == "fetpype.pipelines"
+
+
+def test_cli_help_startup_time():
+    # Generous bound: `--help` must not import the processing stack
+    cmd = [sys.executable, "-m", "fetpype.workflows.pipeline_fet", "--help"]
+    start = time.perf_counter()
+    subprocess.run(cmd, capture_output=True, check=True)
+    assert time.perf_counter() - start < 5.0
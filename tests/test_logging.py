@@ -0,0 +1,22 @@
+import sys
+
+import pytest
+
+from fetpype.utils.logging import run_and_tee
+
+
+def test_run_and_tee_argv_without_shell(tmp_path):
+    # Arguments with spaces and shell characters are passed as-is
+    target = tmp_path / "dir with spaces" / "out $HOME.txt"
+    target.parent.mkdir()
+    code = "import sys; open(sys.argv[1], 'w').write('ok'); print('done')"
+    output = run_and_tee([sys.executable, "-c", code, str(target)])
+    assert target.read_text() == "ok"
+    assert output == "done"
+
+
+def test_run_and_tee_failures():
+    with pytest.raises(RuntimeError):
+        run_and_tee([sys.executable, "-c", "raise SystemExit(3)"])
+    with pytest.raises(RuntimeError):
+        run_and_tee(["fetpype-command-that-does-not-exist"])
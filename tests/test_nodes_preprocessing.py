@@ -0,0 +1,347 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from fetpype.nodes.preprocessing import (
+    CheckAffineResStacksAndMasks,
+    CheckAndSortStacksAndMasks,
+    CropStacksAndMasks,
+    PreprocessStacksAndMasks,
+)
+
+
+def _stack(path, shape, zooms, mask=False, seed=0):
+    rng = np.random.default_rng(seed)
+    if mask:
+        data = np.zeros(shape, dtype=np.uint8)
+        data[5:15, 8:20, 2:6] = 1
+    else:
+        data = rng.integers(0, 1000, shape).astype(np.int16)
+    img = nib.Nifti1Image(data, np.diag(list(zooms[:3]) + [1]))
+    img.header.set_zooms(zooms)
+    nib.save(img, path)
+    return path
+
+
+@pytest.fixture
+def subject(tmp_path):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    stacks, masks = [], []
+    shapes = [(64, 64, 8), (64, 64, 8, 1), (64, 64, 8)]
+    for run, shape in enumerate(shapes, 1):
+        stacks.append(
+            _stack(str(inputs / f"sub-01_run-{run}_T2w.nii.gz"), shape,
+                   (0.8, 0.8, 3.0) + (1.0,) * (len(shape) - 3), seed=run)
+        )
+        # The mask of run 3 does not match its stack
+        zooms = (0.8, 0.8, 3.0) if run != 3 else (1.0, 1.0, 3.0)
+        masks.append(
+            _stack(str(inputs / f"sub-01_run-{run}_mask.nii.gz"),
+                   (64, 64, 8), zooms, mask=True)
+        )
+    return stacks, masks[::-1]
+
+
+def _chain(stacks, masks, cwd, monkeypatch):
+    os.makedirs(cwd)
+    monkeypatch.chdir(cwd)
+    out = CheckAndSortStacksAndMasks(stacks=stacks, masks=masks).run()
+    out = CheckAffineResStacksAndMasks(
+        stacks=out.outputs.output_stacks, masks=out.outputs.output_masks
+    ).run()
+    cropped = [
+        CropStacksAndMasks(image=s, mask=m).run().outputs
+        for s, m in zip(out.outputs.output_stacks, out.outputs.output_masks)
+    ]
+    return (
+        [c.output_image for c in cropped],
+        [c.output_mask for c in cropped],
+    )
+
+
+def test_preprocess_stacks_and_masks(subject, tmp_path, monkeypatch):
+    stacks, masks = subject
+    expected = _chain(stacks, masks, str(tmp_path / "chain"), monkeypatch)
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("fused")
+    os.chdir("fused")
+    out = PreprocessStacksAndMasks(
+        stacks=stacks, masks=masks, sort_masks=True, num_threads=2
+    ).run()
+    result = (out.outputs.output_stacks, out.outputs.output_masks)
+
+    # Same files as the separate nodes, run 3 being discarded
+    assert [os.path.basename(f) for f in result[0]] == [
+        "sub-01_run-1_T2w.nii.gz",
+        "sub-01_run-2_T2w.nii.gz",
+    ]
+    for fused, chained in zip(sum(result, []), sum(expected, [])):
+        assert os.path.basename(fused) == os.path.basename(chained)
+        fused, chained = nib.load(fused), nib.load(chained)
+        assert fused.shape == chained.shape == (34, 39, 8)
+        assert np.allclose(fused.affine, chained.affine)
+        # The separate nodes rescale the data when writing it with the
+        # input data type in between
+        assert np.allclose(fused.get_fdata(), chained.get_fdata(), atol=1e-2)
+
+
+def test_preprocess_stacks_and_masks_errors(subject, tmp_path, monkeypatch):
+    stacks, masks = subject
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(RuntimeError, match="no corresponding mask"):
+        PreprocessStacksAndMasks(
+            stacks=stacks, masks=masks[:1], sort_masks=True
+        ).run()
+    with pytest.raises(ValueError, match="discarded"):
+        PreprocessStacksAndMasks(
+            stacks=stacks[2:], masks=masks[:1], crop_enabled=False
+        ).run()
+
+
+def test_run_stack_preprocessing(subject, tmp_path, monkeypatch, stub_cmd):
+    from fetpype import VALID_PREPRO_TAGS
+    from fetpype.nodes import CommandTemplate
+    from fetpype.nodes.preprocessing import (
+        drop_discarded_stacks,
+        pair_stacks_and_masks,
+        run_stack_preprocessing,
+    )
+
+    stacks, masks = subject
+    stacks, masks = pair_stacks_and_masks(stacks, masks)
+    assert [os.path.basename(m) for m in masks] == [
+        f"sub-01_run-{run}_mask.nii.gz" for run in (1, 2, 3)
+    ]
+    cmd = CommandTemplate(
+        stub_cmd("<input_stacks>", "<output_stacks>"), VALID_PREPRO_TAGS
+    )
+    outputs = []
+    for i, (stack, mask) in enumerate(zip(stacks, masks)):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs(f"mapflow_{i}")
+        os.chdir(f"mapflow_{i}")
+        outputs.append(
+            run_stack_preprocessing(
+                stack, mask, denoising_cmd=cmd, bias_correction_cmd=cmd
+            )
+        )
+    # Run 3 is discarded by the check
+    assert outputs[2] == (None, None, None, None)
+    stacks_out, masks_out, reports = drop_discarded_stacks(*zip(*outputs))
+    assert nib.load(stacks_out[1]).shape == (34, 39, 8)
+    assert "bias_correction" in stacks_out[1]
+    assert "check_and_crop" in masks_out[1]
+    assert reports == []
+
+    # Slice reports of the kept stacks
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("outliers")
+    os.chdir("outliers")
+    stack, mask, report, _ = run_stack_preprocessing(
+        stacks[0],
+        masks[0],
+        denoising_cmd=cmd,
+        bias_correction_cmd=cmd,
+        outlier_zscore=3.5,
+    )
+    assert os.path.dirname(report) == os.path.dirname(mask)
+    assert os.path.exists(report)
+    assert drop_discarded_stacks(
+        [stack, None], [mask, None], [report, None]
+    )[2] == [report]
+
+    # Masks computed by the brain extraction
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("brain_extraction")
+    os.chdir("brain_extraction")
+    be_cmd = CommandTemplate(
+        stub_cmd("<input_stacks>", "<output_masks>"), VALID_PREPRO_TAGS
+    )
+    stack, mask, _, _ = run_stack_preprocessing(
+        stacks[0],
+        brain_extraction_cmd=be_cmd,
+        denoising_cmd=cmd,
+        bias_correction_cmd=cmd,
+        check_enabled=False,
+        crop_enabled=False,
+    )
+    assert os.path.basename(mask) == "sub-01_run-1_mask.nii.gz"
+    assert os.path.exists(stack)
+
+
+def _corrupted_stacks(tmp_path, make_stack):
+    rng = np.random.default_rng(0)
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    paths = []
+    for run in range(1, 4):
+        stack, mask = make_stack((64, 64, 20), (1.0, 1.0, 3.0), rng)
+        data = stack.get_fdata()
+        if run == 2:
+            # In-plane motion of every other slice
+            data[..., ::2] = np.roll(data[..., ::2], 12, axis=(0, 1))
+        elif run == 3:
+            # Signal dropout of a third of the slices
+            data[..., ::3] *= 0.1
+        for img, suffix in [(stack, "T2w"), (mask, "mask")]:
+            path = str(inputs / f"sub-01_run-{run}_{suffix}.nii.gz")
+            if suffix == "T2w":
+                img = nib.Nifti1Image(data, img.affine, img.header)
+            nib.save(img, path)
+            paths.append(path)
+    return paths[::2], paths[1::2]
+
+
+def test_stack_selection(tmp_path, monkeypatch, make_stack, stub_cmd):
+    from fetpype import VALID_PREPRO_TAGS
+    from fetpype.nodes import CommandTemplate
+    from fetpype.nodes.preprocessing import (
+        drop_discarded_stacks,
+        run_stack_preprocessing,
+        select_stacks,
+        stack_quality,
+    )
+
+    stacks, masks = _corrupted_stacks(tmp_path, make_stack)
+    qualities = []
+    for stack, mask in zip(stacks, masks):
+        stack = nib.load(stack)
+        qualities.append(
+            stack_quality(
+                stack.get_fdata(),
+                nib.load(mask).get_fdata(),
+                stack.header.get_zooms(),
+            )
+        )
+    assert qualities[1]["slice_correlation"] < qualities[0][
+        "slice_correlation"
+    ]
+    assert qualities[0]["dropout"] == 0
+    assert qualities[2]["dropout"] > 0.2
+    kept, scores = select_stacks(qualities)
+    assert kept == [0, 1, 2]
+    assert scores[0] > max(scores[1:])
+    assert select_stacks(qualities, max_stacks=2)[0] == sorted(
+        np.argsort(scores)[::-1][:2]
+    )
+    assert select_stacks(qualities, min_score=scores[0])[0] == [0]
+
+    monkeypatch.chdir(tmp_path)
+    out = PreprocessStacksAndMasks(
+        stacks=stacks, masks=masks, max_stacks=1
+    ).run()
+    assert [os.path.basename(f) for f in out.outputs.output_stacks] == [
+        "sub-01_run-1_T2w.nii.gz"
+    ]
+    assert drop_discarded_stacks(
+        stacks + [None],
+        masks + [None],
+        qualities=qualities + [None],
+        min_score=scores[0],
+    ) == ([stacks[0]], [masks[0]], [])
+    with pytest.raises(ValueError, match="quality"):
+        drop_discarded_stacks(stacks, masks, min_score=scores[0])
+
+    # Streaming mode scores the stacks as PreprocessStacksAndMasks
+    cmd = CommandTemplate(
+        stub_cmd("<input_stacks>", "<output_stacks>"), VALID_PREPRO_TAGS
+    )
+    outputs = []
+    for i, (stack, mask) in enumerate(zip(stacks, masks)):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs(f"mapflow_{i}")
+        os.chdir(f"mapflow_{i}")
+        outputs.append(
+            run_stack_preprocessing(
+                stack,
+                mask,
+                denoising_cmd=cmd,
+                bias_correction_cmd=cmd,
+                outlier_zscore=3.5,
+                quality=True,
+            )
+        )
+    streamed = drop_discarded_stacks(*zip(*outputs), max_stacks=1)[0]
+    monkeypatch.chdir(tmp_path)
+    fused = PreprocessStacksAndMasks(
+        stacks=stacks, masks=masks, max_stacks=1, outlier_zscore=3.5
+    ).run()
+    assert [os.path.basename(f) for f in streamed] == [
+        os.path.basename(f) for f in fused.outputs.output_stacks
+    ]
+
+
+def test_outlier_slices(tmp_path, monkeypatch, make_stack):
+    import json
+
+    from fetpype.nodes.preprocessing import detect_outlier_slices
+
+    stack, mask = make_stack(
+        (64, 64, 20), (1.0, 1.0, 3.0), np.random.default_rng(0)
+    )
+    data = stack.get_fdata()
+    data[..., 8] = np.roll(data[..., 8], 10, axis=(0, 1))
+    data[..., 11] *= 0.2
+    outliers, report = detect_outlier_slices(data, mask.get_fdata())
+    assert report["outliers"] == [8, 11] == list(np.flatnonzero(outliers))
+    assert report["slices"][8]["reasons"] == ["ncc"]
+    assert report["slices"][11]["reasons"] == ["intensity"]
+    assert report["slices"][0]["ncc_prev"] is None
+
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    paths = [str(inputs / f"sub-01_run-1_{s}.nii.gz") for s in ("T2w", "mask")]
+    nib.save(nib.Nifti1Image(data, stack.affine, stack.header), paths[0])
+    nib.save(mask, paths[1])
+    monkeypatch.chdir(tmp_path)
+    out = PreprocessStacksAndMasks(
+        stacks=paths[:1],
+        masks=paths[1:],
+        crop_enabled=False,
+        outlier_zscore=3.5,
+    ).run()
+    cleaned = nib.load(out.outputs.output_masks[0]).get_fdata()
+    assert not cleaned[..., [8, 11]].any()
+    assert cleaned[..., 10].any()
+    with open(out.outputs.output_slice_reports[0]) as f:
+        assert json.load(f)["outliers"] == [8, 11]
+
+
+def test_refine_mask(tmp_path, monkeypatch):
+    from fetpype.nodes.preprocessing import refine_mask
+
+    mask = np.zeros((64, 64, 8), dtype=np.uint8)
+    mask[20:40, 20:40, 2:6] = 1
+    mask[28:32, 28:32, 3] = 0  # hole
+    mask[0, 63, 7] = 1  # stray false positive
+    refined = refine_mask(mask, (0.8, 0.8, 3.0))
+    assert refined.dtype == mask.dtype
+    assert refined.sum() == 20 * 20 * 4
+    dilated = refine_mask(mask, (0.8, 0.8, 3.0), dilation=1.6)
+    # Dilated in-plane only, the slices being thicker than the radius
+    assert dilated[18:42, 20:40, 2].all() and not dilated[..., 1].any()
+
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    paths = [
+        _stack(str(inputs / "sub-01_run-1_T2w.nii.gz"), (64, 64, 8),
+               (0.8, 0.8, 3.0)),
+        str(inputs / "sub-01_run-1_mask.nii.gz"),
+    ]
+    nib.save(nib.Nifti1Image(mask, np.diag([0.8, 0.8, 3.0, 1])), paths[1])
+    monkeypatch.chdir(tmp_path)
+    shapes = []
+    for refine in (False, True):
+        os.makedirs(f"refine_{refine}")
+        os.chdir(f"refine_{refine}")
+        out = PreprocessStacksAndMasks(
+            stacks=paths[:1], masks=paths[1:], refine_mask=refine
+        ).run()
+        shapes.append(nib.load(out.outputs.output_masks[0]).shape)
+        os.chdir(tmp_path)
+    # The stray voxel inflates the crop
+    assert shapes == [(59, 63, 8), (58, 58, 8)]
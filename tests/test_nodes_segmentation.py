@@ -0,0 +1,51 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from fetpype.nodes.segmentation import run_seg_cmd
+
+
+def test_run_seg_cmd_crop(tmp_path, monkeypatch, make_stack, stub_cmd):
+    stack, mask = make_stack(
+        (80, 90, 70), (0.8, 0.8, 0.8), np.random.default_rng(0)
+    )
+    data = (stack.get_fdata() * mask.get_fdata()).astype(np.int16)
+    srr = str(tmp_path / "srr.nii.gz")
+    nib.save(nib.Nifti1Image(data, stack.affine), srr)
+
+    monkeypatch.chdir(tmp_path)
+    # The stub copies its input, as a segmentation in the same grid
+    seg = run_seg_cmd(
+        srr, stub_cmd("<input_volume>", "<output_seg>"), crop_margin=4
+    )
+    cropped = nib.load(os.path.join("seg", "input", "input_srr.nii.gz"))
+    assert all(c < n for c, n in zip(cropped.shape, data.shape))
+    assert np.allclose(
+        nib.affines.apply_affine(cropped.affine, [0, 0, 0]),
+        nib.affines.apply_affine(
+            stack.affine,
+            np.argwhere(data > 0).min(axis=0) - 5,
+        ),
+    )
+
+    out = nib.load(seg)
+    assert out.shape == data.shape
+    assert np.allclose(out.affine, stack.affine)
+    assert np.array_equal(np.asanyarray(out.dataobj), data)
+
+
+def test_run_seg_cmd_crop_long_axes(tmp_path, monkeypatch, stub_cmd):
+    # The brain extends beyond the size of the first axis on the others
+    data = np.zeros((50, 120, 100), dtype=np.int16)
+    data[10:40, 20:110, 10:70] = 1
+    srr = str(tmp_path / "srr.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), srr)
+
+    monkeypatch.chdir(tmp_path)
+    seg = run_seg_cmd(
+        srr, stub_cmd("<input_volume>", "<output_seg>"), crop_margin=2
+    )
+    cropped = nib.load(os.path.join("seg", "input", "input_srr.nii.gz"))
+    assert cropped.shape == (34, 94, 64)
+    assert np.array_equal(np.asanyarray(nib.load(seg).dataobj), data)
@@ -0,0 +1,64 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from fetpype.nodes.surface_extraction import hemisphere_mask, run_surf_cmd
+
+
+def _seg(path):
+    seg = np.zeros((60, 70, 50), dtype=np.int16)
+    seg[10:25, 20:40, 10:30] = 5
+    seg[12:20, 25:35, 15:25] = 7
+    seg[35:50, 20:40, 10:30] = 6  # other hemisphere
+    seg[5, 5, 5] = 30  # label outside the lookup table
+    affine = np.diag([0.5, 0.5, 0.5, 1.0])
+    affine[:3, 3] = [-10, 20, 5]
+    nib.save(nib.Nifti1Image(seg, affine), path)
+    return seg, affine
+
+
+def test_hemisphere_mask(tmp_path):
+    seg, affine = _seg(str(tmp_path / "seg.nii.gz"))
+    out = hemisphere_mask(
+        str(tmp_path / "seg.nii.gz"), [5, 7, 14], str(tmp_path / "lh.nii.gz")
+    )
+    mask = nib.load(out)
+    assert mask.get_data_dtype() == np.uint8
+    assert mask.shape == (19, 24, 24)
+    # Same voxels in scanner space
+    expected = nib.affines.apply_affine(
+        affine, np.argwhere(np.isin(seg, [5, 7, 14]))
+    )
+    found = nib.affines.apply_affine(
+        mask.affine, np.argwhere(np.asanyarray(mask.dataobj) == 1)
+    )
+    assert np.allclose(expected, found)
+
+
+def test_run_surf_cmd_crop(tmp_path, monkeypatch, stub_cmd):
+    _seg(str(tmp_path / "seg.nii.gz"))
+    monkeypatch.chdir(tmp_path)
+    surf = run_surf_cmd(
+        str(tmp_path / "seg.nii.gz"),
+        stub_cmd("<input_seg>", "<output_surf>"),
+        "lh.nii.gz",
+        [5, 7],
+        crop_hemisphere=True,
+    )
+    assert os.path.exists(surf)
+    staged = nib.load(os.path.join("seg", "input", "input_seg.nii.gz"))
+    assert staged.shape == (19, 24, 24)
+
+
+def test_hemisphere_mask_long_axes(tmp_path):
+    # Labels beyond the size of the first axis on the others
+    seg = np.zeros((50, 120, 100), dtype=np.int16)
+    seg[10:40, 20:110, 10:70] = 5
+    nib.save(nib.Nifti1Image(seg, np.eye(4)), str(tmp_path / "seg.nii.gz"))
+    out = hemisphere_mask(
+        str(tmp_path / "seg.nii.gz"), [5], str(tmp_path / "lh.nii.gz")
+    )
+    mask = np.asanyarray(nib.load(out).dataobj)
+    assert mask.shape == (34, 94, 64)
+    assert mask.sum() == (seg == 5).sum()
@@ -0,0 +1,48 @@
+import pytest
+
+from fetpype import VALID_RECON_TAGS
+from fetpype.nodes.utils import CommandTemplate, as_template
+
+
+def test_command_template_render():
+    tpl = CommandTemplate(
+        "docker run --rm <mount> img cmd --input <input_stacks> "
+        "--output <output_dir>/out.nii.gz",
+        VALID_RECON_TAGS,
+    )
+    assert tpl.tags == {"mount", "input_stacks", "output_dir"}
+    assert "input_stacks" in tpl and "input_masks" not in tpl
+    values = {
+        "mount": ["-v", "/a:/a"],
+        "input_stacks": ["/a/s1.nii.gz", "/a/s2.nii.gz"],
+        "output_dir": "/b",
+    }
+    assert tpl.render(**values) == (
+        "docker run --rm -v /a:/a img cmd --input /a/s1.nii.gz "
+        "/a/s2.nii.gz --output /b/out.nii.gz"
+    )
+    assert tpl.render_argv(**values) == [
+        "docker", "run", "--rm", "-v", "/a:/a", "img", "cmd",
+        "--input", "/a/s1.nii.gz", "/a/s2.nii.gz",
+        "--output", "/b/out.nii.gz",
+    ]
+
+
+def test_command_template_validation():
+    with pytest.raises(ValueError):
+        CommandTemplate("run <unknown>", VALID_RECON_TAGS)
+    with pytest.raises(ValueError):
+        CommandTemplate("docker run img <input_stacks>", VALID_RECON_TAGS)
+    tpl = CommandTemplate("run <input_stacks> <output_dir>", VALID_RECON_TAGS)
+    with pytest.raises(ValueError):
+        tpl.render(input_stacks=["a"])
+
+
+def test_command_template_is_stable():
+    cmd = "run <input_stacks> --mask <input_masks> <output_volume>"
+    tpl = as_template(cmd, VALID_RECON_TAGS)
+    assert as_template(tpl, VALID_RECON_TAGS) is tpl
+    assert repr(tpl) == repr(CommandTemplate(cmd, VALID_RECON_TAGS))
+    no_mask = tpl.replace("--mask <input_masks>", "")
+    assert "input_masks" not in no_mask
+    assert no_mask.render(input_stacks="a", output_volume="b") == "run a  b"
@@ -4,6 +4,7 @@ from fetpype.pipelines.full_pipeline import (
     create_rec_pipeline,
     create_seg_pipeline,
     create_surf_pipeline,
+    stage_workflow_name,
 )
 from fetpype.workflows.utils import (
     init_and_load_cfg,
@@ -69,3 +70,101 @@ def test_create_full_pipelines(
         simple_form=True,
     )
     assert op.exists(op.join(mock_output_dir, name, "graph.png"))
+
+
+def test_stage_workflow_name(generate_config):
+    cfg = init_and_load_cfg(generate_config("nesvor", "bounti", "surfpype"))
+    other = init_and_load_cfg(
+        generate_config("nesvor", "fetalsynthseg", "surfpype")
+    )
+    # Only the working directories of the changed stages differ
+    for stage in ["preprocessing", "reconstruction"]:
+        assert stage_workflow_name(cfg, stage) == stage_workflow_name(
+            other, stage
+        )
+    for stage in ["segmentation", "surface"]:
+        assert stage_workflow_name(cfg, stage) != stage_workflow_name(
+            other, stage
+        )
+    assert stage_workflow_name(cfg, "reconstruction").startswith(
+        "Reconstruction_"
+    )
+
+
+def _node_hashes(workflow):
+    return {
+        name: workflow.get_node(name).inputs.get_hashval()[1]
+        for name in workflow.list_node_names()
+    }
+
+
+def test_node_hashes(generate_config):
+    from omegaconf import OmegaConf
+
+    from fetpype.pipelines.full_pipeline import get_recon
+
+    cfg = init_and_load_cfg(generate_config("nesvor", "bounti", "surfpype"))
+    OmegaConf.set_struct(cfg, False)
+    hosts = [
+        OmegaConf.merge(
+            cfg,
+            {
+                "container": "singularity",
+                "singularity_path": path,
+                "singularity_mount": path,
+                "singularity_home": path,
+                "segmentation": {"path_to_output": f"{path}/seg.nii.gz"},
+            },
+        )
+        for path in ["/data", "/scratch"]
+    ]
+    # Unrelated settings and the host paths do not change the nodes
+    recon, other = [_node_hashes(get_recon(c)) for c in hosts]
+    assert recon == other
+    assert set(recon) >= {"nesvor", "clamp_intensities"}
+    hosts[1].reconstruction.output_resolution = 0.5
+    assert _node_hashes(get_recon(hosts[1]))["nesvor"] != recon["nesvor"]
+
+
+@pytest.mark.parametrize("load_masks", [True, False])
+def test_streaming_prepro(generate_config, load_masks):
+    from omegaconf import OmegaConf
+
+    from fetpype.pipelines.full_pipeline import get_prepro
+
+    cfg = init_and_load_cfg(generate_config("nesvor", "bounti", "surfpype"))
+    OmegaConf.set_struct(cfg, False)
+    cfg.preprocessing.streaming = True
+    prepro = get_prepro(cfg, load_masks=load_masks, enabled_cropping=True)
+    names = set(prepro.list_node_names())
+    assert "StackPreprocessing" in names
+    assert ("PairStacksAndMasks" in names) == load_masks
+    assert not names & {"Denoising", "MergeDenoise", "BiasCorrection"}
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_slice_reports(generate_config, streaming):
+    from omegaconf import OmegaConf
+
+    from fetpype.pipelines.full_pipeline import get_prepro, get_recon
+
+    def inputs(workflow, node):
+        node = workflow.get_node(node)
+        return {
+            dst
+            for _, _, data in workflow._graph.in_edges(node, data=True)
+            for _, dst in data["connect"]
+        }
+
+    cfg = init_and_load_cfg(generate_config("nesvor", "bounti", "surfpype"))
+    OmegaConf.set_struct(cfg, False)
+    cfg.preprocessing.streaming = streaming
+    prepro = get_prepro(cfg, load_masks=True, enabled_cropping=True)
+    assert "slice_reports" in inputs(prepro, "outputnode")
+
+    # Only passed to the reconstruction commands using them
+    assert "input_slice_reports" not in inputs(get_recon(cfg), "nesvor")
+    cfg.reconstruction.reconstruction[cfg.container].cmd += (
+        " --slice-reports <input_slice_reports>"
+    )
+    assert "input_slice_reports" in inputs(get_recon(cfg), "nesvor")
@@ -1,9 +1,19 @@
+import os
+import time
+
 import pytest
 import re
 import nipype.pipeline.engine as pe
 import nipype.interfaces.io as nio
 
-from fetpype.utils.utils_bids import create_bids_datasink
+from fetpype.utils.utils_bids import (
+    create_bids_datasink,
+    get_gestational_age,
+    get_up_to_date_subjects,
+    load_participants_index,
+)
+from fetpype.utils.utils_manifest import RunManifest, stage_digests
+from omegaconf import OmegaConf
 
 
 # Helper for sorting lists containing None
@@ -140,6 +150,17 @@ def test_datasink_regex_simulation_reconstruction(
     result_path_no_ses = apply_regex_subs(in_path_no_ses, regex_subs)
     assert result_path_no_ses == expected_path_no_ses_cleaned
 
+    # Slice reports of the stacks
+    in_path_report = (
+        f"{mock_output_dir}/nesvor_pipeline_wf/"
+        "_session_02_subject_sub-01/CheckAndCrop/"
+        "sub-01_ses-02_run-1_T2w_slices.json"
+    )
+    assert apply_regex_subs(in_path_report, regex_subs) == (
+        f"{mock_output_dir}/sub-01/ses-02/anat/"
+        "sub-01_ses-02_run-1_desc-slices_T2w.json"
+    )
+
 
 def test_datasink_regex_simulation_segmentation(
     mock_output_dir, mock_nipype_wf_dir
@@ -217,3 +238,87 @@ def test_datasink_regex_simulation_cleanup(
         )
         == "sub-01/ses-01/anat/sub-01.nii"
     )
+
+
+# --- Tests for the participants index ---
+def test_participants_index_gestational_age(tmp_path):
+    (tmp_path / "participants.tsv").write_text(
+        "participant_id\tsession_id\tgestational_age\n"
+        "sub-01\tses-01\t28\n"
+        "sub-01\tses-02\t32.5\n"
+        "sub-02\t\t30\n"
+    )
+    participants = load_participants_index(str(tmp_path))
+    assert participants["sub-02"]["gestational_age"] == 30
+    assert participants["sub-01_ses-02"]["gestational_age"] == 32.5
+
+    t2 = "/data/sub-01_ses-02_rec-nesvor_T2w.nii.gz"
+    assert get_gestational_age(str(tmp_path), t2, participants) == 32.5
+    # Without an index, the table is read from the dataset
+    t2 = "/data/sub-02_rec-nesvor_T2w.nii.gz"
+    assert get_gestational_age(str(tmp_path), t2) == 30
+
+    with pytest.raises(IndexError):
+        get_gestational_age(str(tmp_path), "sub-03_T2w.nii.gz", participants)
+    with pytest.raises(FileNotFoundError):
+        load_participants_index(str(tmp_path / "missing"))
+
+
+# --- Tests for the incremental mode ---
+def _touch(path, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    os.utime(path, (mtime, mtime))
+
+
+def test_get_up_to_date_subjects(tmp_path):
+    now = time.time()
+    data, out = tmp_path / "data", tmp_path / "derivatives" / "nesvor"
+    inputs = {
+        ("01", "01", None): "sub-01/ses-01/anat/sub-01_ses-01_run-1_T2w",
+        ("02", None, "haste"): "sub-02/anat/sub-02_acq-haste_T2w",
+        # Modified after its completion
+        ("03", None, None): "sub-03/anat/sub-03_T2w",
+        # Never completed
+        ("04", None, None): "sub-04/anat/sub-04_T2w",
+    }
+    for key, name in inputs.items():
+        mtime = now + 100 if key[0] == "03" else now - 100
+        _touch(str(data / f"{name}.nii.gz"), mtime)
+    cfg = OmegaConf.create(
+        {
+            "preprocessing": {"mask_refinement": {"enabled": False}},
+            "reconstruction": {"pipeline": "nesvor", "resolution": 0.8},
+        }
+    )
+
+    def digests():
+        return stage_digests(cfg, ["reconstruction"])
+
+    manifest = RunManifest(str(tmp_path / "run_manifest.json"))
+    for key in list(inputs)[:3]:
+        output = out / f"sub-{key[0]}_rec-nesvor_T2w.nii.gz"
+        _touch(str(output), now - 100)
+        manifest.record(
+            key, "reconstruction", digests()["reconstruction"], [str(output)]
+        )
+
+    up_to_date = get_up_to_date_subjects(
+        manifest, [str(data), None], digests()
+    )
+    assert up_to_date == {("01", "01", None), ("02", None, "haste")}
+    # Even if the datasink left the outputs untouched
+    assert os.path.getmtime(out / "sub-01_rec-nesvor_T2w.nii.gz") < now
+    (out / "sub-02_rec-nesvor_T2w.nii.gz").unlink()
+    assert get_up_to_date_subjects(manifest, [str(data)], digests()) == {
+        ("01", "01", None)
+    }
+
+    # A change of configuration makes all the subjects stale
+    cfg.reconstruction.resolution = 0.5
+    assert not get_up_to_date_subjects(manifest, [str(data)], digests())
+    cfg.reconstruction.resolution = 0.8
+    assert get_up_to_date_subjects(manifest, [str(data)], digests())
+    # So does a change of the stages before the reconstruction
+    cfg.preprocessing.mask_refinement.enabled = True
+    assert not get_up_to_date_subjects(manifest, [str(data)], digests())
@@ -0,0 +1,149 @@
+from omegaconf import OmegaConf
+import pytest
+
+import fetpype.utils.utils_docker as utils_docker
+from fetpype.utils.utils_docker import (
+    get_container_name,
+    get_container_names,
+    get_container_sources,
+)
+
+
+def test_get_container_name_skips_options():
+    cmd = (
+        "docker run --rm <mount> --gpus all vzalevskyi/fetalsynthseg:latest "
+        "python3 predict.py --input <input_dir>/input_srr.nii.gz"
+    )
+    assert (
+        get_container_name("docker", cmd) == "vzalevskyi/fetalsynthseg:latest"
+    )
+    cmd = (
+        "singularity exec --bind <singularity_mount> --nv "
+        "<singularity_path>/nesvor.sif nesvor reconstruct"
+    )
+    assert (
+        get_container_name("singularity", cmd, "/images")
+        == "/images/nesvor.sif"
+    )
+
+
+@pytest.mark.parametrize(
+    "cmd, expected",
+    [
+        (
+            "docker run --rm -v /tmp:/tmp -e HOME=/x thsanchez/nesvor:v0.5 "
+            "nesvor",
+            "thsanchez/nesvor:v0.5",
+        ),
+        ("docker run -w /work -e K=a:b org/img:1 run", "org/img:1"),
+        ("docker run --rm ubuntu ls /data", "ubuntu"),
+        ("docker run -it --name=x -w/work ubuntu:22.04 ls", "ubuntu:22.04"),
+        (
+            "docker run --gpus '\"device=0\"' <mount> renbem/niftymic "
+            "niftymic_reconstruct_volume",
+            "renbem/niftymic",
+        ),
+        ("docker run --rm <mount>", None),
+    ],
+)
+def test_get_container_name_docker_options(cmd, expected):
+    assert get_container_name("docker", cmd) == expected
+
+
+def test_get_container_names_groups_keys():
+    cfg = {
+        "singularity_path": "/images",
+        "a": {
+            "docker": {"cmd": "docker run <mount> org/img:1 run_a"},
+            "singularity": {"cmd": "singularity run <singularity_path>/a.sif"},
+        },
+        "b": {"docker": {"cmd": "docker run <mount> org/img:1 run_b"}},
+    }
+    assert get_container_names("docker", cfg) == {
+        "org/img:1": ["/a/docker/cmd", "/b/docker/cmd"]
+    }
+    assert get_container_names("singularity", cfg) == {
+        "/images/a.sif": ["/a/singularity/cmd"]
+    }
+
+
+def test_pin_container_commands_rewrites_cmds(monkeypatch):
+    cfg = OmegaConf.create(
+        {
+            "container": "docker",
+            "a": {"docker": {"cmd": "docker run <mount> org/img:1 img_cmd"}},
+            "b": {"docker": {"cmd": "docker run <mount> org/other:2 cmd"}},
+        }
+    )
+    monkeypatch.setattr(
+        utils_docker, "is_available_container", lambda t, n: True
+    )
+    monkeypatch.setattr(
+        utils_docker,
+        "resolve_container_digest",
+        lambda t, n: (n.split(":")[0] + "@sha256:0123", "sha256:0123"),
+    )
+    monkeypatch.setattr(utils_docker, "warm_container", lambda t, r: None)
+
+    pinned = utils_docker.pin_container_commands(cfg, sections=["a"])
+    assert list(pinned) == ["org/img:1"]
+    assert cfg.a.docker.cmd == "docker run <mount> org/img@sha256:0123 img_cmd"
+    assert cfg.b.docker.cmd == "docker run <mount> org/other:2 cmd"
+
+
+def test_get_container_sources():
+    cfg = {
+        "singularity_path": "/images",
+        "a": {
+            "docker": {"cmd": "docker run <mount> org/img:1 run_a"},
+            "singularity": {"cmd": "singularity run <singularity_path>/a.sif"},
+        },
+    }
+    assert get_container_sources(cfg) == {"/images/a.sif": "org/img:1"}
+
+
+@pytest.mark.parametrize(
+    "images, expected",
+    [
+        (["org/img:latest", "org/img:0.1.2"], "org/img:0.1.2"),
+        (["org/img:0.9.0", "org/img:0.10.0"], "org/img:0.10.0"),
+        (["org/img", "org/img:latest"], "org/img"),
+        (["org/img:2", "org/img@sha256:0123"], "org/img@sha256:0123"),
+    ],
+)
+def test_get_container_sources_conflict(images, expected):
+    # Whatever the order of the steps, the most specific image is used
+    sif = "singularity run <singularity_path>/a.sif"
+    for ordered in (images, images[::-1]):
+        cfg = {"singularity_path": "/images"}
+        for i, image in enumerate(ordered):
+            cfg[f"step{i}"] = {
+                "docker": {"cmd": f"docker run <mount> {image} run"},
+                "singularity": {"cmd": sif},
+            }
+        assert get_container_sources(cfg) == {"/images/a.sif": expected}
+
+
+def test_check_container_commands_non_interactive(monkeypatch):
+    cfg = {
+        "a": {"docker": {"cmd": "docker run <mount> org/img:1 run_a"}},
+        "b": {"docker": {"cmd": "docker run <mount> org/img:2 run_b"}},
+        "c": {"docker": {"cmd": "docker run <mount> org/bad:3 run_c"}},
+    }
+    retrieved = []
+
+    def retrieve(container_type, name, source=None):
+        if name == "org/bad:3":
+            raise ValueError("unknown image")
+        retrieved.append(name)
+
+    monkeypatch.setattr(utils_docker, "retrieve_container", retrieve)
+    # Only the missing containers are pulled, and failures are aggregated
+    monkeypatch.setattr(
+        utils_docker, "is_available_container", lambda t, n: n == "org/img:2"
+    )
+    with pytest.raises(RuntimeError, match="org/bad:3"):
+        utils_docker.check_container_commands(
+            "docker", cfg, non_interactive=True
+        )
+    assert retrieved == ["org/img:1"]
@@ -0,0 +1,54 @@
+from omegaconf import OmegaConf
+
+from fetpype.utils.utils_bids import create_datasource
+from fetpype.utils.utils_manifest import RunManifest, stage_digests
+
+
+def _cfg(seg="bounti"):
+    return OmegaConf.create(
+        {
+            "reconstruction": {"pipeline": "nesvor"},
+            "segmentation": {"pipeline": seg},
+            "surface": {"pipeline": "surfpype"},
+        }
+    )
+
+
+def test_stage_digests():
+    digests = stage_digests(_cfg())
+    assert list(digests) == ["reconstruction", "segmentation", "surface"]
+    other = stage_digests(_cfg("fetalsynthseg"))
+    # Changing a stage invalidates it and the following ones only
+    assert digests["reconstruction"] == other["reconstruction"]
+    assert digests["segmentation"] != other["segmentation"]
+    assert digests["surface"] != other["surface"]
+    assert list(stage_digests(_cfg(), ["surface"])) == ["surface"]
+
+
+def test_run_manifest(tmp_path):
+    out = tmp_path / "T2w.nii.gz"
+    out.write_bytes(b"0")
+    digests = stage_digests(_cfg(), ["reconstruction"])
+    manifest = RunManifest(str(tmp_path / "wf" / "run_manifest.json"))
+    manifest.record(("01", None, None), "reconstruction", "old", [str(out)])
+    manifest.record(("02", "1", None), "reconstruction", digests[
+        "reconstruction"
+    ], [str(out)])
+    manifest.save()
+
+    manifest = RunManifest(manifest.path)
+    assert manifest.completed(digests) == {("02", "1", None)}
+    out.unlink()
+    assert manifest.completed(digests) == set()
+
+
+def test_create_datasource_skip(tmp_path, generate_cohort):
+    subjects = generate_cohort(str(tmp_path / "data"), 2)
+    query = {"stacks": {"datatype": "anat", "suffix": "T2w"}}
+    datasource = create_datasource(
+        query,
+        str(tmp_path / "data"),
+        str(tmp_path / "nipype"),
+        skip={(subjects[0], "01", None)},
+    )
+    assert datasource.iterables[1] == [(subjects[1], "01", None)]
@@ -0,0 +1,124 @@
+import gzip
+
+import nibabel as nib
+import numpy as np
+from omegaconf import OmegaConf
+import pytest
+
+from fetpype.nodes.preprocessing import CropStacksAndMasks
+from fetpype.nodes.reconstruction import clamp_intensities
+from fetpype.utils import utils_gzip
+from fetpype.utils.utils_nifti import (
+    ensure_nii_gz,
+    get_intermediate_format,
+    get_nifti_threads,
+    load_nifti,
+    save_nifti,
+)
+
+
+def _image(shape=(20, 20, 10)):
+    data = np.zeros(shape)
+    data[5:15, 5:15, 2:8] = np.arange(600).reshape(10, 10, 6)
+    return nib.Nifti1Image(data, np.eye(4))
+
+
+def test_save_nifti_formats(tmp_path, monkeypatch):
+    # ensure_nii_gz writes its copy in the current directory
+    monkeypatch.chdir(tmp_path)
+    img = _image()
+    for name, level in (("a.nii", None), ("b.nii.gz", None), ("c.nii.gz", 9)):
+        path = save_nifti(img, str(tmp_path / name), level)
+        assert np.array_equal(nib.load(path).get_fdata(), img.get_fdata())
+    with open(tmp_path / "a.nii", "rb") as f:
+        assert f.read(2) != b"\x1f\x8b"
+    with gzip.open(tmp_path / "c.nii.gz") as f:
+        assert len(f.read()) > 0
+
+    out = ensure_nii_gz(str(tmp_path / "a.nii"))
+    assert out == str(tmp_path / "a.nii.gz")
+    assert ensure_nii_gz(out) == out
+
+
+def test_intermediate_format_in_nodes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    nib.save(_image(), "in_T2w.nii.gz")
+    nib.save(_image(), "in_mask.nii.gz")
+    crop = CropStacksAndMasks(
+        image="in_T2w.nii.gz",
+        mask="in_mask.nii.gz",
+        boundary=0,
+        output_format="nii",
+    )
+    out = crop.run().outputs
+    assert out.output_image.endswith("in_T2w.nii")
+    assert nib.load(out.output_mask).shape == (10, 10, 6)
+
+    clamped = clamp_intensities(out.output_image, 0.99, output_format="nii")
+    assert clamped.endswith("in_T2w_clamped.nii")
+
+
+def test_get_intermediate_format():
+    cfg = OmegaConf.create({})
+    assert get_intermediate_format(cfg) == {
+        "output_format": "nii.gz",
+        "compresslevel": None,
+    }
+    cfg = OmegaConf.create({"intermediate_format": "nii.zst"})
+    with pytest.raises(ValueError):
+        get_intermediate_format(cfg)
+
+
+def test_parallel_gzip_round_trip():
+    data = np.random.default_rng(0).normal(size=100_000).tobytes()
+    buf = utils_gzip.compress(data, 1, threads=4, block_size=1 << 16)
+    # A standard gzip file...
+    assert gzip.decompress(buf) == data
+    # ...whose blocks are decompressed in parallel
+    assert len(utils_gzip._split_members(memoryview(buf))[0]) == 13
+    assert utils_gzip.decompress(buf, threads=4) == data
+    # Other gzip files and empty data are handled too
+    assert utils_gzip.decompress(gzip.compress(data), threads=4) == data
+    tail = gzip.compress(b"tail")
+    assert utils_gzip.decompress(buf + tail) == data + b"tail"
+    assert gzip.decompress(utils_gzip.compress(b"")) == b""
+    with pytest.raises(gzip.BadGzipFile):
+        corrupted = bytearray(buf)
+        corrupted[-8] ^= 1
+        utils_gzip.decompress(bytes(corrupted))
+
+
+def test_save_load_nifti_threads(tmp_path, monkeypatch):
+    img = _image((64, 64, 40))
+    path = save_nifti(img, str(tmp_path / "a.nii.gz"), threads=3)
+    assert np.array_equal(nib.load(path).get_fdata(), img.get_fdata())
+    loaded = load_nifti(path, threads=3)
+    assert np.array_equal(loaded.get_fdata(), img.get_fdata())
+    assert np.allclose(loaded.affine, img.affine)
+    nifti2 = nib.Nifti2Image(img.get_fdata(), np.eye(4))
+    path = save_nifti(nifti2, str(tmp_path / "b.nii.gz"), threads=2)
+    assert isinstance(load_nifti(path, threads=2), nib.Nifti2Image)
+
+    assert get_nifti_threads(OmegaConf.create({})) == 1
+    with pytest.raises(ValueError):
+        get_nifti_threads(OmegaConf.create({"nifti_threads": 0}))
+
+    # The threads of the nodes come from n_procs
+    from nipype.pipeline import engine as pe
+
+    monkeypatch.chdir(tmp_path)
+    save_nifti(img, "in_T2w.nii.gz")
+    save_nifti(img, "in_mask.nii.gz")
+    crop = pe.MapNode(
+        CropStacksAndMasks(), iterfield=["image", "mask"], name="crop"
+    )
+    crop.n_procs = 2
+    crop.base_dir = str(tmp_path)
+    crop.inputs.image = [str(tmp_path / "in_T2w.nii.gz")]
+    crop.inputs.mask = [str(tmp_path / "in_mask.nii.gz")]
+    out = crop.run().outputs.output_image[0]
+    assert crop.interface.inputs.num_threads == 2
+    with open(out, "rb") as f:
+        buf = f.read()
+    # Written by the threaded writer
+    assert utils_gzip._split_members(buf)[1] == len(buf)
@@ -0,0 +1,88 @@
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from fetpype.utils.utils_bids import create_datasource
+from fetpype.utils.utils_preflight import preflight_subjects
+
+
+@pytest.fixture
+def cohort(tmp_path, generate_cohort):
+    data_dir = str(tmp_path / "data")
+    subjects = generate_cohort(data_dir, 4)
+    masks_dir = os.path.join(data_dir, "derivatives", "masks")
+
+    def anat(root, sub):
+        return os.path.join(root, f"sub-{sub}", "ses-01", "anat")
+
+    # Missing mask
+    os.remove(
+        os.path.join(
+            anat(masks_dir, subjects[1]),
+            f"sub-{subjects[1]}_ses-01_run-1_mask.nii.gz",
+        )
+    )
+    # Truncated stack
+    path = os.path.join(
+        anat(data_dir, subjects[2]),
+        f"sub-{subjects[2]}_ses-01_run-2_T2w.nii.gz",
+    )
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    # Empty mask, its stack is discarded but the subject can run
+    path = os.path.join(
+        anat(masks_dir, subjects[3]),
+        f"sub-{subjects[3]}_ses-01_run-1_mask.nii.gz",
+    )
+    img = nib.load(path)
+    nib.save(
+        nib.Nifti1Image(np.zeros(img.shape, np.uint8), img.affine), path
+    )
+
+    query = {
+        "stacks": {"datatype": "anat", "suffix": "T2w"},
+        "masks": {"datatype": "anat", "suffix": "mask"},
+    }
+    datasource = create_datasource(
+        query, data_dir, str(tmp_path / "nipype"),
+        extra_derivatives=masks_dir,
+    )
+    return subjects, data_dir, masks_dir, datasource
+
+
+def test_preflight_exclude(cohort, tmp_path):
+    subjects, data_dir, masks_dir, datasource = cohort
+    inventory_path = str(tmp_path / "nipype" / "inventory.json")
+    inventory = preflight_subjects(
+        datasource, "exclude", data_dir, masks_dir,
+        inventory_path=inventory_path,
+    )
+    assert datasource.iterables[1] == [
+        (subjects[0], "01", None),
+        (subjects[3], "01", None),
+    ]
+    errors = {k: v["errors"] for k, v in inventory.items()}
+    assert "no corresponding mask" in errors[f"sub-{subjects[1]}_ses-01"][0]
+    assert "Cannot read" in errors[f"sub-{subjects[2]}_ses-01"][0]
+    assert "is empty" in inventory[f"sub-{subjects[3]}_ses-01"]["warnings"][0]
+
+    with open(inventory_path) as f:
+        entry = json.load(f)[f"sub-{subjects[0]}_ses-01"]
+    stack = entry["stacks"][0]
+    assert stack["orientation"] == "".join(
+        nib.aff2axcodes(nib.load(stack["path"]).affine)
+    )
+    assert stack["size"] == os.path.getsize(stack["path"])
+    assert len(entry["masks"]) == len(entry["stacks"])
+    assert entry["masks"][0]["empty"] is False
+
+
+def test_preflight_abort(cohort):
+    subjects, data_dir, masks_dir, datasource = cohort
+    with pytest.raises(ValueError, match="2 subject"):
+        preflight_subjects(datasource, "abort", data_dir, masks_dir)
+    assert preflight_subjects(datasource, "off", data_dir) is None
+    assert len(datasource.iterables[1]) == 4
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+
+from fetpype.utils import utils_scheduler
+from fetpype.utils.utils_scheduler import (
+    GB,
+    DiskAwareMultiProcPlugin,
+    subject_input_size,
+    workdir_usage,
+)
+
+
+def _touch(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"0" * size)
+
+
+class _Node:
+    def __init__(self, key):
+        self.parameterization = [key]
+
+
+def test_sizes(tmp_path):
+    _touch(str(tmp_path / "data/sub-01/ses-01/anat/a_T2w.nii.gz"), 100)
+    _touch(str(tmp_path / "masks/sub-01/ses-01/anat/a_mask.nii.gz"), 10)
+    _touch(str(tmp_path / "data/sub-02/anat/a_T2w.nii.gz"), 50)
+    dirs = [str(tmp_path / "data"), str(tmp_path / "masks")]
+    assert subject_input_size("_session_01_subject_01", dirs) == 110
+    assert subject_input_size("_session_None_subject_02", dirs) == 50
+    assert subject_input_size("_acquisition_haste", dirs) == 0
+
+    wf = tmp_path / "wf"
+    _touch(str(wf / "pipe/Prepro/_session_01_subject_01/crop/a.nii"), 30)
+    _touch(str(wf / "pipe/Recon/_session_01_subject_01/srr/b.nii"), 20)
+    _touch(str(wf / "_session_01_subject_01/sink/c.pklz"), 5)
+    assert workdir_usage(str(wf)) == {
+        "_session_01_subject_01": {"Prepro": 30, "Recon": 20, ".": 5}
+    }
+
+
+def test_admission(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils_scheduler, "_free_space", lambda _: 10 * GB)
+    plugin = DiskAwareMultiProcPlugin(
+        plugin_args={
+            "n_procs": 1,
+            "min_free_gb": 6,
+            "workflow_dir": str(tmp_path / "wf"),
+            "default_expansion": 2,
+        }
+    )
+    # Three subjects of 1GB of inputs, two jobs each
+    for sub in ("01", "02", "03"):
+        plugin._input_sizes[f"_subject_{sub}"] = GB
+    plugin.procs = [_Node(f"_subject_{s}") for s in ("01", "02", "03") * 2]
+    plugin.proc_done = np.zeros(6, dtype=bool)
+    plugin.proc_pending = np.zeros(6, dtype=bool)
+
+    # 4GB available: two subjects with a 2GB footprint fit
+    assert list(plugin._sort_jobs(np.array([0, 1, 2]))) == [0, 1]
+    plugin.proc_done[[0, 1]] = True
+    plugin.proc_pending[[0, 1]] = True
+    # The running subjects are still expected to use 4GB
+    assert list(plugin._sort_jobs(np.array([2, 3]))) == [3]
+    # Jobs of started subjects always run
+    assert list(plugin._sort_jobs(np.array([2, 4]))) == [4]
+    plugin.pool.shutdown()
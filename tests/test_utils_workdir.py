@@ -0,0 +1,137 @@
+import os
+
+import pytest
+from nipype.utils.filemanip import savepkl
+
+from fetpype.utils.utils_workdir import (
+    WorkdirCleaner,
+    get_workflow_dirs,
+    prune_workdir,
+)
+
+SUBJECT = "_session_01_subject_01"
+
+
+def _touch(path, size=10):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"0" * size)
+    return path
+
+
+def _workflow_dirs(base):
+    return [
+        base,
+        os.path.join(base, "stages"),
+        os.path.join(base, "stages", "Prepro_a"),
+    ]
+
+
+def _workdir(base):
+    """A work directory with two subjects."""
+    files = {}
+    for sub in (SUBJECT, "_session_01_subject_02"):
+        node = os.path.join(base, "stages", "Prepro_a", sub, "Crop")
+        files[sub] = {
+            "data": _touch(os.path.join(node, "mapflow", "_Crop0", "a.nii")),
+            "result": _touch(os.path.join(node, "result_Crop.pklz")),
+            "hash": _touch(os.path.join(node, "_0x1234.json")),
+            "final": _touch(os.path.join(node, "..", "Recon", "srr.nii.gz")),
+            # Stage of another configuration, not part of the run
+            "other": _touch(
+                os.path.join(base, "stages", "Prepro_b", sub, "Crop", "a.nii")
+            ),
+        }
+        sink = os.path.join(base, sub, "final_recon_datasink")
+        os.makedirs(sink)
+        savepkl(
+            os.path.join(sink, "_inputs.pklz"),
+            {"_outputs": {"@srr": os.path.abspath(files[sub]["final"])}},
+        )
+    return files
+
+
+def test_prune_workdir(tmp_path):
+    files = _workdir(str(tmp_path))
+    freed = prune_workdir(_workflow_dirs(str(tmp_path)), [SUBJECT])
+    assert freed == 20
+    pruned = files[SUBJECT]
+    assert os.path.exists(pruned["other"])
+    assert not os.path.exists(pruned["data"])
+    assert not os.path.exists(pruned["final"])
+    # The result of a pruned node goes, its hash file stays
+    assert not os.path.exists(pruned["result"])
+    assert os.path.exists(pruned["hash"])
+    # Other subjects are untouched
+    kept = files["_session_01_subject_02"].values()
+    assert all(os.path.exists(f) for f in kept)
+    # Not an iterable
+    assert prune_workdir(_workflow_dirs(str(tmp_path)), []) == 0
+
+
+def test_prune_workdir_walk(tmp_path, monkeypatch):
+    # Only the directories of the subject are walked, not the whole tree
+    _workdir(str(tmp_path))
+    walked = []
+    walk = os.walk
+
+    def recording_walk(top, **kwargs):
+        for root, dirs, files in walk(top, **kwargs):
+            walked.append(root)
+            yield root, dirs, files
+
+    monkeypatch.setattr(os, "walk", recording_walk)
+    prune_workdir(_workflow_dirs(str(tmp_path)), [SUBJECT])
+    assert walked
+    assert all(SUBJECT in root.split(os.sep) for root in walked)
+
+
+class _Node:
+    def __init__(self, base, name, sub):
+        self.name = name
+        self.parameterization = [sub]
+        self.base = base
+
+    def output_dir(self):
+        return os.path.join(self.base, self.parameterization[0], self.name)
+
+
+def test_workdir_cleaner(tmp_path):
+    base = str(tmp_path)
+    files = _workdir(base)
+    statuses = []
+    cleaner = WorkdirCleaner(
+        _workflow_dirs(base),
+        ["final_recon_datasink", "final_seg_datasink"],
+        "keep_final",
+        lambda node, status: statuses.append(status),
+    )
+    cleaner(_Node(base, "final_recon_datasink", SUBJECT), "end")
+    assert os.path.exists(files[SUBJECT]["data"])
+    cleaner(_Node(base, "Crop", SUBJECT), "end")
+    cleaner(_Node(base, "final_seg_datasink", SUBJECT), "end")
+    assert statuses == ["end"] * 3
+    assert not os.path.exists(files[SUBJECT]["data"])
+    # keep_final keeps the working copies of the outputs
+    assert os.path.exists(files[SUBJECT]["final"])
+    assert os.path.exists(files["_session_01_subject_02"]["data"])
+
+    with pytest.raises(ValueError):
+        WorkdirCleaner(base, [], "keep_some")
+
+
+def test_get_workflow_dirs(tmp_path):
+    import nipype.pipeline.engine as pe
+    from nipype.interfaces.utility import IdentityInterface
+
+    main = pe.Workflow(name="fetpype", base_dir=str(tmp_path))
+    stages = pe.Workflow(name="stages")
+    prepro = pe.Workflow(name="Prepro_a")
+    prepro.add_nodes([pe.Node(IdentityInterface(["x"]), name="Crop")])
+    stages.add_nodes([prepro])
+    main.add_nodes([stages])
+    assert get_workflow_dirs(main) == [
+        str(tmp_path / "fetpype"),
+        str(tmp_path / "fetpype" / "stages"),
+        str(tmp_path / "fetpype" / "stages" / "Prepro_a"),
+    ]
@@ -0,0 +1,79 @@
+import os
+
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
+import pytest
+
+from fetpype.workflows.utils import run_per_subject
+
+
+def _write(x):
+    if x == 3:
+        raise ValueError("Failing subject")
+
+
+def _connect(workflow, datasource):
+    node = pe.Node(
+        niu.Function(input_names=["x"], function=_write), name="write"
+    )
+    workflow.connect(datasource, "x", node, "x")
+
+
+class _Statuses:
+    def __init__(self):
+        self.statuses = []
+
+    def __call__(self, node, status, **kwargs):
+        self.statuses.append((node.name, status))
+
+
+def _callback(workflow):
+    return _Statuses()
+
+
+def test_run_per_subject(tmp_path):
+    datasource = pe.Node(
+        niu.IdentityInterface(fields=["x"]), name="datasource"
+    )
+    datasource.synchronize = True
+    datasource.iterables = [("x",), [(1,), (2,), (3,)]]
+    workflow = pe.Workflow(name="wf", base_dir=str(tmp_path))
+    crash_dir = tmp_path / "crash"
+    workflow.config["execution"]["crashdump_dir"] = str(crash_dir)
+    done = {}
+    with pytest.raises(RuntimeError, match="1 subject"):
+        run_per_subject(
+            workflow,
+            datasource,
+            _connect,
+            2,
+            callback=_callback,
+            on_done=lambda entities, statuses: done.update(
+                {entities: statuses.statuses}
+            ),
+        )
+    assert sorted(done) == [(1,), (2,)]
+    assert done[(1,)] == [("write", "start"), ("write", "end")]
+    # Same layout as a workflow iterating over the subjects
+    assert os.path.exists(tmp_path / "wf/_x_2/write/result_write.pklz")
+    # The crash file of the failed subject goes to the crashdump_dir
+    assert len(list(crash_dir.glob("crash-*.pklz"))) == 1
+
+
+def test_run_per_subject_save_graph(tmp_path, monkeypatch):
+    datasource = pe.Node(
+        niu.IdentityInterface(fields=["x"]), name="datasource"
+    )
+    datasource.synchronize = True
+    datasource.iterables = [("x",), [(1,), (2,)]]
+    workflow = pe.Workflow(name="wf", base_dir=str(tmp_path))
+    graphs = []
+    monkeypatch.setattr(
+        pe.Workflow,
+        "write_graph",
+        lambda self, **kwargs: graphs.append(self.list_node_names()),
+    )
+    run_per_subject(workflow, datasource, _connect, 1, save_graph=True)
+    # The graph of one subject, written before the run
+    assert graphs == [["datasource", "write"]]
+    assert datasource.iterables[1] == [(1,), (2,)]